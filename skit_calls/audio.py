@@ -0,0 +1,349 @@
+"""
+Download the recordings behind the audio_url and call_url columns of a sample.
+
+Downloads run concurrently on one event loop. Concurrency is bounded by the connection pool,
+requests are started at most `rate` times a second (token bucket) and failed downloads are
+retried with exponential backoff. Files are written next to their destination and renamed
+into place, so a partially downloaded file is never visible.
+
+s3:// urls are fetched with aiobotocore, https urls with aiohttp. With `via_s3`, https urls
+of S3 objects are also fetched with the (signed) S3 client. `endpoint_url` points the S3
+client at a stand-in such as minio or localstack.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlsplit
+
+import aiofiles
+import aiohttp
+import attr
+import pandas as pd
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import BotoCoreError, ClientError
+from loguru import logger
+
+from skit_calls import constants as const
+from skit_calls.cache import AudioCache, cache_key, materialize
+
+
+class RetryableError(Exception):
+    pass
+
+
+@attr.s(slots=True)
+class DownloadReport:
+    output_dir: str = attr.ib()
+    downloaded: int = attr.ib(default=0)
+    skipped: int = attr.ib(default=0)
+    cached: int = attr.ib(default=0)
+    failed: Dict[str, str] = attr.ib(factory=dict)
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` acquisitions a second, with bursts of up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def parse_s3_url(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Bucket and key of s3:// urls and https urls of S3 objects, None for other urls.
+    """
+    if match := re.match(const.S3_OBJ_PATTERN, url):
+        return match.group(1), match.group(2)
+    url = url.split("?")[0]
+    if match := re.match(const.S3_URL_PATTERN_1, url):
+        return match.group(2), unquote(match.group(3))
+    if match := re.match(const.S3_URL_PATTERN_2, url):
+        return match.group(1), unquote(match.group(3))
+    return None
+
+
+def source_id(url: str) -> str:
+    """
+    Identify the object behind a url: s3://bucket/key for S3 objects, the url without its query otherwise.
+    """
+    if bucket_key := parse_s3_url(url):
+        return "s3://{}/{}".format(*bucket_key)
+    return url.split("?")[0]
+
+
+def audio_path(url: str, output_dir: str) -> str:
+    """
+    Local path of a recording: <output_dir>/<bucket or host>/<key or path>.
+    """
+    if bucket_key := parse_s3_url(url):
+        root, key = bucket_key
+    else:
+        parts = urlsplit(url)
+        root, key = parts.hostname or "", unquote(parts.path)
+    output_dir = os.path.abspath(output_dir)
+    path = os.path.normpath(os.path.join(output_dir, root, key.lstrip("/")))
+    if not path.startswith(os.path.join(output_dir, "")):
+        raise ValueError(f"{url} points outside of {output_dir}.")
+    return path
+
+
+def read_audio_urls(file_path: str, columns: Sequence[str] = const.AUDIO_COLUMNS) -> Iterator[str]:
+    """
+    Yield the distinct urls in `columns` of a csv or jsonl sample, in file order.
+    """
+    seen = set()
+
+    def rows():
+        if file_path.endswith(const.JSONL_FILE):
+            with open(file_path, "r", encoding="utf-8") as handle:
+                for line in handle:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            chunks = pd.read_csv(
+                file_path, usecols=lambda c: c in columns, dtype=str, chunksize=const.CSV_CHUNK_SIZE
+            )
+            for chunk in chunks:
+                yield from chunk.to_dict("records")
+
+    for row in rows():
+        for column in columns:
+            url = row.get(column)
+            if isinstance(url, str) and url and url not in seen:
+                seen.add(url)
+                yield url
+
+
+async def write_atomically(path: str, chunks) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        async with aiofiles.open(tmp_path, "wb") as handle:
+            async for chunk in chunks:
+                await handle.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def http_chunks(session: aiohttp.ClientSession, url: str):
+    async with session.get(url) as response:
+        if response.status in const.RETRY_STATUSES:
+            raise RetryableError(f"HTTP {response.status}")
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(const.AUDIO_CHUNK_SIZE):
+            yield chunk
+
+
+async def s3_chunks(s3_client, bucket: str, key: str):
+    try:
+        response = await s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if status in const.RETRY_STATUSES:
+            raise RetryableError(str(e)) from e
+        raise
+    async with response["Body"] as stream:
+        while chunk := await stream.read(const.AUDIO_CHUNK_SIZE):
+            yield chunk
+
+
+async def download_one(
+    url: str,
+    path: str,
+    session: aiohttp.ClientSession,
+    s3_client,
+    limiter: RateLimiter,
+    retries: int,
+    via_s3: bool,
+) -> None:
+    bucket_key = parse_s3_url(url) if (via_s3 or url.startswith("s3://")) else None
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        try:
+            if bucket_key:
+                chunks = s3_chunks(s3_client, *bucket_key)
+            else:
+                chunks = http_chunks(session, url)
+            await write_atomically(path, chunks)
+            return
+        except (RetryableError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, BotoCoreError) as e:
+            if attempt == retries:
+                raise
+            backoff = const.AUDIO_RETRY_BACKOFF * 2**attempt
+            logger.debug(f"Retrying {url} in {backoff}s after {e!r}")
+            await asyncio.sleep(backoff)
+
+
+async def adownload_audio(
+    urls: Iterable[str],
+    output_dir: str,
+    concurrency: int = const.AUDIO_CONCURRENCY,
+    rate: float = const.AUDIO_RATE_LIMIT,
+    retries: int = const.AUDIO_RETRIES,
+    endpoint_url: Optional[str] = None,
+    via_s3: bool = False,
+    overwrite: bool = False,
+    cache: Optional[AudioCache] = None,
+    s3_client=None,
+) -> DownloadReport:
+    """
+    Download `urls` into `output_dir`, see `download_audio`.
+
+    Recordings in `cache` are linked into `output_dir` instead of downloaded, new ones are
+    downloaded into the cache first. The cache index is saved when all downloads are done.
+
+    `s3_client` replaces the aiobotocore client, it must provide an async `get_object`.
+    """
+    report = DownloadReport(output_dir=output_dir)
+    limiter = RateLimiter(rate)
+    pending: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    timeout = aiohttp.ClientTimeout(total=const.AUDIO_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def worker(session, client):
+        while (url := await pending.get()) is not None:
+            try:
+                path = audio_path(url, output_dir)
+                if not overwrite and os.path.exists(path):
+                    report.skipped += 1
+                    continue
+                if cache is None:
+                    await download_one(url, path, session, client, limiter, retries, via_s3)
+                    report.downloaded += 1
+                    continue
+                source = source_id(url)
+                cached = cache.get(source)
+                if cached:
+                    report.cached += 1
+                else:
+                    await download_one(url, cache.path(cache_key(source)), session, client, limiter, retries, via_s3)
+                    cached = cache.add(source)
+                    report.downloaded += 1
+                materialize(cached, path)
+            except Exception as e:
+                logger.warning(f"Couldn't download {url}: {e!r}")
+                report.failed[url] = repr(e)
+
+    async def run(client):
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.create_task(worker(session, client)) for _ in range(concurrency)]
+            try:
+                for url in urls:
+                    await pending.put(url)
+                for _ in workers:
+                    await pending.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+    try:
+        if s3_client is not None:
+            await run(s3_client)
+        else:
+            config = AioConfig(max_pool_connections=concurrency)
+            endpoint_url = endpoint_url or os.getenv(const.S3_ENDPOINT_URL)
+            async with get_session().create_client("s3", endpoint_url=endpoint_url, config=config) as client:
+                await run(client)
+    finally:
+        if cache is not None:
+            cache.save()
+
+    logger.info(
+        f"Downloaded {report.downloaded}, linked {report.cached} cached, skipped {report.skipped} existing"
+        f" and failed {len(report.failed)} recordings into {output_dir}"
+    )
+    return report
+
+
+def download_audio(
+    file_path: str,
+    output_dir: str,
+    columns: Sequence[str] = const.AUDIO_COLUMNS,
+    concurrency: int = const.AUDIO_CONCURRENCY,
+    rate: float = const.AUDIO_RATE_LIMIT,
+    retries: int = const.AUDIO_RETRIES,
+    endpoint_url: Optional[str] = None,
+    via_s3: bool = False,
+    overwrite: bool = False,
+    cache_dir: Optional[str] = None,
+    cache_size: int = const.AUDIO_CACHE_SIZE,
+) -> DownloadReport:
+    """
+    Download the recordings of a `sample` or `select` output file.
+
+    :param file_path: A csv or jsonl file written by `sample` or `select`.
+    :type file_path: str
+
+    :param output_dir: Recordings are saved as <output_dir>/<bucket or host>/<key or path>.
+    :type output_dir: str
+
+    :param columns: Columns holding urls, defaults to audio_url and call_url
+    :type columns: Sequence[str], optional
+
+    :param concurrency: Downloads in flight, defaults to 16
+    :type concurrency: int, optional
+
+    :param rate: Requests started per second, 0 is unlimited
+    :type rate: float, optional
+
+    :param retries: Retries after timeouts, connection errors, 429 and 5xx responses
+    :type retries: int, optional
+
+    :param endpoint_url: S3 endpoint, defaults to $S3_ENDPOINT_URL or AWS
+    :type endpoint_url: Optional[str], optional
+
+    :param via_s3: Fetch https urls of S3 objects with the S3 client instead of plain http
+    :type via_s3: bool, optional
+
+    :param overwrite: Download files that already exist in output_dir
+    :type overwrite: bool, optional
+
+    :param cache_dir: Keep recordings in this cache across runs and link them into output_dir
+    :type cache_dir: Optional[str], optional
+
+    :param cache_size: Bytes the cache may hold before least recently used recordings are evicted
+    :type cache_size: int, optional
+
+    :return: Counts of downloaded and skipped files, and the error for each failed url.
+    :rtype: DownloadReport
+    """
+    urls = read_audio_urls(file_path, columns)
+    return asyncio.run(
+        adownload_audio(
+            urls,
+            output_dir,
+            concurrency=concurrency,
+            rate=rate,
+            retries=retries,
+            endpoint_url=endpoint_url,
+            via_s3=via_s3,
+            overwrite=overwrite,
+            cache=AudioCache(cache_dir, cache_size) if cache_dir else None,
+        )
+    )
@@ -0,0 +1,189 @@
+"""
+Run many sample and select jobs in one process.
+
+Jobs are read from a JSON lines file, one job per line: `"command"` is "sample" or "select",
+`"name"` names its output and every other key is a keyword argument of `calls.sample` or
+`calls.select`. Dates are passed as they are to `calls.sample`, not parsed like the CLI's.
+
+All jobs share the process' connection pools and query cache, and run on a thread pool of
+`concurrency` threads. `concurrency` jobs have to fit their connections in `DB_POOL_SIZE`, see
+`db.check_pool_size`. Sample jobs whose call id filters are identical (dates, lang, orgs,
+flows, sampling strategy, seed, ...) share one draw of call ids, sized for the largest of them,
+and each job samples as many as it asked for from it. Jobs that differ only in turn filters, columns
+or output format therefore sample the same calls. Jobs with an exclusion index always draw
+their own ids, the index changes after each job.
+
+Each job writes one output, to its `"output"` (a path or s3:// url) or to
+`<output_dir>/<name>.csv`, and `summary.json` in `output_dir` reports how every job went.
+"""
+import inspect
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import attr
+from loguru import logger
+
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import db
+
+COMMANDS = ("sample", "select")
+
+
+@attr.s(slots=True)
+class Job:
+    name: str = attr.ib()
+    command: str = attr.ib()
+    params: Dict[str, Any] = attr.ib()
+    output: Optional[str] = attr.ib(default=None)
+    draw: Optional[str] = attr.ib(default=None)
+
+
+@attr.s(slots=True)
+class JobReport:
+    name: str = attr.ib()
+    command: str = attr.ib()
+    status: str = attr.ib(default="pending")
+    path: Optional[str] = attr.ib(default=None)
+    error: Optional[str] = attr.ib(default=None)
+    seconds: float = attr.ib(default=0.0)
+    shared_draw: bool = attr.ib(default=False)
+
+
+def read_jobs(jobs_file: str) -> List[Job]:
+    """
+    Parse a jobs file, names default to the job's line number.
+    """
+    jobs = []
+    with open(jobs_file, "r", encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            params = json.loads(line)
+            command = params.pop("command", None)
+            if command not in COMMANDS:
+                raise ValueError(f"Line {line_number}: command should be one of {COMMANDS}, not {command!r}.")
+            name = str(params.pop("name", f"job-{line_number:04d}"))
+            jobs.append(Job(name, command, params, params.pop("output", None)))
+    names = [job.name for job in jobs]
+    if len(set(names)) < len(names):
+        raise ValueError("Job names should be unique, they name the outputs.")
+    return jobs
+
+
+DRAW_PARAMS = {
+    name: parameter.default
+    for name, parameter in inspect.signature(calls.sample_call_ids).parameters.items()
+    if name not in ("call_quantity", "exclusions")
+}
+
+
+def draw_key(job: Job) -> Optional[str]:
+    """
+    The call id filters of a sample job, None for jobs that can't share a draw.
+    """
+    if job.command != "sample" or job.params.get("exclusion_index") or "call_ids" in job.params:
+        return None
+    filters = {name: job.params.get(name, default) for name, default in DRAW_PARAMS.items()}
+    if any(value is inspect.Parameter.empty for value in filters.values()):
+        return None
+    return json.dumps(filters, sort_keys=True, default=str)
+
+
+def output_path(job: Job, output_dir: str) -> str:
+    if job.output:
+        return job.output
+    if job.params.get("shard_size") or job.params.get("num_shards"):
+        return os.path.join(output_dir, job.name)
+    jsonl = job.params.get("output_format") == const.JSONL and not job.params.get("bulk")
+    return os.path.join(output_dir, job.name + (const.JSONL_FILE if jsonl else const.CSV_FILE))
+
+
+class SharedDraws:
+    """
+    Call ids drawn once per set of filters, by the first job that needs them.
+
+    Each job samples as many ids as it asked for from the draw, seeded by the draw's filters
+    (which include `seed`), so jobs sharing a draw overlap on purpose: a smaller job's ids are
+    mostly among a larger job's. That is what lets jobs that only differ in turn filters,
+    columns or output format look at the same calls.
+    """
+
+    def __init__(self, jobs: List[Job]):
+        self.quantities: Dict[str, int] = {}
+        for job in jobs:
+            if job.draw is not None:
+                quantity = job.params.get("call_quantity", const.DEFAULT_CALL_QUANTITY)
+                self.quantities[job.draw] = max(self.quantities.get(job.draw, 0), quantity)
+        self.call_ids: Dict[str, Tuple[int, ...]] = {}
+        self.locks = {key: threading.Lock() for key in self.quantities}
+
+    def get(self, job: Job) -> Tuple[int, ...]:
+        key = job.draw
+        if key is None:
+            raise ValueError(f"Job {job.name} doesn't share a draw.")
+        with self.locks[key]:
+            if key not in self.call_ids:
+                filters = {name: job.params.get(name, default) for name, default in DRAW_PARAMS.items()}
+                self.call_ids[key] = calls.sample_call_ids(**filters, call_quantity=self.quantities[key])
+        quantity = job.params.get("call_quantity", const.DEFAULT_CALL_QUANTITY)
+        call_ids = sorted(self.call_ids[key])
+        wanted = min(math.ceil(quantity * (1 + const.MARGIN)), len(call_ids))
+        return tuple(random.Random(key).sample(call_ids, wanted))
+
+
+def run_job(job: Job, draws: SharedDraws, output_dir: str) -> JobReport:
+    report = JobReport(job.name, job.command, shared_draw=job.draw is not None)
+    start = time.time()
+    try:
+        params = dict(job.params)
+        if job.draw is not None:
+            params["call_ids"] = draws.get(job)
+        report.path = calls.write_result(job.command, params, output_path(job, output_dir))
+        report.status = "done"
+    except Exception as e:
+        logger.exception(f"Job {job.name} failed")
+        report.status, report.error = "failed", repr(e)
+    report.seconds = round(time.time() - start, 3)
+    logger.info(f"Job {job.name} {report.status} in {report.seconds}s")
+    return report
+
+
+def run_batch(
+    jobs_file: str, output_dir: str, concurrency: int = const.BATCH_CONCURRENCY
+) -> Dict[str, Any]:
+    """
+    Run the jobs of `jobs_file`, `concurrency` at a time, and write `summary.json` to `output_dir`.
+
+    :return: The summary.
+    """
+    db.check_pool_size(concurrency, "concurrency")
+    jobs = read_jobs(jobs_file)
+    keys = [draw_key(job) for job in jobs]
+    for job, key in zip(jobs, keys):
+        if key is not None and keys.count(key) > 1:
+            job.draw = key
+    draws = SharedDraws(jobs)
+    shared = sum(job.draw is not None for job in jobs)
+    logger.info(f"Running {len(jobs)} jobs, {shared} of them share {len(draws.quantities)} call id draws.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.time()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="skit-calls-batch") as executor:
+        reports = list(executor.map(lambda job: run_job(job, draws, output_dir), jobs))
+    summary = {
+        "jobs": [attr.asdict(report) for report in reports],
+        "done": sum(report.status == "done" for report in reports),
+        "failed": sum(report.status == "failed" for report in reports),
+        "shared_call_id_draws": len(draws.call_ids),
+        "seconds": round(time.time() - start, 3),
+    }
+    with open(os.path.join(output_dir, const.BATCH_SUMMARY), "w", encoding="utf-8") as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
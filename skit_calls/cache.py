@@ -0,0 +1,157 @@
+"""
+A local, content-addressed cache of recordings shared across runs.
+
+Recordings are stored under the sha256 of their source: the S3 bucket/key, or the url
+without its query string for other urls (see `audio.source_id`), so presigned and public
+urls of the same object share an entry. An index file keeps the size and last use of every
+entry: lookups read one dict entry instead of walking the cache, and eviction drops the least
+recently used entries once the cache grows past its size limit.
+
+Runs sharing a cache directory merge their entries into the index under a lock when they
+save it, so one run doesn't drop what another added.
+
+Cached files are materialised into a run's output directory as hardlinks, falling back to
+symlinks (across filesystems) and then copies. Hardlinked files outlive their eviction from
+the cache, symlinks don't.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set
+
+from loguru import logger
+
+from skit_calls import constants as const
+
+
+def cache_key(source: str) -> str:
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def materialize(source: str, destination: str) -> None:
+    """
+    Make `source` available at `destination` without copying where the filesystem allows.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp_path = f"{destination}.{uuid.uuid4().hex}.part"
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(source), tmp_path)
+            except OSError:
+                shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, destination)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+class AudioCache:
+    """
+    Recordings keyed by `cache_key`, evicted least recently used first past `max_bytes`.
+
+    Call `save` to persist the index, entries added since the last save are otherwise
+    dropped by the next run.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = const.AUDIO_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, const.AUDIO_CACHE_INDEX)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries: Dict[str, Dict[str, float]] = self.load()
+        # Keys dropped since the last save, for `save` to drop from the index on disk too.
+        self.removed: Set[str] = set()
+        self.size = sum(entry["size"] for entry in self.entries.values())
+
+    def load(self) -> Dict[str, Dict[str, float]]:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with open(f"{self.index_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, source: str) -> Optional[str]:
+        """
+        Path of the cached recording of `source`, None if it isn't cached.
+        """
+        key = cache_key(source)
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.size -= self.entries.pop(key)["size"]
+            self.removed.add(key)
+            return None
+        self.entries[key]["used"] = time.time()
+        return path
+
+    def add(self, source: str) -> str:
+        """
+        Record the file written at `self.path(cache_key(source))`, evicting older entries past the limit.
+        """
+        key = cache_key(source)
+        size = os.path.getsize(self.path(key))
+        if key in self.entries:
+            self.size -= self.entries[key]["size"]
+        self.entries[key] = {"size": size, "used": time.time()}
+        self.size += size
+        self.evict(keep=key)
+        return self.path(key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        if self.size <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"]):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.size -= self.entries.pop(key)["size"]
+            self.removed.add(key)
+        logger.debug(f"Audio cache at {self.size} of {self.max_bytes} bytes after eviction.")
+
+    def save(self) -> None:
+        """
+        Merge the entries into the index on disk, keeping the latest use of each, and evict past the limit.
+
+        Entries this cache dropped are dropped from the index unless another run cached them again.
+        """
+        with self.locked():
+            entries = self.load()
+            for key in self.removed:
+                if key in entries and not os.path.exists(self.path(key)):
+                    del entries[key]
+            for key, entry in self.entries.items():
+                if key not in entries or entries[key]["used"] < entry["used"]:
+                    entries[key] = entry
+            self.entries = entries
+            self.size = sum(entry["size"] for entry in entries.values())
+            self.evict()
+            tmp_path = f"{self.index_path}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump(self.entries, handle)
+            os.replace(tmp_path, self.index_path)
+            self.removed.clear()
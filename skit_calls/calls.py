@@ -1,28 +1,246 @@
 import csv
+import io
+import os
+import shutil
+import sys
 import tempfile
 import time
-from typing import Any, Dict, Iterable, List, Optional, Union, Set
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Sized, TextIO, Tuple, Union, Set
 
 import pandas as pd
 from loguru import logger
 
 from skit_calls import constants as const
-from skit_calls.data import mutators, query
-from skit_calls.data.model import Turn
+from skit_calls.data import mutators, query, sampling
+from skit_calls.data.exclusions import ExclusionIndex
+from skit_calls.data.frames import concat_frames
+from skit_calls.data.model import Turn, check_columns, derive_columns, dump_json_line
+from skit_calls.shards import save_turns_in_shards
+from skit_calls.upload import is_s3_url, open_s3_output
+from skit_calls.utils import parse_size, prefetch
 
 def save_turns_in_memory(stream: Iterable[Dict[str, Any]]) -> pd.DataFrame:
     return pd.DataFrame(list(stream))
 
 
-def save_turns_on_disk(stream: Iterable[Dict[str, Any]]) -> str:
-    _, file_path = tempfile.mkstemp(suffix=const.CSV_FILE)
-    with open(file_path, "w", encoding="utf-8") as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=Turn.__slots__)
-        writer.writeheader()
-        for turn in stream:
-            writer.writerow(turn)
+def write_csv(stream: Iterable[Dict[str, Any]], handle, columns: Optional[Tuple[str, ...]] = None) -> None:
+    writer = csv.DictWriter(handle, fieldnames=columns or Turn.__slots__)
+    writer.writeheader()
+    for turn in stream:
+        writer.writerow(turn)
+
+
+def write_csv_rows(stream: Iterable[Tuple[Any, ...]], handle, columns: Optional[Tuple[str, ...]] = None) -> None:
+    writer = csv.writer(handle)
+    writer.writerow(columns or Turn.__slots__)
+    writer.writerows(stream)
+
+
+def write_jsonl(stream: Iterable[Dict[str, Any]], handle) -> None:
+    for turn in stream:
+        handle.write(dump_json_line(turn))
+        handle.write("\n")
+
+
+@contextmanager
+def open_output(suffix: str, output: Optional[str] = None) -> Iterator[Tuple[TextIO, str]]:
+    """
+    A handle to write a result to and where it ends up: a temp file, or an S3 object
+    streamed while it is written if `output` is an s3:// url.
+    """
+    if output is not None:
+        with open_s3_output(output, suffix) as (handle, url):
+            yield handle, url
+        return
+    _, file_path = tempfile.mkstemp(suffix=suffix)
+    with open(file_path, "w", encoding="utf-8") as handle:
+        yield handle, file_path
+
+
+def save_turns_on_disk(
+    stream: Iterable[Dict[str, Any]],
+    output_format: str = const.CSV,
+    columns: Optional[Tuple[str, ...]] = None,
+    output: Optional[str] = None,
+) -> str:
+    if output_format == const.JSONL:
+        suffix, write = const.JSONL_FILE, write_jsonl
+    elif output_format == const.CSV_ROWS:
+        suffix, write = const.CSV_FILE, partial(write_csv_rows, columns=columns)
+    else:
+        suffix, write = const.CSV_FILE, partial(write_csv, columns=columns)
+    with open_output(suffix, output) as (handle, file_path):
+        write(stream, handle)
+    return file_path
+
+
+def approx_size(turn: Dict[str, Any]) -> int:
+    """
+    Approximate bytes held by a serialized turn, nested values are already strings.
+    """
+    return sys.getsizeof(turn) + sum(sys.getsizeof(value) for value in turn.values())
+
+
+class TurnResults:
+    """
+    Turns kept in memory, or in a csv file once they outgrew the memory budget.
+
+    Iterate for turn dicts, use `iter_chunks` for DataFrames or `to_frame` to load everything.
+    Turns read back from a spilled file have the string values of the csv output.
+    """
+
+    def __init__(self, turns: Optional[List[Dict[str, Any]]] = None, path: Optional[str] = None):
+        self.turns: List[Dict[str, Any]] = turns or []
+        self.path = path
+
+    @property
+    def spilled(self) -> bool:
+        return self.path is not None
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self.path is None:
+            yield from self.turns
+            return
+        with open(self.path, "r", encoding="utf-8") as handle:
+            yield from csv.DictReader(handle)
+
+    def iter_chunks(self, chunk_size: int = const.CSV_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        if not self.spilled:
+            yield from iter_chunks(self.turns, chunk_size)
+            return
+        yield from pd.read_csv(self.path, chunksize=chunk_size)
+
+    def to_frame(self) -> pd.DataFrame:
+        if self.spilled:
+            return pd.read_csv(self.path)
+        return pd.DataFrame(self.turns)
+
+
+def budget_bytes(memory_budget: Union[int, str, bool]) -> int:
+    """
+    Bytes in a memory budget, `True` stands for the default budget, `MEMORY_LIMIT`.
+    """
+    if memory_budget is True:
+        return int(const.MEMORY_LIMIT)
+    return parse_size(memory_budget)
+
+
+def save_turns_within_budget(
+    stream: Iterable[Dict[str, Any]],
+    memory_budget: int = int(const.MEMORY_LIMIT),
+    columns: Optional[Tuple[str, ...]] = None,
+) -> TurnResults:
+    """
+    Buffer turns in memory until their approximate size passes `memory_budget` bytes,
+    then write the buffer and the rest of the stream to a csv file.
+    """
+    stream = iter(stream)
+    turns, size = [], 0
+    for turn in stream:
+        turns.append(turn)
+        size += approx_size(turn)
+        if size > memory_budget:
+            logger.info(f"Turns passed the memory budget of {memory_budget} bytes, spilling to disk.")
+            return TurnResults(path=save_turns_on_disk(chain(turns, stream), columns=columns))
+    return TurnResults(turns=turns)
+
+
+def turn_format(output_format: str, on_disk: bool, as_rows: bool = True, as_frame: bool = False) -> str:
+    """
+    How turns are decoded: csv files are written from row tuples unless dicts are needed,
+    in-memory results are decoded into DataFrames when `as_frame` is set.
+    """
+    if not on_disk:
+        return const.FRAME if as_frame else const.CSV
+    if output_format == const.CSV and as_rows:
+        return const.CSV_ROWS
+    return output_format
+
+
+def check_output_columns(
+    columns: Optional[List[str]], bulk: bool = False, sharded: bool = False
+) -> Optional[Tuple[str, ...]]:
+    """
+    Validate a `columns` projection against the output it is written to.
+    """
+    checked = check_columns(columns)
+    if checked is None:
+        return None
+    if bulk:
+        raise ValueError("Bulk exports write every query column, columns can't be picked.")
+    if sharded and "call_id" not in checked:
+        raise ValueError("Shards are split by call, columns must include call_id.")
+    return checked
+
+
+def check_output(output: Optional[str], on_disk: bool = True, sharded: bool = False) -> None:
+    """
+    Validate an `output` url against the kind of result that is written to it.
+    """
+    if output is None:
+        return
+    if not is_s3_url(output):
+        raise ValueError(f"Invalid output {output}, expected s3://bucket/prefix.")
+    if not on_disk or sharded:
+        raise ValueError("An output url takes a single file, it can't be combined with shards or in-memory results.")
+
+
+def export_turns_on_disk(
+    copied_batches: Iterable[str],
+    domain_url: str = const.DEFAULT_AUDIO_URL_DOMAIN,
+    use_fsm_url: bool = False,
+    timezone: str = const.DEFAULT_TIMEZONE,
+    output: Optional[str] = None,
+    delivered: Optional[Set[int]] = None,
+) -> str:
+    """
+    Write CSV batches from `query.gen_copied_batches` to a single file.
+
+    The raw query columns are kept as the db formatted them, `DERIVED_COLUMNS` are appended.
+    The call ids of the written rows are added to `delivered` if a set is given.
+    """
+    writer = None
+    with open_output(const.CSV_FILE, output) as (handle, file_path):
+        for copied_batch in copied_batches:
+            reader = csv.DictReader(io.StringIO(copied_batch, newline=""))
+            if writer is None:
+                if not reader.fieldnames:
+                    continue
+                fieldnames = list(reader.fieldnames) + [
+                    column for column in const.DERIVED_COLUMNS if column not in reader.fieldnames
+                ]
+                writer = csv.DictWriter(handle, fieldnames=fieldnames)
+                writer.writeheader()
+            for row in reader:
+                row.update(derive_columns(row, domain_url, use_fsm_url, timezone))
+                writer.writerow(row)
+                if delivered is not None:
+                    delivered.add(int(row["call_id"]))
     return file_path
 
+def stream_call_ids_from_csv(
+    csv_file: str,
+    uuid_col: str,
+    org_ids: Set[int],
+    chunk_size: int = const.CSV_CHUNK_SIZE,
+    batch_size: int = const.UUID_BATCH_SIZE,
+) -> Iterable[int]:
+    """
+    Call ids for the uuids in a csv file, resolved on a background thread as the file is read.
+
+    Only the uuid column of `chunk_size` rows is held in memory at a time.
+    """
+    uuid_chunks = (
+        chunk[uuid_col].dropna().unique()
+        for chunk in pd.read_csv(csv_file, usecols=[uuid_col], chunksize=chunk_size)
+    )
+    call_id_batches = query.gen_call_ids_from_uuids(uuid_chunks, org_ids, batch_size=batch_size)
+    return chain.from_iterable(prefetch(call_id_batches, maxsize=const.PREFETCH_BATCHES))
+
+
 def get_call_ids_for_flow(flow_id, 
                         call_quantity, 
                         random_call_id_limit,
@@ -36,11 +254,14 @@ def get_call_ids_for_flow(flow_id,
                         use_case,
                         flow_name,
                         ignore_callers,
-                        reported):
+                        reported,
+                        sampling_strategy=const.RANDOM_SAMPLING,
+                        seed=None,
+                        exclusions=None):
     logger.info(f"Random id limit {random_call_id_limit}")
     logger.info(f"Call quantity limit {call_quantity}")
     logger.info(f"Flow ids {flow_id}")
-    call_ids = query.gen_random_call_ids(
+    call_filters = query.get_call_filters(
         start_date=start_date,
         end_date=end_date,
         ids_=org_ids,
@@ -56,10 +277,89 @@ def get_call_ids_for_flow(flow_id,
         flow_id=flow_id,
         random_id_limit=random_call_id_limit
     )
+    call_ids = sampling.sample_call_ids(sampling_strategy, call_filters, seed=seed, exclusions=exclusions)
     logger.info(f"Number of call Ids obtained is {len(call_ids)}")
     return call_ids
 
 
+def sample_call_ids(
+    start_date: str,
+    end_date: str,
+    lang: str,
+    org_ids: Optional[List[str]] = [],
+    call_quantity: int = 200,
+    call_type: List[str] = [const.INBOUND, const.OUTBOUND],
+    ignore_callers: Optional[List[str]] = None,
+    reported: bool = False,
+    template_id: Optional[int] = None,
+    use_case: Optional[str] = None,
+    flow_name: Optional[str] = None,
+    min_duration: Optional[float] = None,
+    flow_ids: Optional[List[str]] = [],
+    sampling_strategy: str = const.RANDOM_SAMPLING,
+    seed: Optional[int] = None,
+    exclusions: Optional[ExclusionIndex] = None,
+) -> Tuple[int]:
+    """
+    Pick the call ids to sample, see `sample` for the parameters.
+    """
+    start_time = time.time()
+    random_id_limit = min(30*call_quantity, 75000)
+    all_call_ids = []
+    logger.info(f"Flow ids: {flow_ids}")
+    for flow_id in flow_ids:
+        flow_id_list = []
+        flow_id_list.append(flow_id)
+        random_call_ids =  get_call_ids_for_flow(flow_id_list, const.MIN_ASSURED_CALL_QUANTITY, 
+                                                const.MIN_RANDOM_CALL_ID_LIMIT, start_date,
+                                                end_date, org_ids, call_type, lang,
+                                                min_duration, template_id, use_case,
+                                                flow_name, ignore_callers, reported,
+                                                sampling_strategy, seed, exclusions)
+        random_call_id_list_1= list(random_call_ids)
+        logger.info(f"Number of call ids for flow {flow_id}: {len(random_call_id_list_1)}")
+        all_call_ids += random_call_id_list_1
+    
+    loop_end_time = time.time()
+    final_time = str(loop_end_time-start_time)
+    logger.info(f"Time to finish loop: {final_time}")
+            
+    random_call_ids =  get_call_ids_for_flow(flow_ids, call_quantity, 
+                                            random_id_limit, start_date,
+                                            end_date, org_ids, call_type, lang,
+                                            min_duration, template_id, use_case,
+                                            flow_name, ignore_callers, reported,
+                                            sampling_strategy, seed, exclusions)
+    
+    end_time_1 = time.time()
+    final_time_1 = str(end_time_1-start_time)
+    
+    random_call_id_list_2= list(random_call_ids)
+    all_call_ids += random_call_id_list_2
+    
+    final_call_ids = tuple(set(all_call_ids))
+    
+    logger.info(f"Number of call ids: {len(final_call_ids)}")
+    
+    logger.info(f"Time to finish getting call ids: {final_time_1}")
+    return random_call_ids
+
+
+def top_up_kwargs(top_up: bool, call_quantity: int, pick_call_ids, seed: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Arguments of `query.gen_random_call_batches` that top up a sample to `call_quantity` calls.
+
+    A seeded sample draws each round with the next seed, so reruns draw the same rounds.
+    """
+    if not top_up:
+        return {}
+
+    def draw_call_ids(quantity: int, round_: int, seen: Set[int]) -> Tuple[int]:
+        return pick_call_ids(call_quantity=quantity, seed=None if seed is None else seed + round_)
+
+    return {"target_calls": call_quantity, "draw_call_ids": draw_call_ids}
+
+
 def sample(
     start_date: str,
     end_date: str,
@@ -83,7 +383,22 @@ def sample(
     delay: float = const.Q_DELAY,
     timezone: str = const.DEFAULT_TIMEZONE,
     flow_ids: Optional[List[str]] = [],
-) -> Union[str, pd.DataFrame]:
+    output_format: str = const.CSV,
+    workers: int = const.DECODE_WORKERS,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    bulk: bool = False,
+    shard_size: Union[int, str, None] = None,
+    num_shards: Optional[int] = None,
+    sampling_strategy: str = const.RANDOM_SAMPLING,
+    seed: Optional[int] = None,
+    partition: Optional[Tuple[int, int]] = None,
+    memory_budget: Union[int, str, bool, None] = None,
+    columns: Optional[List[str]] = None,
+    top_up: bool = False,
+    exclusion_index: Optional[str] = None,
+    output: Optional[str] = None,
+    call_ids: Optional[Sequence[int]] = None,
+) -> Union[str, pd.DataFrame, TurnResults]:
     """
     Sample calls.
 
@@ -141,48 +456,114 @@ def sample(
     :param flow_ids: A list of flow ids from which to retrieve the data
     :type flow_ids: Optional[str]
 
+    :param output_format: File format when on_disk is set, "csv" or "jsonl", defaults to "csv"
+    :type output_format: str, optional
+
+    :param workers: Number of processes decoding turn batches, defaults to decoding in-process
+    :type workers: int, optional
+
+    :param queue_size: Batches queued between the fetch, decode and write stages, 0 runs them serially
+    :type queue_size: int, optional
+
+    :param bulk: Export the raw query columns with COPY and only add derived columns, implies on_disk
+    :type bulk: bool, optional
+
+    :param shard_size: Write a directory of shards of this many rows, or bytes for sizes like "64MB".
+        Calls are never split across shards, shards are listed in manifest.json as they are completed.
+    :type shard_size: Union[int, str, None], optional
+
+    :param num_shards: Write this many shards with an equal number of calls instead
+    :type num_shards: Optional[int], optional
+
+    :param sampling_strategy: How call ids are picked, "random", "block" or "hash", defaults to "random".
+        See `skit_calls.data.sampling` for the tradeoffs.
+    :type sampling_strategy: str, optional
+
+    :param seed: Seed for the sampling strategy, the same seed picks the same calls
+    :type seed: Optional[int], optional
+
+    :param partition: Keep only partition i of N, `(i, N)`, of the sampled calls. N processes with the
+        same seed, one per partition, produce the same dataset as a single process.
+    :type partition: Optional[Tuple[int, int]], optional
+
+    :param memory_budget: Without on_disk, return a `TurnResults` that moves to a csv file once the turns
+        take more than this many bytes (or a size like "2GB", True for `MEMORY_LIMIT`) instead of a DataFrame.
+    :type memory_budget: Union[int, str, bool, None], optional
+
+    :param columns: Output only these `Turn` fields, in this order. Fields that aren't requested
+        aren't fetched or computed, e.g. no presigned urls without "audio_url". Sharding needs "call_id".
+    :type columns: Optional[List[str]], optional
+
+    :param top_up: Keep drawing disjoint call ids until call_quantity calls have turns matching
+        asr_provider, intents and states, sized by the share of calls that matched so far.
+        Can't be combined with partition or bulk.
+    :type top_up: bool, optional
+
+    :param exclusion_index: A .npy file of call ids that are never sampled, see `skit_calls.data.exclusions`.
+        Created if missing, the call ids that had turns in the output are added once the output is complete.
+    :type exclusion_index: Optional[str], optional
+
+    :param output: Stream the output file to this s3://bucket/prefix with a multipart upload while turns
+        are fetched, nothing is written locally. Needs on_disk and can't be combined with shards.
+    :type output: Optional[str], optional
+
+    :param call_ids: Call ids already drawn with these filters, e.g. shared between jobs by `skit_calls.batch`.
+        They replace the first draw, top-up rounds still draw more.
+    :type call_ids: Optional[Sequence[int]], optional
+
     :return: A directory path if save is set to "files" otherwise path to a file.
     :rtype: str
     """
-    start_time = time.time()
-    random_id_limit = min(30*call_quantity, 75000)
-    all_call_ids = []
-    logger.info(f"Flow ids: {flow_ids}")
-    for flow_id in flow_ids:
-        flow_id_list = []
-        flow_id_list.append(flow_id)
-        random_call_ids =  get_call_ids_for_flow(flow_id_list, const.MIN_ASSURED_CALL_QUANTITY, 
-                                                const.MIN_RANDOM_CALL_ID_LIMIT, start_date,
-                                                end_date, org_ids, call_type, lang,
-                                                min_duration, template_id, use_case,
-                                                flow_name, ignore_callers, reported)
-        random_call_id_list_1= list(random_call_ids)
-        logger.info(f"Number of call ids for flow {flow_id}: {len(random_call_id_list_1)}")
-        all_call_ids += random_call_id_list_1
-    
-    loop_end_time = time.time()
-    final_time = str(loop_end_time-start_time)
-    logger.info(f"Time to finish loop: {final_time}")
-            
-    random_call_ids =  get_call_ids_for_flow(flow_ids, call_quantity, 
-                                            random_id_limit, start_date,
-                                            end_date, org_ids, call_type, lang,
-                                            min_duration, template_id, use_case,
-                                            flow_name, ignore_callers, reported)
-    
+    exclusions = ExclusionIndex(exclusion_index) if exclusion_index else None
+    pick_call_ids = partial(
+        sample_call_ids,
+        start_date,
+        end_date,
+        lang,
+        org_ids=org_ids,
+        call_type=call_type,
+        ignore_callers=ignore_callers,
+        reported=reported,
+        template_id=template_id,
+        use_case=use_case,
+        flow_name=flow_name,
+        min_duration=min_duration,
+        flow_ids=flow_ids,
+        sampling_strategy=sampling_strategy,
+        exclusions=exclusions,
+    )
+    if top_up and partition:
+        raise ValueError("Top-up sampling depends on the turns each run fetched, it can't be partitioned.")
+    if call_ids is None:
+        call_ids = pick_call_ids(call_quantity=call_quantity, seed=seed)
+    random_call_ids = tuple(sampling.partition_call_ids(call_ids, partition))
+    # Call ids with turns in the output, only these are added to the exclusion index.
+    delivered: Set[int] = set()
+    if partition and seed is None:
+        logger.warning("Partitions of an unseeded sample are drawn from different samples.")
     end_time_1 = time.time()
-    final_time_1 = str(end_time_1-start_time)
-    
-    random_call_id_list_2= list(random_call_ids)
-    all_call_ids += random_call_id_list_2
-    
-    final_call_ids = tuple(set(all_call_ids))
-    
-    logger.info(f"Number of call ids: {len(final_call_ids)}")
-    
-    logger.info(f"Time to finish getting call ids: {final_time_1}")
+    output_columns = check_output_columns(columns, bulk, bool(shard_size or num_shards))
+    check_output(output, on_disk or bulk, not bulk and bool(shard_size or num_shards))
+
+    if top_up and bulk:
+        raise ValueError("Bulk exports can't top up the sample, drop bulk or top_up.")
+    if bulk:
+        copied_batches = query.gen_copied_batches(
+            random_call_ids,
+            asr_provider=asr_provider,
+            intents=intents,
+            states=states,
+            limit=batch_turns,
+            delay=delay,
+        )
+        if exclusions is None:
+            return export_turns_on_disk(copied_batches, domain_url, use_fsm_url, timezone, output)
+        copied_batches = exclusions.add_after(copied_batches, delivered)
+        return export_turns_on_disk(copied_batches, domain_url, use_fsm_url, timezone, output, delivered)
 
-    random_call_data = query.gen_random_calls(
+    sharded = on_disk and bool(shard_size or num_shards)
+    decoded_as = turn_format(output_format, on_disk, as_rows=not sharded, as_frame=memory_budget is None)
+    call_batches = query.gen_random_call_batches(
         random_call_ids,
         asr_provider=asr_provider,
         intents=intents,
@@ -192,16 +573,68 @@ def sample(
         domain_url=domain_url,
         use_fsm_url=use_fsm_url,
         timezone=timezone,
+        output_format=decoded_as,
+        workers=workers,
+        queue_size=queue_size,
+        columns=output_columns,
+        delivered=None if exclusions is None else delivered,
+        **top_up_kwargs(top_up, call_quantity, pick_call_ids, seed),
     )
+    if exclusions is not None:
+        call_batches = exclusions.add_after(call_batches, delivered)
+    if sharded:
+        return save_turns_in_shards(
+            call_batches,
+            tempfile.mkdtemp(),
+            output_format,
+            shard_size,
+            num_shards,
+            n_calls=call_quantity if top_up else len(random_call_ids),
+            columns=output_columns,
+        )
+    if decoded_as == const.FRAME:
+        df = concat_frames(call_batches)
+        logger.info(f"Number of call with data obtained is {df.shape[0]}")
+        return df
+    random_call_data = chain.from_iterable(call_batches)
     end_time_second = time.time()
     total_time_second_query = str(end_time_second - end_time_1)
     logger.info(f"Time required to obtain call data from queried IDs {total_time_second_query} seconds")
     if on_disk:
-        return save_turns_on_disk(random_call_data)
+        return save_turns_on_disk(random_call_data, decoded_as, output_columns, output)
+    if memory_budget is not None:
+        return save_turns_within_budget(random_call_data, budget_bytes(memory_budget), output_columns)
     df = save_turns_in_memory(random_call_data)
     logger.info(f"Number of call with data obtained is {df.shape[0]}")
     return df
 
+def select_call_ids(
+    call_ids: Optional[List[int]] = None,
+    org_ids: Optional[Set[int]] = None,
+    csv_file: Optional[str] = None,
+    uuid_col: Optional[str] = None,
+    stream: bool = False,
+) -> Iterable[int]:
+    """
+    Resolve the call ids to select, see `select` for the parameters.
+    """
+    if csv_file and uuid_col and org_ids and stream:
+        streamed = iter(stream_call_ids_from_csv(csv_file, uuid_col, org_ids))
+        # A stream is always truthy, the first id tells whether the csv matched any calls.
+        first = next(streamed, None)
+        if first is None:
+            raise ValueError("No call ids or csv file provided.")
+        return chain([first], streamed)
+    elif csv_file and uuid_col and org_ids:
+        df = pd.read_csv(csv_file)
+        resolved = query.get_call_ids_from_uuids(tuple(df[uuid_col].unique()), org_ids)
+    else:
+        raise ValueError("Both csv_file or uuid_column must be provided.")
+    if not resolved:
+        raise ValueError("No call ids or csv file provided.")
+    return resolved
+
+
 def select(
     call_ids: Optional[List[int]] = None,
     org_ids: Optional[Set[int]] = None,
@@ -209,8 +642,19 @@ def select(
     uuid_col: Optional[str] = None,
     call_history: bool = False,
     on_disk: bool = True,
-    delay: float = const.Q_DELAY
-) -> Union[str, pd.DataFrame]:
+    delay: float = const.Q_DELAY,
+    output_format: str = const.CSV,
+    workers: int = const.DECODE_WORKERS,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    bulk: bool = False,
+    shard_size: Union[int, str, None] = None,
+    num_shards: Optional[int] = None,
+    stream: bool = False,
+    partition: Optional[Tuple[int, int]] = None,
+    memory_budget: Union[int, str, bool, None] = None,
+    columns: Optional[List[str]] = None,
+    output: Optional[str] = None,
+) -> Union[str, pd.DataFrame, TurnResults]:
     """
     Sample calls.
 
@@ -220,23 +664,247 @@ def select(
     :param on_disk: To save "in-memory" (works for <5k calls) vs "files", defaults to True
     :type on_disk: bool
 
+    :param output_format: File format when on_disk is set, "csv" or "jsonl", defaults to "csv"
+    :type output_format: str, optional
+
+    :param workers: Number of processes decoding turn batches, defaults to decoding in-process
+    :type workers: int, optional
+
+    :param queue_size: Batches queued between the fetch, decode and write stages, 0 runs them serially
+    :type queue_size: int, optional
+
+    :param bulk: Export the raw query columns with COPY and only add derived columns, implies on_disk
+    :type bulk: bool, optional
+
+    :param shard_size: Write a directory of shards of this many rows, or bytes for sizes like "64MB".
+        Calls are never split across shards, shards are listed in manifest.json as they are completed.
+    :type shard_size: Union[int, str, None], optional
+
+    :param num_shards: Write this many shards with an equal number of calls instead
+    :type num_shards: Optional[int], optional
+
+    :param stream: Read csv_file in chunks and download turns while later uuids are still being resolved
+    :type stream: bool, optional
+
+    :param partition: Keep only partition i of N, `(i, N)`, of the selected calls
+    :type partition: Optional[Tuple[int, int]], optional
+
+    :param memory_budget: Without on_disk, return a `TurnResults` that moves to a csv file once the turns
+        take more than this many bytes (or a size like "2GB", True for `MEMORY_LIMIT`) instead of a DataFrame.
+    :type memory_budget: Union[int, str, bool, None], optional
+
+    :param columns: Output only these `Turn` fields, in this order. Fields that aren't requested
+        aren't fetched or computed, e.g. no presigned urls without "audio_url". Sharding needs "call_id".
+    :type columns: Optional[List[str]], optional
+
+    :param output: Stream the output file to this s3://bucket/prefix while turns are fetched, see `sample`
+    :type output: Optional[str], optional
+
     :return: A directory path if save is set to "files" otherwise path to a file.
     :rtype: str
     """
     try:
-        if csv_file and uuid_col and org_ids:
-            df = pd.read_csv(csv_file)
-            call_ids = query.get_call_ids_from_uuids(org_ids, tuple(df[uuid_col].unique()))
-        else:
-            raise ValueError("Both csv_file or uuid_column must be provided.")
-        if not call_ids:
-            raise ValueError("No call ids or csv file provided.")
-        random_call_data = query.gen_random_calls(call_ids, delay=const.Q_DELAY)
+        selected = sampling.partition_call_ids(
+            select_call_ids(call_ids, org_ids, csv_file, uuid_col, stream), partition
+        )
+        output_columns = check_output_columns(columns, bulk, bool(shard_size or num_shards))
+        check_output(output, on_disk or bulk, not bulk and bool(shard_size or num_shards))
+        if bulk:
+            return export_turns_on_disk(query.gen_copied_batches(selected, delay=delay), output=output)
+        sharded = on_disk and bool(shard_size or num_shards)
+        decoded_as = turn_format(
+            output_format,
+            on_disk,
+            as_rows=not (sharded or call_history),
+            as_frame=memory_budget is None and not call_history,
+        )
+        call_batches = query.gen_random_call_batches(
+            selected,
+            delay=const.Q_DELAY,
+            output_format=decoded_as,
+            workers=workers,
+            queue_size=queue_size,
+            columns=output_columns,
+        )
+        if sharded:
+            if call_history:
+                raise ValueError("Call history can't be written in shards.")
+            n_calls = len(selected) if isinstance(selected, Sized) else None
+            return save_turns_in_shards(
+                call_batches,
+                tempfile.mkdtemp(),
+                output_format,
+                shard_size,
+                num_shards,
+                n_calls=n_calls,
+                columns=output_columns,
+            )
+        if decoded_as == const.FRAME:
+            return concat_frames(call_batches)
+        random_call_data = chain.from_iterable(call_batches)
         if call_history:
             random_call_data = mutators.add_call_history(random_call_data)
         if on_disk:
-            return save_turns_on_disk(random_call_data)
+            return save_turns_on_disk(random_call_data, decoded_as, output_columns, output)
+        if memory_budget is not None:
+            return save_turns_within_budget(random_call_data, budget_bytes(memory_budget), output_columns)
         return save_turns_in_memory(random_call_data)
     except Exception as e:
         logger.error(e)
         logger.error(f"This error is common if you are requesting a large dataset.")
+
+
+def write_result(command: str, params: Dict[str, Any], output: str) -> str:
+    """
+    Run `sample` or `select` with `params` and put the file or shard directory at `output`:
+    streamed there for s3:// urls, moved there from the temp directory otherwise.
+    """
+    commands: Dict[str, Callable[..., Any]] = {"sample": sample, "select": select}
+    job = partial(commands[command], **{**params, "on_disk": True})
+    if is_s3_url(output):
+        return job(output=output)
+    path = job()
+    if not isinstance(path, str):
+        raise RuntimeError(f"The {command} job didn't produce a file, check the logs.")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    return shutil.move(path, output)
+
+
+def iter_chunks(
+    turns: Iterable[Dict[str, Any]], chunk_size: Optional[int] = None
+) -> Iterator[Union[Dict[str, Any], pd.DataFrame]]:
+    """
+    Yield turns one by one, or as DataFrames of `chunk_size` turns.
+    """
+    turns = iter(turns)
+    if not chunk_size:
+        yield from turns
+        return
+    while chunk := list(islice(turns, chunk_size)):
+        yield pd.DataFrame(chunk)
+
+
+def iter_sample(
+    start_date: str,
+    end_date: str,
+    lang: str,
+    domain_url: str = const.DEFAULT_AUDIO_URL_DOMAIN,
+    org_ids: Optional[List[str]] = [],
+    call_quantity: int = 200,
+    call_type: List[str] = [const.INBOUND, const.OUTBOUND],
+    use_fsm_url: bool = False,
+    ignore_callers: Optional[List[str]] = None,
+    reported: bool = False,
+    template_id: Optional[int] = None,
+    use_case: Optional[str] = None,
+    flow_name: Optional[str] = None,
+    min_duration: Optional[float] = None,
+    asr_provider: Optional[str] = None,
+    states: Optional[List[str]] = None,
+    intents: Optional[List[str]] = None,
+    batch_turns: int = const.TURNS_LIMIT,
+    delay: float = const.Q_DELAY,
+    timezone: str = const.DEFAULT_TIMEZONE,
+    flow_ids: Optional[List[str]] = [],
+    workers: int = const.DECODE_WORKERS,
+    sampling_strategy: str = const.RANDOM_SAMPLING,
+    seed: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    *,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    partition: Optional[Tuple[int, int]] = None,
+    columns: Optional[List[str]] = None,
+    top_up: bool = False,
+    exclusion_index: Optional[str] = None,
+) -> Iterator[Union[Dict[str, Any], pd.DataFrame]]:
+    """
+    Sample calls as a stream, without an intermediate file.
+
+    Takes the parameters of `sample`. Turns are fetched as the caller consumes them
+    so memory stays constant whatever the quantity. Parameters after `chunk_size` are
+    keyword-only, so that new ones never shift positional arguments.
+
+    :param chunk_size: Yield DataFrames of this many turns, defaults to yielding turn dicts
+    :type chunk_size: Optional[int], optional
+
+    :return: Turns with the same values as the rows of `sample`.
+    :rtype: Iterator[Union[Dict[str, Any], pd.DataFrame]]
+    """
+    exclusions = ExclusionIndex(exclusion_index) if exclusion_index else None
+    pick_call_ids = partial(
+        sample_call_ids,
+        start_date,
+        end_date,
+        lang,
+        org_ids=org_ids,
+        call_type=call_type,
+        ignore_callers=ignore_callers,
+        reported=reported,
+        template_id=template_id,
+        use_case=use_case,
+        flow_name=flow_name,
+        min_duration=min_duration,
+        flow_ids=flow_ids,
+        sampling_strategy=sampling_strategy,
+        exclusions=exclusions,
+    )
+    if top_up and partition:
+        raise ValueError("Top-up sampling depends on the turns each run fetched, it can't be partitioned.")
+    random_call_ids = tuple(
+        sampling.partition_call_ids(pick_call_ids(call_quantity=call_quantity, seed=seed), partition)
+    )
+    delivered: Set[int] = set()
+    turns = query.gen_random_calls(
+        random_call_ids,
+        asr_provider=asr_provider,
+        intents=intents,
+        states=states,
+        limit=batch_turns,
+        delay=delay,
+        domain_url=domain_url,
+        use_fsm_url=use_fsm_url,
+        timezone=timezone,
+        workers=workers,
+        queue_size=queue_size,
+        columns=columns,
+        delivered=None if exclusions is None else delivered,
+        **top_up_kwargs(top_up, call_quantity, pick_call_ids, seed),
+    )
+    if exclusions is not None:
+        turns = exclusions.add_after(turns, delivered)
+    yield from iter_chunks(turns, chunk_size)
+
+
+def iter_select(
+    call_ids: Optional[List[int]] = None,
+    org_ids: Optional[Set[int]] = None,
+    csv_file: Optional[str] = None,
+    uuid_col: Optional[str] = None,
+    delay: float = const.Q_DELAY,
+    workers: int = const.DECODE_WORKERS,
+    stream: bool = False,
+    chunk_size: Optional[int] = None,
+    *,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    partition: Optional[Tuple[int, int]] = None,
+    columns: Optional[List[str]] = None,
+) -> Iterator[Union[Dict[str, Any], pd.DataFrame]]:
+    """
+    Select calls as a stream, without an intermediate file.
+
+    Takes the parameters of `select`, errors are raised instead of logged. Parameters after
+    `chunk_size` are keyword-only.
+
+    :param chunk_size: Yield DataFrames of this many turns, defaults to yielding turn dicts
+    :type chunk_size: Optional[int], optional
+
+    :return: Turns with the same values as the rows of `select`.
+    :rtype: Iterator[Union[Dict[str, Any], pd.DataFrame]]
+    """
+    selected = sampling.partition_call_ids(
+        select_call_ids(call_ids, org_ids, csv_file, uuid_col, stream), partition
+    )
+    turns = query.gen_random_calls(
+        selected, delay=delay, workers=workers, queue_size=queue_size, columns=columns
+    )
+    yield from iter_chunks(turns, chunk_size)
@@ -1,4 +1,5 @@
 import argparse
+import os
 import tempfile
 import time
 from typing import Optional, Union, Tuple
@@ -8,9 +9,11 @@ import pandas as pd
 import pytz
 from loguru import logger
 
-from skit_calls import calls
+from skit_calls import audio, batch, calls, server
 from skit_calls import constants as const
-from skit_calls.utils import configure_logger, process_ids_to_int
+from skit_calls.data.model import check_columns
+from skit_calls.upload import parse_output_url
+from skit_calls.utils import configure_logger, parse_size, process_ids_to_int
 
 
 def to_datetime(date_string: Optional[str]) -> datetime:
@@ -30,6 +33,49 @@ def to_datetime(date_string: Optional[str]) -> datetime:
         )
 
 
+def parse_partition(partition: str) -> Tuple[int, int]:
+    """
+    Parse a partition "i/N" into (i, N), 0 <= i < N.
+
+    :param partition: A partition like "0/4".
+    :type partition: str
+    """
+    try:
+        index, count = (int(part) for part in partition.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid partition {partition}: expected i/N, like 0/4.")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid partition {partition}: i should be in [0, N).")
+    return index, count
+
+
+def parse_columns(columns: str) -> Optional[Tuple[str, ...]]:
+    """
+    Parse comma separated `Turn` fields.
+
+    :param columns: Fields like "call_uuid,intent".
+    :type columns: str
+    """
+    try:
+        return check_columns(column.strip() for column in columns.split(",") if column.strip())
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_output(output: str) -> str:
+    """
+    Check an s3://bucket/prefix output.
+
+    :param output: An output like "s3://datasets/calls/".
+    :type output: str
+    """
+    try:
+        parse_output_url(output)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return output
+
+
 def validate_date_ranges(start_date: datetime, end_date: datetime) -> None:
     """
     Check if start_date is before end_date.
@@ -188,6 +234,31 @@ def build_sample_command(parser: argparse.ArgumentParser) -> None:
         help="A comma separated list of states to keep turns from, and remove all else.",
         default=[],
     )
+    parser.add_argument(
+        "--sampling-strategy",
+        type=str,
+        choices=const.SAMPLING_STRATEGIES,
+        default=const.RANDOM_SAMPLING,
+        help="How call ids are picked: random orders all candidates, block reads a fraction of the"
+        " table's pages, hash picks hash buckets of call ids. block and hash scale with --call-quantity.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the block and hash sampling strategies.",
+    )
+    parser.add_argument(
+        "--top-up",
+        action="store_true",
+        help="Draw more calls until --call-quantity calls have turns matching --asr-provider, --intents and --states.",
+    )
+    parser.add_argument(
+        "--exclusion-index",
+        type=str,
+        default=None,
+        help="A .npy file of call ids to never sample, created if missing. Sampled call ids are added after each run.",
+    )
     parser.add_argument(
         "--flow-ids",
         type=str,
@@ -226,6 +297,12 @@ def build_select_command(parser: argparse.ArgumentParser) -> None:
         "--uuid-column",
         help="The column name of the UUID column in the CSV file. Required if --csv is set.",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read --csv in chunks and start downloading turns while uuids are still being resolved.",
+        default=False,
+    )
     parser.add_argument(
         "--history",
         action="store_true",
@@ -234,6 +311,118 @@ def build_select_command(parser: argparse.ArgumentParser) -> None:
     )
 
 
+def build_download_audio_command(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "file",
+        help="A csv or jsonl file written by the sample or select commands.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory to save recordings in, a new temporary directory by default.",
+    )
+    parser.add_argument(
+        "--columns",
+        nargs="+",
+        default=list(const.AUDIO_COLUMNS),
+        help="Columns holding the urls to download.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=const.AUDIO_CONCURRENCY,
+        help="Number of downloads in flight.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=const.AUDIO_RATE_LIMIT,
+        help="Maximum requests started per second, 0 is unlimited.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=const.AUDIO_RETRIES,
+        help="Retries after timeouts, connection errors, 429 and 5xx responses.",
+    )
+    parser.add_argument(
+        "--s3-endpoint-url",
+        help=f"S3 endpoint for s3:// urls, defaults to ${const.S3_ENDPOINT_URL} or AWS.",
+    )
+    parser.add_argument(
+        "--via-s3",
+        action="store_true",
+        default=False,
+        help="Fetch https urls of S3 objects with signed S3 requests.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=False,
+        help="Download files that already exist in --output-dir.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep recordings in this directory across runs and link them into --output-dir.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        default=const.AUDIO_CACHE_SIZE,
+        help="Size the cache may grow to before least recently used recordings are evicted, e.g. 50GB.",
+    )
+
+
+def download_audio(args: argparse.Namespace) -> str:
+    report = audio.download_audio(
+        args.file,
+        args.output_dir or tempfile.mkdtemp(),
+        columns=args.columns,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        retries=args.retries,
+        endpoint_url=args.s3_endpoint_url,
+        via_s3=args.via_s3,
+        overwrite=args.overwrite,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+    )
+    return report.output_dir
+
+
+def build_serve_command(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--host", default=const.SERVE_HOST, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=const.SERVE_PORT, help="Port to listen on.")
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=const.SERVE_MAX_JOBS,
+        help="Jobs run at once, requests beyond this are answered with 429. "
+        f"Each job can hold {const.DB_CONNECTIONS_PER_JOB} of the DB_POOL_SIZE db connections.",
+    )
+    parser.add_argument(
+        "--root",
+        default=const.SERVE_ROOT,
+        help="Directory jobs may read and write local files in ($SERVE_ROOT), without it only s3:// urls are accepted.",
+    )
+
+
+def build_batch_command(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "jobs",
+        help="A JSON lines file of jobs: a command (sample or select), a name and the python arguments of the command.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory for the jobs' outputs and summary.json, defaults to a temp directory.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=const.BATCH_CONCURRENCY,
+        help=f"Jobs run at once, each can hold {const.DB_CONNECTIONS_PER_JOB} of the DB_POOL_SIZE db connections.",
+    )
+
+
 def build_cli():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -252,6 +441,21 @@ def build_cli():
     build_select_command(
         subparsers.add_parser("select", help="Select calls from known call-ids.")
     )
+    build_download_audio_command(
+        subparsers.add_parser(
+            "download-audio", help="Download the recordings of a sample or select output file."
+        )
+    )
+    build_batch_command(
+        subparsers.add_parser(
+            "batch", help="Run the sample and select jobs of a JSON lines file in one process."
+        )
+    )
+    build_serve_command(
+        subparsers.add_parser(
+            "serve", help="Serve sample and select jobs over HTTP, keeping connections and caches warm."
+        )
+    )
 
     parser.add_argument(
         "--delay",
@@ -275,6 +479,74 @@ def build_cli():
         help="Each record is written directly to disk. Highly recommended for large queries.",
         default=True,
     )
+
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=const.OUTPUT_FORMATS,
+        default=const.CSV,
+        help="Format of the output file. jsonl keeps nested fields as native JSON.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=const.DECODE_WORKERS,
+        help="Number of processes that decode turn batches while the next ones are fetched.",
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=const.PIPELINE_QUEUE_SIZE,
+        help="Batches queued between the fetch, decode and write stages. 0 runs the stages one after another.",
+    )
+
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        default=False,
+        help="Export raw turn columns via COPY and add only the derived columns (audio_url, intent, ...)."
+        " Always written as csv on disk.",
+    )
+
+    parser.add_argument(
+        "--partition",
+        type=parse_partition,
+        help="Keep only partition i/N of the calls, assigned by a hash of the call id."
+        " N processes with the same --seed, one per partition, produce the dataset of a single process.",
+    )
+
+    parser.add_argument(
+        "--columns",
+        type=parse_columns,
+        help="Output only these comma separated turn fields, e.g. call_uuid,conversation_uuid,intent,audio_url."
+        " Other fields aren't fetched or computed.",
+    )
+
+    parser.add_argument(
+        "--output",
+        type=parse_output,
+        help="Stream the output file to s3://bucket/prefix with a multipart upload while turns are fetched,"
+        " instead of a local temp file. $S3_ENDPOINT_URL points it at a stand-in like minio.",
+    )
+
+    parser.add_argument(
+        "--memory-budget",
+        help="Collect turns in memory and write them to a csv file only if they outgrow this size, e.g. 2GB.",
+    )
+
+    shards = parser.add_mutually_exclusive_group()
+    shards.add_argument(
+        "--shard-size",
+        help="Write a directory of shards with this many rows, or bytes for sizes like 64MB."
+        " Calls are never split and shards are listed in manifest.json as soon as they are complete.",
+    )
+    shards.add_argument(
+        "--num-shards",
+        type=int,
+        help="Write a directory of this many shards with an equal number of calls.",
+    )
     return parser
 
 
@@ -309,22 +581,48 @@ def random_sample_calls(args: argparse.Namespace) -> Union[str, pd.DataFrame]:
         asr_provider=args.asr_provider,
         intents=args.intents,
         states=args.states,
-        on_disk=args.on_disk,
+        on_disk=args.on_disk and not args.memory_budget,
         batch_turns=args.batch_turns,
         delay=args.delay,
         timezone=args.timezone,
-        flow_ids=args.flow_ids
+        flow_ids=args.flow_ids,
+        output_format=args.output_format,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        bulk=args.bulk,
+        shard_size=args.shard_size,
+        num_shards=args.num_shards,
+        sampling_strategy=args.sampling_strategy,
+        seed=args.seed,
+        partition=args.partition,
+        memory_budget=args.memory_budget,
+        columns=args.columns,
+        top_up=args.top_up,
+        exclusion_index=args.exclusion_index,
+        output=args.output,
     )
     logger.info(f"Finished in {time.time() - start:.2f} seconds")
     return maybe_df
 
 
-def cmd_to_str(args: argparse.Namespace) -> str:
+def cmd_to_str(args: argparse.Namespace) -> None:
     configure_logger(args.verbose)
 
     maybe_df = None
     if args.command == "sample":
         maybe_df = random_sample_calls(args)
+    elif args.command == "download-audio":
+        print(download_audio(args))
+        return
+    elif args.command == "batch":
+        output_dir = args.output_dir or tempfile.mkdtemp()
+        summary = batch.run_batch(args.jobs, output_dir, args.concurrency)
+        logger.info(f"{summary['done']} jobs done, {summary['failed']} failed.")
+        print(os.path.join(output_dir, const.BATCH_SUMMARY))
+        return
+    elif args.command == "serve":
+        server.serve(args.host, args.port, args.max_jobs, args.root)
+        return
     elif args.command == "select":
         maybe_df = calls.select(
             args.call_ids,
@@ -332,14 +630,36 @@ def cmd_to_str(args: argparse.Namespace) -> str:
             args.csv,
             args.uuid_column,
             args.history,
-            on_disk=args.on_disk,
+            on_disk=args.on_disk and not args.memory_budget,
             delay=args.delay,
+            output_format=args.output_format,
+            workers=args.workers,
+            queue_size=args.queue_size,
+            bulk=args.bulk,
+            shard_size=args.shard_size,
+            num_shards=args.num_shards,
+            stream=args.stream,
+            partition=args.partition,
+            memory_budget=args.memory_budget,
+            columns=args.columns,
+            output=args.output,
         )
     else:
         raise argparse.ArgumentError(f"Unknown command {args.command}")
 
-    if args.on_disk:
+    if isinstance(maybe_df, calls.TurnResults):
+        if maybe_df.spilled:
+            print(maybe_df.path)
+            return
+        maybe_df = maybe_df.to_frame()
+    elif args.on_disk or args.bulk or not isinstance(maybe_df, pd.DataFrame):
         print(maybe_df)
+        return
+
+    if args.output_format == const.JSONL:
+        _, file_path = tempfile.mkstemp(suffix=const.JSONL_FILE)
+        maybe_df.to_json(file_path, orient="records", lines=True, force_ascii=False)
+        print(file_path)
     else:
         _, file_path = tempfile.mkstemp(suffix=const.CSV_FILE)
         maybe_df.to_csv(file_path, index=False)
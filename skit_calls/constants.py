@@ -19,6 +19,7 @@ a_dict[const.KEY]
 In the latter, a mature IDE will suggest the KEY constant, reducing time and ensuring consistency.
 """
 import os
+import tempfile
 
 ID = "id"
 AUTHORIZATION = "authorization"
@@ -87,8 +88,18 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
 ON_DISK = "on-disk"
 IN_MEMORY = "in-memory"
+# Default memory budget in bytes, for `memory_budget=True`.
 MEMORY_LIMIT = 10e7
 Q_DELAY = 0.2
+# Milliseconds a batch query may run before it is cancelled and bisected, 0 disables the timeout.
+STATEMENT_TIMEOUT = int(os.getenv("STATEMENT_TIMEOUT_MS", 120_000))
+# Retries of a batch after lost connections or serialization conflicts, waiting twice as long each time.
+TRANSIENT_RETRIES = int(os.getenv("TRANSIENT_RETRIES", 5))
+# Queries slower than this, and cancelled ones, get their EXPLAIN in SLOW_QUERY_LOG, 0 turns it off.
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", 30_000))
+# 1 explains slow queries that finished with EXPLAIN (ANALYZE, BUFFERS), which runs them a second time.
+SLOW_QUERY_ANALYZE = bool(int(os.getenv("SLOW_QUERY_ANALYZE", 0)))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", os.path.join(tempfile.gettempdir(), "skit-calls-slow-queries.jsonl"))
 DEFAULT_API_GATEWAY_URL = "https://apigateway.vernacular.ai"
 DEFAULT_AUDIO_URL_DOMAIN = "https://cca-v2-apis.vernacular.ai"
 DEFAULT_CALL_QUANTITY = 200
@@ -100,6 +111,8 @@ S3_OBJ_PATTERN = r"s3:\/\/([a-zA-Z0-9\-]+)\/(.+)"
 RANDOM_CALL_ID_QUERY = "RANDOM_CALL_ID_QUERY"
 RANDOM_CALL_DATA_QUERY = "RANDOM_CALL_DATA_QUERY"
 CALL_IDS_FROM_UUIDS_QUERY = "CALL_IDS_FROM_UUIDS_QUERY"
+BLOCK_SAMPLED_CALL_ID_QUERY = "BLOCK_SAMPLED_CALL_ID_QUERY"
+HASH_SAMPLED_CALL_ID_QUERY = "HASH_SAMPLED_CALL_ID_QUERY"
 RANDOM_CALL_DATA_CURSOR = "random_call_data_cursor"
 
 # Call types
@@ -111,7 +124,20 @@ DB_PORT = "DB_PORT"
 DB_USER = "DB_USER"
 DB_PASSWORD = "DB_PASSWORD"
 DB_NAME = "DB_NAME"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))  # connections per db host
+# A streamed select resolves uuids on one connection while it fetches turns on another.
+DB_CONNECTIONS_PER_JOB = 2
+PREPARE_STATEMENTS = True
+# How id sets used with `IN %(name)s` are bound, picked by the size of the set.
+BIND_TUPLE = "tuple"
+BIND_ARRAY = "array"
+BIND_TEMP_TABLE = "temp_table"
+ID_SET_ARRAY_THRESHOLD = 100
+ID_SET_TEMP_TABLE_THRESHOLD = 10000
+# SQL type of the calls' uuid column, large uuid sets are bound as arrays or temp tables of it.
+CALL_UUID_TYPE = os.getenv("CALL_UUID_TYPE", "uuid")
 EXCLUDED_NUMBERS = "excluded_numbers"
+EXCLUDED_CALL_IDS = "excluded_call_ids"
 CALL_IDS = "call_ids"
 USE_CASE = "use_case"
 FLOW_NAME = "flow_name"
@@ -134,13 +160,85 @@ BOT_RESPONSE = "bot_response"
 CDN_RECORDINGS_BASE_PATH = "CDN_RECORDINGS_BASE_PATH"
 WAV_FILE = ".wav"
 CSV_FILE = ".csv"
+JSONL_FILE = ".jsonl"
+CSV = "csv"
+JSONL = "jsonl"
+OUTPUT_FORMATS = (CSV, JSONL)
+CSV_ROWS = "csv_rows"  # internal: csv output decoded as tuples in Turn.__slots__ order
+FRAME = "frame"  # internal: in-memory output decoded as a DataFrame per batch
+# Turn fields that are only decoded from the db's JSON, never transformed.
+RAW_JSON_FIELDS = ("context", "prediction", "intents_info")
+# Turn fields computed from the raw query columns, added to bulk (COPY) exports.
+DERIVED_COLUMNS = (
+    "audio_url",
+    "call_url",
+    "readable_reftime",
+    "intent",
+    "intent_score",
+    "primary_utterance",
+    "format_utterances",
+    "bot_response",
+)
 LIMIT = "limit"
 OFFSET = "offset"
 TURNS_LIMIT = 1000
+CSV_CHUNK_SIZE = 50000  # rows of a --csv file read at once by a streaming select
+UUID_BATCH_SIZE = 5000  # uuids resolved to call ids per query
+PREFETCH_BATCHES = 4  # resolved batches of call ids waiting for the turn fetcher
+PIPELINE_QUEUE_SIZE = 2  # batches waiting between the fetch, decode and write stages, 0 runs them serially
+DECODE_WORKERS = 0  # batches are decoded in the main process unless > 1
 CONVERSATION_TYPES = "conversation_types"
 CONVERSATION_SUB_TYPES = "conversation_sub_types"
 UCASE_INPUT = "INPUT"
 UCASE_AUDIO = "AUDIO"
 MARGIN = 0.1
+
+# Call id sampling strategies, see skit_calls.data.sampling
+RANDOM_SAMPLING = "random"
+BLOCK_SAMPLING = "block"
+HASH_SAMPLING = "hash"
+SAMPLING_STRATEGIES = (RANDOM_SAMPLING, BLOCK_SAMPLING, HASH_SAMPLING)
+SAMPLE_PERCENT = "sample_percent"
+SEED = "seed"
+HASH_BUCKETS_PARAM = "hash_buckets"
+HASH_BUCKETS = 1024  # must match the mask in HASH_SAMPLED_CALL_ID_QUERY: hashint8(id) & 1023
+HASH_START_BUCKETS = 4
+BLOCK_SAMPLE_START_PERCENT = 0.1
+BLOCK_SAMPLE_GROWTH = 4
 MIN_ASSURED_CALL_QUANTITY = 25 # minimum assured  number of calls per flow id
-MIN_RANDOM_CALL_ID_LIMIT = 750  # An upper limit of  MIN_ASSURED_CALL_QUANTITY * 30
\ No newline at end of file
+MIN_RANDOM_CALL_ID_LIMIT = 750  # An upper limit of  MIN_ASSURED_CALL_QUANTITY * 30
+# Top-up sampling, see query.gen_topped_up_raw_batches
+TOP_UP_ROUNDS = 5  # further draws of call ids after the first sample
+TOP_UP_MIN_HIT_RATE = 0.02  # floor of the estimated share of calls with matching turns
+# Exclusion index, see skit_calls.data.exclusions
+EXCLUSION_ROUNDS = 3  # draws with a larger limit when excluded ids crowd out a sample
+# Audio downloads, see skit_calls.audio
+AUDIO_COLUMNS = ("audio_url", "call_url")
+AUDIO_CONCURRENCY = 16  # downloads in flight, also the size of the connection pool
+AUDIO_RATE_LIMIT = 0.0  # requests started per second, 0 is unlimited
+AUDIO_RETRIES = 3
+AUDIO_RETRY_BACKOFF = 0.5  # seconds, doubled after every failed attempt
+AUDIO_TIMEOUT = 60  # seconds per download
+AUDIO_CHUNK_SIZE = 1 << 16
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+S3_ENDPOINT_URL = "S3_ENDPOINT_URL"
+AUDIO_CACHE_SIZE = 10 * 2**30  # bytes
+AUDIO_CACHE_INDEX = "index.json"
+# Streaming output to S3, see skit_calls.upload
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", 8 * 2**20))  # bytes, S3 needs at least 5MB for all but the last part
+S3_UPLOAD_CONCURRENCY = 4  # parts uploaded in flight
+# Service mode, see skit_calls.server
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765
+SERVE_MAX_JOBS = int(os.getenv("SERVE_MAX_JOBS", 4))  # jobs running at once, more are answered with 429
+SERVE_CHUNK_TURNS = 500  # turns fetched per step of a streamed response
+SERVE_ROOT = os.getenv("SERVE_ROOT")  # directory for local paths of jobs, unset allows only s3:// urls
+# Batch runs, see skit_calls.batch
+BATCH_CONCURRENCY = 4  # jobs running at once
+BATCH_SUMMARY = "summary.json"
+SHARD_MANIFEST = "manifest.json"
+# Read replicas, see skit_calls.data.db.Endpoints
+DB_HOSTS = "DB_HOSTS"  # comma separated host[:port][*weight], the first one is the primary
+DB_EJECT_AFTER = 3  # failures in a row before a host is skipped
+DB_EJECT_SECONDS = 30
+DB_LATENCY_ALPHA = 0.2  # weight of the latest latency in a host's moving average
@@ -1,7 +1,14 @@
 import os
-from typing import Optional
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
 
 import psycopg2 as pg
+from loguru import logger
+from psycopg2.extensions import QueryCanceledError, TransactionRollbackError
+from psycopg2.pool import ThreadedConnectionPool
 
 from skit_calls import constants as const
 
@@ -35,3 +42,238 @@ def connect(
     return pg.connect(
         host=host, port=port, user=user, password=password, dbname=db_name
     )
+
+
+class PreparingConnection(pg.extensions.connection):
+    """
+    A connection that remembers the statements prepared on its session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Endpoint:
+    """
+    A db host with its own pool of connections, and the health the pool's users observed.
+
+    `slots` counts the connections `pooled` may still borrow, a thread waits for one rather than
+    have the pool raise PoolError when all of them are in use.
+    """
+
+    def __init__(self, host: Optional[str], port: Optional[str] = None, weight: float = 1.0, primary: bool = False):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.primary = primary
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.pool: Optional[ThreadedConnectionPool] = None
+        self.slots = threading.BoundedSemaphore(const.DB_POOL_SIZE)
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.host}:{self.port}, weight={self.weight}, primary={self.primary})"
+
+    def get_pool(self, maxconn: int = const.DB_POOL_SIZE) -> ThreadedConnectionPool:
+        with self.lock:
+            if self.pool is None or self.pool.closed:
+                self.pool = ThreadedConnectionPool(
+                    1,
+                    maxconn,
+                    host=self.host,
+                    port=self.port,
+                    user=os.getenv(const.DB_USER),
+                    password=os.getenv(const.DB_PASSWORD),
+                    dbname=os.getenv(const.DB_NAME),
+                    connection_factory=PreparingConnection,
+                )
+            return self.pool
+
+    def close(self) -> None:
+        with self.lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+
+
+def parse_endpoints(hosts: str, default_port: Optional[str] = None) -> List[Endpoint]:
+    """
+    Parse DB_HOSTS, comma separated `host[:port][*weight]`. The first host is the primary.
+
+    >>> parse_endpoints("primary:5432*1, replica-1*3")
+    [Endpoint(primary:5432, weight=1.0, primary=True), Endpoint(replica-1:None, weight=3.0, primary=False)]
+    """
+    endpoints = []
+    for i, spec in enumerate(filter(None, (spec.strip() for spec in hosts.split(",")))):
+        address, _, weight = spec.partition("*")
+        host, _, port = address.partition(":")
+        endpoints.append(Endpoint(host, port or default_port, float(weight or 1), primary=i == 0))
+    if not endpoints:
+        raise ValueError(f"No hosts in {const.DB_HOSTS}={hosts!r}.")
+    return endpoints
+
+
+def is_host_failure(error: BaseException) -> bool:
+    """
+    Connection level errors count against a host, query errors like conflicts or timeouts don't.
+    """
+    return isinstance(error, (pg.OperationalError, pg.InterfaceError)) and not isinstance(
+        error, (TransactionRollbackError, QueryCanceledError)
+    )
+
+
+class Endpoints:
+    """
+    Spread connections over the primary and read replicas.
+
+    Hosts are picked at random in proportion to weight / latency, using an exponentially
+    weighted moving average of each host's latency. A host that fails `eject_after` times in
+    a row is skipped for `eject_seconds`, then given another chance. If every host is ejected,
+    the one due back first is used.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        eject_after: int = const.DB_EJECT_AFTER,
+        eject_seconds: float = const.DB_EJECT_SECONDS,
+        alpha: float = const.DB_LATENCY_ALPHA,
+        rng: Optional[random.Random] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.endpoints = endpoints
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.alpha = alpha
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def choose(self, writable: bool = False) -> Endpoint:
+        """
+        Pick a host, only the primary if the session will write (e.g. temp tables).
+        """
+        candidates = [ep for ep in self.endpoints if ep.primary] if writable else self.endpoints
+        with self.lock:
+            now = self.clock()
+            healthy = [ep for ep in candidates if ep.ejected_until <= now]
+            if not healthy:
+                return min(candidates, key=lambda ep: ep.ejected_until)
+            latencies = [ep.latency for ep in healthy if ep.latency is not None]
+            # Hosts without a measurement yet are assumed as fast as the fastest one, so they get probed.
+            default_latency = min(latencies, default=1.0)
+            scores = [ep.weight / max(ep.latency or default_latency, 1e-3) for ep in healthy]
+            return self.rng.choices(healthy, weights=scores)[0]
+
+    def record_success(self, endpoint: Endpoint, seconds: float) -> None:
+        with self.lock:
+            endpoint.failures = 0
+            if endpoint.latency is None:
+                endpoint.latency = seconds
+            else:
+                endpoint.latency += self.alpha * (seconds - endpoint.latency)
+
+    def record_failure(self, endpoint: Endpoint) -> None:
+        with self.lock:
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_after:
+                endpoint.ejected_until = self.clock() + self.eject_seconds
+                logger.warning(
+                    f"Ejecting {endpoint} for {self.eject_seconds}s after {endpoint.failures} failures in a row."
+                )
+
+    def close(self) -> None:
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+
+_endpoints: Optional[Endpoints] = None
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoints() -> Endpoints:
+    """
+    The process wide endpoints, from DB_HOSTS or else DB_HOST, created on first use.
+    """
+    global _endpoints
+    with _endpoints_lock:
+        if _endpoints is None:
+            hosts = os.getenv(const.DB_HOSTS)
+            if hosts:
+                endpoints = parse_endpoints(hosts, os.getenv(const.DB_PORT))
+            else:
+                endpoints = [Endpoint(os.getenv(const.DB_HOST), os.getenv(const.DB_PORT), primary=True)]
+            _endpoints = Endpoints(endpoints)
+        return _endpoints
+
+
+def get_pool(maxconn: int = const.DB_POOL_SIZE) -> ThreadedConnectionPool:
+    """
+    The pool of connections to the primary, created on first use.
+    """
+    return get_endpoints().choose(writable=True).get_pool(maxconn)
+
+
+def close_pools() -> None:
+    get_endpoints().close()
+
+
+def check_pool_size(jobs: int, name: str, pool_size: Optional[int] = None) -> None:
+    """
+    Reject running `jobs` at once if they could need more connections than a pool has.
+
+    A job waiting for a connection while holding one could otherwise wait forever on the others.
+    """
+    pool_size = const.DB_POOL_SIZE if pool_size is None else pool_size
+    if jobs < 1:
+        raise ValueError(f"{name} should be at least 1, got {jobs}.")
+    needed = jobs * const.DB_CONNECTIONS_PER_JOB
+    if needed > pool_size:
+        raise ValueError(
+            f"{name}={jobs} jobs can hold up to {needed} db connections, more than DB_POOL_SIZE={pool_size}. "
+            f"Lower {name} to {max(pool_size // const.DB_CONNECTIONS_PER_JOB, 1)} or raise DB_POOL_SIZE."
+        )
+
+
+@contextmanager
+def pooled(writable: bool = False):
+    """
+    Borrow a connection from one of the endpoints, the transaction is committed or rolled back on exit.
+
+    Sessions that create tables, even temporary ones, need `writable` as replicas are read only.
+    Connections that broke while borrowed are closed instead of being returned to the pool.
+    Waits for a connection when all of the endpoint's are borrowed.
+    """
+    endpoints = get_endpoints()
+    endpoint = endpoints.choose(writable)
+    slots = endpoint.slots
+    slots.acquire()
+    start = time.monotonic()
+    try:
+        pool = endpoint.get_pool()
+        conn = pool.getconn()
+    except BaseException as e:
+        slots.release()
+        if is_host_failure(e):
+            endpoints.record_failure(endpoint)
+        raise
+    try:
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        if is_host_failure(e):
+            endpoints.record_failure(endpoint)
+        try:
+            conn.rollback()
+        except pg.Error:
+            conn.close()
+        raise
+    else:
+        endpoints.record_success(endpoint, time.monotonic() - start)
+    finally:
+        try:
+            pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            slots.release()
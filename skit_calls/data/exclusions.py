@@ -0,0 +1,105 @@
+"""
+A persistent index of call ids that sampling must never return again.
+
+The index is a sorted array of unique int64 call ids saved as a `.npy` file: 8 bytes per id,
+memory mapped on load and probed with a binary search (`np.searchsorted`), so millions of ids
+load instantly and a batch of candidates is checked in one vectorised call.
+
+Exclusions are pushed into the call id queries as `NOT IN %(excluded_call_ids)s`, see
+`sampling.sample_call_ids`, and every sampled id is confirmed against the index. Updates
+take a lock and merge into the file on disk, so concurrent runs don't drop each other's ids.
+"""
+import fcntl
+import os
+import uuid
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Sequence, Tuple, TypeVar
+
+import numpy as np
+from loguru import logger
+
+T = TypeVar("T")
+
+
+def as_id_array(call_ids: Iterable[int]) -> np.ndarray:
+    return np.unique(np.fromiter((int(call_id) for call_id in call_ids), dtype=np.int64))
+
+
+class ExclusionIndex:
+    """
+    Call ids kept in a sorted `.npy` file at `path`, created empty if it doesn't exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = self.load()
+
+    def load(self) -> np.ndarray:
+        if not os.path.exists(self.path):
+            return np.empty(0, dtype=np.int64)
+        return np.load(self.path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, call_id: int) -> bool:
+        return bool(self.contains([call_id])[0])
+
+    def contains(self, call_ids: Sequence[int]) -> np.ndarray:
+        """
+        A boolean mask of the `call_ids` that are in the index.
+        """
+        candidates = np.asarray(call_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, candidates)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == candidates[found]
+        return found
+
+    def filter(self, call_ids: Sequence[int]) -> Tuple[int, ...]:
+        """
+        The `call_ids` that aren't in the index, in their original order.
+        """
+        if not len(call_ids) or not len(self.ids):
+            return tuple(call_ids)
+        excluded = self.contains(call_ids)
+        return tuple(call_id for call_id, skip in zip(call_ids, excluded) if not skip)
+
+    def as_tuple(self) -> Tuple[int, ...]:
+        return tuple(self.ids.tolist())
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, call_ids: Iterable[int]) -> int:
+        """
+        Merge `call_ids` into the index file and reload it, returns the number of new ids.
+        """
+        new_ids = as_id_array(call_ids)
+        with self.locked():
+            current = self.load()
+            merged = np.union1d(current, new_ids)
+            added = len(merged) - len(current)
+            if added:
+                tmp_path = f"{self.path}.{uuid.uuid4().hex}.part"
+                with open(tmp_path, "wb") as handle:
+                    np.save(handle, merged)
+                os.replace(tmp_path, self.path)
+            self.ids = self.load()
+        logger.info(f"Added {added} call ids to the exclusion index, {len(self.ids)} in total.")
+        return added
+
+    def add_after(self, stream: Iterable[T], call_ids: Iterable[int]) -> Iterator[T]:
+        """
+        Yield from `stream`, then add `call_ids` once it was consumed completely.
+
+        `call_ids` is read at the end, so a collection that grows while the stream runs is fine.
+        """
+        yield from stream
+        self.add(call_ids)
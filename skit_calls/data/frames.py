@@ -0,0 +1,253 @@
+"""
+Decode turn batches straight into DataFrame columns.
+
+A fetched batch is transposed once and each `Turn` field is built as a column: timestamps,
+url joins and float conversions are vectorised, JSON columns are parsed once per row and
+shared by every field derived from them. Frames equal a DataFrame of `Turn.to_dict` rows
+for the same batch, without building a `Turn` and a dict per row.
+"""
+import json
+import os
+from functools import cached_property
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from skit_calls import constants as const
+from skit_calls.data.model import (
+    Turn,
+    get_call_url,
+    get_url,
+    jsonify_maybestr,
+    jsonify_utterances,
+    prediction2intent,
+    slots2entities,
+)
+
+# urljoin resolves these differently from a plain concatenation: schemes, params, queries,
+# fragments, empty and dot segments.
+UNSAFE_BASE = r"^(?!https?://[^/?#;]+(?:/[^?#;%]*)?$)|[^:]//|(?:^|/)\.\.?(?:/|$)"
+UNSAFE_PATH = r"^$|[:;?#]|//|(?:^|/)\.\.?(?:/|$)"
+
+
+# One encoder for every value, `json.dumps` builds a new one per call for non-default options.
+encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def serialize(value: Any) -> Any:
+    return encode(value) if isinstance(value, (dict, list)) else value
+
+
+def join_urls(
+    bases: Sequence[Optional[str]], paths: Sequence[Optional[str]], fallback: Callable[[Any, Any], Optional[str]]
+) -> np.ndarray:
+    """
+    `urljoin(os.path.join(base, ""), unquote(path).lstrip("/"))` for each pair.
+
+    Pairs where that is a concatenation are joined as strings, `fallback(base, path)` is
+    called for the rest.
+    """
+    base_series = pd.Series(bases, dtype=object)
+    relative = pd.Series([path if path is None else unquote(path) for path in paths], dtype=object).str.lstrip("/")
+    safe = (
+        base_series.notna()
+        & relative.notna()
+        & ~base_series.str.contains(UNSAFE_BASE, regex=True, na=True)
+        & ~relative.str.contains(UNSAFE_PATH, regex=True, na=True)
+    ).to_numpy()
+    slashed = base_series.where(base_series.str.endswith("/", na=True), base_series + "/")
+    urls = (slashed + relative).to_numpy(dtype=object)
+    for i in np.flatnonzero(~safe):
+        urls[i] = fallback(base_series.iat[i], paths[i])
+    return urls
+
+
+def isoformat(times: pd.DatetimeIndex) -> pd.Index:
+    """
+    `datetime.isoformat` of each timestamp: microseconds only when set, a "+HH:MM" offset.
+    """
+    seconds = pd.Index(times.strftime("%Y-%m-%dT%H:%M:%S"))
+    micros = pd.Index(times.microsecond)
+    fractions = ("." + micros.astype(str).str.zfill(6)).where(micros != 0, "")
+    offsets = pd.Index(times.strftime("%z"))
+    return seconds + fractions + offsets.str[:3] + ":" + offsets.str[3:]
+
+
+# `Turn` fields decoded with `as_floats`.
+FLOAT_FIELDS = ("asr_latency", "slu_latency", "call_duration")
+
+
+def as_floats(values: Sequence[Any]) -> Any:
+    """
+    `float_maybestr` of each value, None for falsy values.
+
+    A batch without any value keeps None like a DataFrame of turn dicts does, see `concat_frames`.
+    """
+    series = pd.Series(values, dtype=object)
+    present = series.astype(bool)
+    if not present.any():
+        return [None] * len(series)
+    return pd.to_numeric(series.where(present))
+
+
+class BatchColumns:
+    """
+    The `Turn` fields of a fetched batch as columns, built on access.
+
+    Fields without a `field_<name>` method are the record column of the same name.
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        rows: List[tuple],
+        domain_url: str,
+        use_fsm_url: bool = False,
+        timezone: str = const.DEFAULT_TIMEZONE,
+    ):
+        self.raw = dict(zip(names, map(list, zip(*rows))))
+        self.domain_url = domain_url
+        self.use_fsm_url = use_fsm_url
+        self.timezone = timezone
+
+    def column(self, name: str) -> Any:
+        build = getattr(self, f"field_{name}", None)
+        return self.raw[name] if build is None else build()
+
+    def frame(self, columns: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+        return pd.DataFrame({name: self.column(name) for name in (columns or Turn.__slots__)})
+
+    @cached_property
+    def reftimes(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(pd.to_datetime(self.raw["reftime"], utc=True)).tz_convert(self.timezone)
+
+    @cached_property
+    def utterances(self) -> List[Any]:
+        return [jsonify_utterances(value) for value in self.raw["utterances"]]
+
+    @cached_property
+    def contexts(self) -> List[Any]:
+        return [jsonify_maybestr(value) for value in self.raw["context"]]
+
+    @cached_property
+    def intents(self) -> List[Tuple[Any, Any, Any]]:
+        return [prediction2intent(prediction or {}) for prediction in self.raw["prediction"]]
+
+    def field_call_id(self) -> pd.Series:
+        return pd.Series(self.raw["call_id"], dtype=object).astype(str)
+
+    def field_template_id(self) -> pd.Series:
+        return pd.Series(self.raw["template_id"], dtype=object).astype(str)
+
+    def field_conversation_id(self) -> List[int]:
+        return [int(value) for value in self.raw["conversation_id"]]
+
+    def field_audio_url(self) -> Any:
+        bases, paths = self.raw["turn_audio_base_path"], self.raw["turn_audio_path"]
+        if self.use_fsm_url:
+            return [
+                get_url(base, path, call_uuid, self.domain_url, True)
+                for base, path, call_uuid in zip(bases, paths, self.raw["call_uuid"])
+            ]
+        return join_urls(bases, paths, lambda base, path: get_url(base, path, "", self.domain_url))
+
+    def field_call_url(self) -> pd.Series:
+        base = os.getenv(const.CDN_RECORDINGS_BASE_PATH)
+        ids = pd.Series(self.raw["call_url_id"], dtype=object)
+        joined = pd.Series(join_urls([base] * len(ids), ids.tolist(), lambda base, path: get_call_url(base, path, "")))
+        derived = (joined + const.WAV_FILE).where(ids.astype(bool), None)
+        urls = pd.Series(self.raw["call_url"], dtype=object)
+        return urls.where(urls.astype(bool), derived)
+
+    def field_reftime(self) -> pd.Index:
+        return isoformat(self.reftimes)
+
+    def field_readable_reftime(self) -> pd.Index:
+        times = self.reftimes
+        if str(times.tz) == str(pytz.UTC):
+            times = times.tz_convert(const.DEFAULT_TIMEZONE)
+        return times.strftime("%d-%b-%Y %I:%M %p")
+
+    def field_utterances(self) -> List[Any]:
+        return [serialize(utterances) for utterances in self.utterances]
+
+    def field_primary_utterance(self) -> List[Any]:
+        return [utterances[0][0][const.TRANSCRIPT] if utterances else None for utterances in self.utterances]
+
+    def field_format_utterances(self) -> List[Any]:
+        return [
+            "\n".join(alternative[const.TRANSCRIPT] for alternative in utterances[0]) if utterances else None
+            for utterances in self.utterances
+        ]
+
+    def field_context(self) -> List[Any]:
+        return [serialize(context) for context in self.contexts]
+
+    def field_bot_response(self) -> List[Any]:
+        return [
+            serialize(context.get(const.BOT_RESPONSE)) if raw else None
+            for raw, context in zip(self.raw["context"], self.contexts)
+        ]
+
+    def field_intents_info(self) -> List[Any]:
+        return [serialize(jsonify_maybestr(value)) for value in self.raw["intents_info"]]
+
+    def field_prediction(self) -> List[Any]:
+        return [serialize(jsonify_maybestr(value)) for value in self.raw["prediction"]]
+
+    def field_intent(self) -> List[Any]:
+        return [name for name, _, _ in self.intents]
+
+    def field_intent_score(self) -> List[Any]:
+        return [score for _, score, _ in self.intents]
+
+    def field_slots(self) -> List[Any]:
+        return [serialize(slots) for _, _, slots in self.intents]
+
+    def field_entities(self) -> List[Any]:
+        return [serialize(slots2entities(slots)) for _, _, slots in self.intents]
+
+    def field_asr_latency(self) -> Any:
+        return as_floats(self.raw["asr_latency"])
+
+    def field_slu_latency(self) -> Any:
+        return as_floats(self.raw["slu_latency"])
+
+    def field_call_duration(self) -> Any:
+        return as_floats(self.raw["call_duration"])
+
+
+def decode_frame(
+    batch: Tuple[Tuple[str, ...], List[tuple]],
+    domain_url: str = const.DEFAULT_AUDIO_URL_DOMAIN,
+    use_fsm_url: bool = False,
+    timezone: str = const.DEFAULT_TIMEZONE,
+    columns: Optional[Tuple[str, ...]] = None,
+) -> pd.DataFrame:
+    """
+    Decode the rows of a fetched batch into a DataFrame of turns, with only `columns` if given.
+    """
+    names, rows = batch
+    if not rows:
+        return pd.DataFrame()
+    return BatchColumns(names, rows, domain_url, use_fsm_url, timezone).frame(columns)
+
+
+def concat_frames(frames: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    One DataFrame of decoded batches, typed like a DataFrame of the same turn dicts.
+
+    Float fields are float64 with NaN once any batch has a value, batches without any
+    would otherwise leave an object column holding None.
+    """
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    for column in FLOAT_FIELDS:
+        if column in df and df[column].dtype == object and df[column].notna().any():
+            df[column] = pd.to_numeric(df[column])
+    return df
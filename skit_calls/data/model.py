@@ -6,7 +6,8 @@ import pandas as pd
 
 from collections import namedtuple
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, Optional
+from functools import lru_cache
+from typing import Any, Callable, ClassVar, Dict, Iterable, List, Tuple, Optional, Union, cast
 from urllib.parse import unquote, urljoin
 import boto3
 from botocore.exceptions import ClientError
@@ -155,7 +156,38 @@ def get_url(
     return audio_url
 
 
-def get_readable_reftime(reftime: str) -> str:
+class RawJSON(str):
+    """
+    JSON text read from the database that is written out verbatim.
+    """
+
+
+# Characters that end a line for `str.splitlines` and JSON lines readers built on it.
+LINE_BREAKS = ("\r", "\n", "\u2028", "\u2029")
+
+
+def breaks_lines(text: str) -> bool:
+    return any(line_break in text for line_break in LINE_BREAKS)
+
+
+def dump_json_value(value: Any) -> str:
+    """
+    `json.dumps` without ASCII escapes, except for U+2028 and U+2029 which would split the line.
+    """
+    return json.dumps(value, ensure_ascii=False).replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+
+
+def dump_json_line(row: Thing) -> str:
+    """
+    Encode a turn as a single JSON object, embedding RawJSON values as-is.
+    """
+    return "{" + ", ".join(
+        f"{json.dumps(key)}: " + (value if isinstance(value, RawJSON) else dump_json_value(value))
+        for key, value in row.items()
+    ) + "}"
+
+
+def get_readable_reftime(reftime: Union[str, datetime]) -> str:
 
     timestamp_with_tz = pd.to_datetime(reftime)
 
@@ -165,6 +197,101 @@ def get_readable_reftime(reftime: str) -> str:
 
     return timestamp_with_tz.strftime("%d-%b-%Y %I:%M %p")
 
+
+def derive_columns(
+    row: Dict[str, str],
+    domain_url: str,
+    use_fsm_url: bool = False,
+    timezone: str = const.DEFAULT_TIMEZONE,
+) -> Thing:
+    """
+    Compute `DERIVED_COLUMNS` for a row of raw query text as produced by COPY.
+
+    Values match those of `Turn.from_record` for the same row.
+    """
+    intent_name, intent_score, _ = prediction2intent(jsonify_maybestr(row["prediction"]) or {})
+    reftime = pd.Timestamp(row["reftime"]).tz_convert(timezone)
+    return {
+        "audio_url": get_url(
+            row["turn_audio_base_path"], row["turn_audio_path"], row["call_uuid"], domain_url, use_fsm_url
+        ),
+        "call_url": row["call_url"] or get_call_url(
+            os.getenv(const.CDN_RECORDINGS_BASE_PATH), row["call_url_id"], const.WAV_FILE
+        ),
+        "readable_reftime": get_readable_reftime(reftime),
+        "intent": intent_name,
+        "intent_score": intent_score,
+        "primary_utterance": extract_primary_utterance(row["utterances"]),
+        "format_utterances": format_utterances(row["utterances"]),
+        "bot_response": extract_bot_response(row["context"]),
+    }
+
+
+def reftime_in(record: Any, timezone: str) -> datetime:
+    return record.reftime.astimezone(pytz.timezone(timezone))
+
+
+def intent_of(record: Any) -> Tuple[IntentName, IntentScore, Slots]:
+    return prediction2intent(record.prediction or {})
+
+
+# Values `Turn.from_record` passes to fields that aren't a record column of the same name,
+# as functions of (record, domain_url, use_fsm_url, timezone). Field converters still apply.
+FIELD_VALUES: Dict[str, Callable[[Any, str, bool, str], Any]] = {
+    "audio_url": lambda record, domain_url, use_fsm_url, timezone: get_url(
+        record.turn_audio_base_path, record.turn_audio_path, record.call_uuid, domain_url, use_fsm_url
+    ),
+    "call_url": lambda record, *_: record.call_url or get_call_url(
+        os.getenv(const.CDN_RECORDINGS_BASE_PATH), record.call_url_id, const.WAV_FILE
+    ),
+    "reftime": lambda record, _, __, timezone: reftime_in(record, timezone),
+    "readable_reftime": lambda record, _, __, timezone: get_readable_reftime(reftime_in(record, timezone)),
+    "primary_utterance": lambda record, *_: record.utterances,
+    "format_utterances": lambda record, *_: record.utterances,
+    "bot_response": lambda record, *_: record.context,
+    "intent": lambda record, *_: intent_of(record)[0],
+    "intent_score": lambda record, *_: intent_of(record)[1],
+    "slots": lambda record, *_: intent_of(record)[2],
+    "entities": lambda record, *_: slots2entities(intent_of(record)[2]),
+}
+# Record columns read by each entry of FIELD_VALUES.
+FIELD_INPUTS: Dict[str, Tuple[str, ...]] = {
+    "audio_url": ("turn_audio_base_path", "turn_audio_path", "call_uuid"),
+    "call_url": ("call_url", "call_url_id"),
+    "reftime": ("reftime",),
+    "readable_reftime": ("reftime",),
+    "primary_utterance": ("utterances",),
+    "format_utterances": ("utterances",),
+    "bot_response": ("context",),
+    "intent": ("prediction",),
+    "intent_score": ("prediction",),
+    "slots": ("prediction",),
+    "entities": ("prediction",),
+}
+
+
+def check_columns(columns: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    """
+    Validate a projection of `Turn` fields, None keeps every field.
+    """
+    if columns is None:
+        return None
+    columns = tuple(dict.fromkeys(columns))
+    unknown = [column for column in columns if column not in Turn.__slots__]
+    if unknown or not columns:
+        raise ValueError(f"Unknown columns {unknown}, expected some of {', '.join(Turn.__slots__)}.")
+    return columns
+
+
+def record_columns(columns: Iterable[str]) -> Tuple[str, ...]:
+    """
+    Record columns needed to compute the given `Turn` fields.
+    """
+    return tuple(dict.fromkeys(
+        name for column in columns for name in FIELD_INPUTS.get(column, (column,))
+    ))
+
+
 @attr.s(slots=True, weakref_slot=False)
 class Turn:
     call_id: str = attr.ib(kw_only=True, repr=True, converter=str)
@@ -231,8 +358,26 @@ class Turn:
         kw_only=True, default=None, converter=float_maybestr, repr=False
     )
 
+    # Generated once the class exists, see `make_row_serializer`.
+    to_row: ClassVar[Callable[["Turn"], Tuple[Any, ...]]]
+
     @classmethod
-    def from_record(cls, record: namedtuple, domain_url: str, use_fsm_url: bool = False, timezone: str = const.DEFAULT_TIMEZONE) -> "Turn":
+    def from_record(
+        cls,
+        record: namedtuple,
+        domain_url: str,
+        use_fsm_url: bool = False,
+        timezone: str = const.DEFAULT_TIMEZONE,
+        columns: Optional[Tuple[str, ...]] = None,
+    ) -> "Turn":
+        """
+        Build a turn from a query record.
+
+        With `columns`, only those fields are computed and the record only needs their
+        `record_columns`, other fields are None.
+        """
+        if columns is not None:
+            return cls.from_record_columns(record, domain_url, use_fsm_url, timezone, columns)
         intent_name, intent_score, slots = prediction2intent(record.prediction or {})
         entities = slots2entities(slots)
         call_url = record.call_url or get_call_url(
@@ -283,6 +428,23 @@ class Turn:
             client_uuid=record.client_uuid,
         )
 
+    @classmethod
+    def from_record_columns(
+        cls, record: Any, domain_url: str, use_fsm_url: bool, timezone: str, columns: Tuple[str, ...]
+    ) -> "Turn":
+        fields = attr.fields_dict(cls)
+        turn = object.__new__(cls)
+        for name in cls.__slots__:
+            object.__setattr__(turn, name, None)
+        for name in columns:
+            get_value = FIELD_VALUES.get(name)
+            value = getattr(record, name) if get_value is None else get_value(
+                record, domain_url, use_fsm_url, timezone
+            )
+            converter = fields[name].converter
+            object.__setattr__(turn, name, value if converter is None else cast(Callable, converter)(value))
+        return turn
+
     def serialize(self, _, __, value):
         return (
             json.dumps(value, ensure_ascii=False)
@@ -290,5 +452,55 @@ class Turn:
             else value
         )
 
-    def to_dict(self) -> Dict[str, Any]:
+    def to_dict(self, columns: Optional[Tuple[str, ...]] = None) -> Dict[str, Any]:
+        if columns is not None:
+            return {name: self.serialize(None, None, getattr(self, name)) for name in columns}
         return attr.asdict(self, value_serializer=self.serialize)
+
+    def to_json_dict(self, record: Any, columns: Optional[Tuple[str, ...]] = None) -> Dict[str, Any]:
+        """
+        Turn values with nested fields left as python objects, for a single JSON encode.
+
+        Fields in `RAW_JSON_FIELDS` keep the JSON text of the record when the db sends text,
+        text with a line break (see `LINE_BREAKS`) is decoded instead so that each turn stays on one line.
+        """
+        if columns is None:
+            row = attr.asdict(self, recurse=False)
+        else:
+            row = {name: getattr(self, name) for name in columns}
+        for field in const.RAW_JSON_FIELDS:
+            if field not in row:
+                continue
+            raw = getattr(record, field)
+            if isinstance(raw, str) and raw and not breaks_lines(raw):
+                row[field] = RawJSON(raw)
+        return row
+
+
+def make_row_serializer(cls, columns: Optional[Tuple[str, ...]] = None) -> Callable[[Any], Tuple[Any, ...]]:
+    """
+    Generate a function returning the field values of an attrs instance as a tuple in slot order,
+    or in the order of `columns`.
+
+    Values are serialized like `Turn.serialize` does for `to_dict`, the generated code reads each
+    slot directly instead of walking the fields and calling a hook per value.
+    """
+    values = "".join(
+        f"        dumps(value, ensure_ascii=False) if isinstance(value := self.{name}, nested) else value,\n"
+        for name in (columns or cls.__slots__)
+    )
+    source = f"def to_row(self):\n    return (\n{values}    )\n"
+    namespace: Dict[str, Any] = {"dumps": json.dumps, "nested": (dict, list)}
+    exec(compile(source, f"<{cls.__name__}.to_row>", "exec"), namespace)
+    return namespace["to_row"]
+
+
+Turn.to_row = make_row_serializer(Turn)
+
+
+@lru_cache(maxsize=None)
+def row_serializer(columns: Optional[Tuple[str, ...]] = None) -> Callable[[Turn], Tuple[Any, ...]]:
+    """
+    `Turn.to_row`, or a serializer of only `columns`.
+    """
+    return Turn.to_row if columns is None else make_row_serializer(Turn, columns)
@@ -1,30 +1,332 @@
+import hashlib
+import io
+import json
+import math
+import multiprocessing
 import os
+import re
+import threading
 import time
+from collections import deque, namedtuple
+from functools import lru_cache, partial
+from itertools import islice
+from multiprocessing.pool import AsyncResult
+from numbers import Integral
 from pprint import pformat
-from typing import Any, Dict, Iterable, Set, Tuple, Optional, List
+from typing import Any, Callable, Deque, Dict, Iterable, Sequence, Set, Tuple, TypeVar, Optional, List
 
 from loguru import logger
 from psycopg2.extensions import connection as Conn
-from psycopg2.extras import NamedTupleCursor
 from tqdm import tqdm
-from psycopg2.errors import SerializationFailure, OperationalError
+from psycopg2.errors import ProgramLimitExceeded, SerializationFailure, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, QueryCanceledError
+from psycopg2 import DataError, Error, ProgrammingError
 
 from skit_calls import constants as const
-from skit_calls.data.db import connect, postgres
-from skit_calls.data.model import Turn
+from skit_calls.data.db import connect, pooled, postgres
+from skit_calls.data.frames import decode_frame
+from skit_calls.data.model import Turn, check_columns, record_columns, row_serializer
+from skit_calls.utils import QueueStats, prefetch
 
+RawBatch = Tuple[Tuple[str, ...], List[tuple]]
+T = TypeVar("T")
 
-def as_turns(records, domain_url, use_fsm_url, timezone) -> Iterable[Dict[str, Any]]:
+def as_turns(
+    records, domain_url, use_fsm_url, timezone, output_format=const.CSV, columns=None
+) -> Iterable[Any]:
+    to_row = row_serializer(columns)
     for record in records:
-        yield Turn.from_record(record, domain_url, use_fsm_url, timezone).to_dict()
+        turn = Turn.from_record(record, domain_url, use_fsm_url, timezone, columns)
+        if output_format == const.JSONL:
+            yield turn.to_json_dict(record, columns)
+        elif output_format == const.CSV_ROWS:
+            yield to_row(turn)
+        else:
+            yield turn.to_dict(columns)
 
 
+@lru_cache(maxsize=None)
 def get_query(query_name):
-    with open(os.getenv(query_name)) as handle:
+    path = os.getenv(query_name)
+    if not path:
+        raise ValueError(f"{query_name} isn't set, it should be the path of a .sql file (see secrets/env.sh).")
+    with open(path) as handle:
         return handle.read()
 
 
-def gen_random_call_ids(
+PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+IN_PLACEHOLDER = re.compile(r"\b(NOT\s+)?IN\s+%\((\w+)\)s", re.IGNORECASE)
+_unpreparable: Set[str] = set()
+
+
+def as_prepared_statement(query: str, params: Dict[str, Any]) -> Optional[Tuple[str, str, List[str]]]:
+    """
+    Rewrite a query with named placeholders for PREPARE.
+
+    Tuples bound with `IN %(name)s` are rewritten to `= ANY($n)` (`<> ALL($n)` for `NOT IN`) and
+    bound as arrays. Returns the statement name, its text and the parameter names by position,
+    or None if a tuple is used any other way.
+
+    :param query: A query with psycopg2 named placeholders.
+    :param params: Values that would be bound to the query.
+    """
+    if "%s" in query:
+        return None
+    names: List[str] = []
+
+    def position(name: str) -> str:
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    def as_array(match: re.Match) -> str:
+        operator = "<> ALL" if match.group(1) else "= ANY"
+        return f"{operator}({position(match.group(2))})"
+
+    text = IN_PLACEHOLDER.sub(as_array, query)
+    if any(isinstance(params.get(name), tuple) for name in PLACEHOLDER.findall(text)):
+        return None
+    text = PLACEHOLDER.sub(lambda match: position(match.group(1)), text).replace("%%", "%")
+    name = "skit_calls_" + hashlib.md5(text.encode()).hexdigest()[:16]
+    return name, text, names
+
+
+def choose_id_binding(size: int) -> str:
+    if size < const.ID_SET_ARRAY_THRESHOLD:
+        return const.BIND_TUPLE
+    if size < const.ID_SET_TEMP_TABLE_THRESHOLD:
+        return const.BIND_ARRAY
+    return const.BIND_TEMP_TABLE
+
+
+def needs_writable(ids: Sequence[Any]) -> bool:
+    """
+    Whether binding `ids` creates a temp table, which only the primary allows.
+    """
+    return choose_id_binding(len(ids)) == const.BIND_TEMP_TABLE
+
+
+def as_array_literal(ids: Iterable[Any]) -> str:
+    return "{" + ",".join(
+        str(id_) if isinstance(id_, Integral) else '"' + str(id_).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for id_ in ids
+    ) + "}"
+
+
+def as_copy_text(id_: Any) -> str:
+    return str(id_).replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+
+
+def bind_id_set(
+    cursor,
+    query: str,
+    params: Dict[str, Any],
+    name: str,
+    strategy: Optional[str] = None,
+    id_type: Optional[str] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Choose how the id set in `params[name]`, used as `IN %(name)s`, is sent to the db.
+
+    - tuple: psycopg2 expands the ids inline, fine for a handful of ids.
+    - array: the ids are one array literal compared with `= ANY(...)`.
+    - temp_table: the ids are copied into a session temp table that the query selects from,
+      the query text doesn't grow with the number of ids.
+
+    The strategy is picked by set size unless given. Queries that don't use `IN %(name)s`
+    are left as they are. Empty sets are bound as an untyped empty array, `IN ()` isn't valid SQL.
+
+    Arrays and temp tables need the SQL type of the ids: bigint for integers, `id_type` otherwise.
+    Other sets stay inline, where postgres coerces the literals to the column's type.
+
+    :return: The query and params to execute.
+    """
+    ids = params[name]
+    matches = [match for match in IN_PLACEHOLDER.finditer(query) if match.group(2) == name]
+    if id_type is None and len(ids) and isinstance(next(iter(ids)), Integral):
+        id_type = "bigint"
+    if not len(ids):
+        strategy = const.BIND_ARRAY
+    elif id_type is None:
+        strategy = const.BIND_TUPLE
+    else:
+        strategy = strategy or choose_id_binding(len(ids))
+    if strategy == const.BIND_TUPLE or not matches:
+        return query, params
+
+    def rewrite(replacement):
+        return IN_PLACEHOLDER.sub(
+            lambda match: replacement(match) if match.group(2) == name else match.group(0), query
+        )
+
+    if strategy == const.BIND_ARRAY:
+        array = f"CAST(%({name})s AS {id_type}[])" if id_type else f"%({name})s"
+        bound_query = rewrite(lambda match: f"{'<> ALL' if match.group(1) else '= ANY'}({array})")
+        return bound_query, {**params, name: as_array_literal(ids)}
+
+    table = f"skit_calls_{name}"
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {table} (id {id_type} PRIMARY KEY) ON COMMIT DELETE ROWS"
+    )
+    cursor.execute(f"TRUNCATE {table}")
+    cursor.copy_expert(f"COPY {table} (id) FROM STDIN", io.StringIO("\n".join(map(as_copy_text, set(ids)))))
+    cursor.execute(f"ANALYZE {table}")
+    bound_query = rewrite(lambda match: f"{match.group(1) or ''}IN (SELECT id FROM {table})")
+    return bound_query, {key: value for key, value in params.items() if key != name}
+
+
+def execute_prepared(cursor, query: str, params: Dict[str, Any]) -> None:
+    """
+    Execute a query as a server-side prepared statement, parsed and planned once per connection.
+
+    Falls back to a plain execute on connections that don't track prepared statements and for
+    queries that postgres can't prepare, e.g. a parameter whose type can't be inferred.
+    """
+    prepared = getattr(cursor.connection, "prepared", None)
+    statement = None if prepared is None or query in _unpreparable else as_prepared_statement(query, params)
+    if prepared is None or statement is None:
+        cursor.execute(query, params)
+        return
+
+    name, text, names = statement
+    values = [list(params[key]) if isinstance(params[key], tuple) else params[key] for key in names]
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f"EXECUTE {name}"
+    if name in prepared:
+        cursor.execute(execute, values)
+        return
+
+    # The first run is guarded by a savepoint so that a failure keeps the rest of the
+    # transaction, e.g. ids staged by `bind_id_set`.
+    cursor.execute("SAVEPOINT skit_calls_prepare")
+    try:
+        cursor.execute(f"PREPARE {name} AS {text}")
+    except (ProgrammingError, DataError) as e:
+        logger.warning(f"Query can't be prepared, falling back to plain statements: {e}")
+        cursor.execute("ROLLBACK TO SAVEPOINT skit_calls_prepare")
+        _unpreparable.add(query)
+        cursor.execute(query, params)
+        return
+    # PREPARE isn't transactional, the statement outlives a rollback of what follows.
+    prepared.add(name)
+    try:
+        cursor.execute(execute, values)
+    except Error:
+        # Errors of the batch itself, e.g. poison calls, are for the caller to handle.
+        cursor.execute("ROLLBACK TO SAVEPOINT skit_calls_prepare")
+        raise
+
+
+# `error` is the class name of the exception a failed query raised, None if it succeeded.
+QueryStats = namedtuple("QueryStats", ["name", "param_sizes", "seconds", "rows", "error"], defaults=(None,))
+
+
+def log_query(stats: QueryStats) -> None:
+    if stats.error is not None:
+        logger.debug(f"{stats.name}: {stats.error} after {stats.seconds:.3f}s, id set sizes {stats.param_sizes}")
+        return
+    logger.debug(f"{stats.name}: {stats.rows} rows in {stats.seconds:.3f}s, id set sizes {stats.param_sizes}")
+
+
+# Called with the `QueryStats` of every query run by `execute_logged`, append to collect them.
+query_hooks: List[Callable[[QueryStats], None]] = [log_query]
+_slow_query_lock = threading.Lock()
+
+
+def param_sizes(params: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    The number of values bound to each collection parameter.
+    """
+    return {
+        key: len(value)
+        for key, value in (params or {}).items()
+        if isinstance(value, (tuple, list, set, frozenset))
+    }
+
+
+def explain_slow_query(
+    cursor, stats: QueryStats, query: str, params: Optional[Dict[str, Any]], analyze: bool = False
+) -> None:
+    """
+    Append the `EXPLAIN` of a query that was just run to `SLOW_QUERY_LOG`, `EXPLAIN (ANALYZE, BUFFERS)`
+    with `analyze`, which runs the query again.
+
+    The plan is taken on a second cursor in the same transaction, so temp tables staged for
+    the query are still there, and within a savepoint, so a failed EXPLAIN (e.g. hitting the
+    statement timeout again) doesn't abort the transaction the query's rows belong to.
+    A failed query aborted its transaction unless it ran in a savepoint of its own: that
+    transaction can only be rolled back, so it is rolled back first, along with staged temp tables.
+    """
+    connection = cursor.connection
+    if connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+        connection.rollback()
+    explain = "EXPLAIN (ANALYZE, BUFFERS)" if analyze else "EXPLAIN"
+    with connection.cursor() as explain_cursor:
+        explain_cursor.execute("SAVEPOINT skit_calls_explain")
+        try:
+            explain_cursor.execute(f"{explain} {query}", params)
+            plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+            explain_cursor.execute("RELEASE SAVEPOINT skit_calls_explain")
+        except Error as e:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT skit_calls_explain")
+            plan = f"EXPLAIN failed: {e}"
+    entry = {**stats._asdict(), "at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "query": query, "plan": plan}
+    with _slow_query_lock, open(const.SLOW_QUERY_LOG, "a", encoding="utf-8") as handle:
+        handle.write(json.dumps(entry, default=str) + "\n")
+    failed = "" if stats.error is None else f" and failed with {stats.error}"
+    logger.warning(f"{stats.name} took {stats.seconds:.1f}s{failed}, its plan is in {const.SLOW_QUERY_LOG}")
+
+
+def execute_logged(
+    cursor,
+    name: str,
+    query: str,
+    params: Optional[Dict[str, Any]] = None,
+    execute: Optional[Callable[..., None]] = None,
+    sizes: Optional[Dict[str, int]] = None,
+) -> None:
+    """
+    Run `execute(cursor, query, params)`, `cursor.execute` by default, and report its `QueryStats`
+    to `query_hooks`, failed queries too before their error propagates.
+
+    Queries slower than `SLOW_QUERY_MS` and cancelled ones (statement timeouts) are explained to
+    `SLOW_QUERY_LOG`. Plans are a plain `EXPLAIN` unless `SLOW_QUERY_ANALYZE` is set, cancelled
+    queries are never run again by `EXPLAIN ANALYZE`.
+
+    :param name: The query's name, like RANDOM_CALL_DATA_QUERY.
+    :param sizes: Id set sizes, for params whose id sets `bind_id_set` moved out of `params`.
+    """
+    error: Optional[BaseException] = None
+    start = time.perf_counter()
+    try:
+        if execute is None:
+            cursor.execute(query, params)
+        else:
+            execute(cursor, query, params)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stats = QueryStats(
+            name,
+            param_sizes(params) if sizes is None else sizes,
+            seconds,
+            -1 if error is not None else cursor.rowcount,
+            None if error is None else type(error).__name__,
+        )
+        if const.SLOW_QUERY_MS and isinstance(error, QueryCanceledError):
+            try:
+                explain_slow_query(cursor, stats, query, params)
+            except Exception as e:
+                # The query's own error is the one to raise.
+                logger.warning(f"Couldn't explain the cancelled {name}: {e}")
+        elif error is None and const.SLOW_QUERY_MS and seconds * 1000 >= const.SLOW_QUERY_MS:
+            explain_slow_query(cursor, stats, query, params, analyze=const.SLOW_QUERY_ANALYZE)
+        for hook in query_hooks:
+            hook(stats)
+
+
+def get_call_filters(
     start_date: str,
     end_date: str,
     ids_: Optional[Set[str]] = None,
@@ -38,9 +340,8 @@ def gen_random_call_ids(
     flow_id:  Optional[Set[str]] = [],
     min_duration: Optional[float] = None,
     excluded_numbers: Optional[Set[str]] = None,
-    retry_limit: int = 2,
     random_id_limit: int = const.DEFAULT_CALL_QUANTITY,
-):
+) -> Dict[str, Any]:
     excluded_numbers = set(excluded_numbers) or set()
     
     if not ids_:
@@ -65,21 +366,50 @@ def gen_random_call_ids(
         const.LIMIT: limit + const.MARGIN * limit,
         const.TEMPLATE_ID: template_id,
         const.FLOW_ID: flow_id,
-        const.RANDOM_ID_LIMT: random_id_limit
+        const.RANDOM_ID_LIMT: random_id_limit,
+        const.EXCLUDED_CALL_IDS: (),
     }
 
     logger.debug(f"call_filters={pformat(call_filters)} | {limit=}")
+    return call_filters
+
 
-    query = get_query(const.RANDOM_CALL_ID_QUERY)
+def as_setseed_arg(seed: int) -> float:
+    """
+    Map any integer seed to postgres' setseed range, [-1, 1].
+    """
+    return (seed % 2**31) / 2**30 - 1
 
+
+def fetch_call_ids(
+    query: str,
+    call_filters: Dict[str, Any],
+    retry_limit: int = 2,
+    seed: Optional[int] = None,
+    name: str = const.RANDOM_CALL_ID_QUERY,
+) -> Tuple[int, ...]:
+    """
+    Run a call id query, seeding random() for the transaction if `seed` is given.
+
+    Call ids in `call_filters[EXCLUDED_CALL_IDS]` are bound with `bind_id_set` for queries
+    that use `NOT IN %(excluded_call_ids)s`.
+    """
     tries = 0
     call_ids = ()
-    
+    excluded = call_filters.get(const.EXCLUDED_CALL_IDS, ())
+    binds_excluded = any(match.group(2) == const.EXCLUDED_CALL_IDS for match in IN_PLACEHOLDER.finditer(query))
+
     while tries <= retry_limit:
         try:
-            with connect() as conn:
+            with pooled(writable=binds_excluded and needs_writable(excluded)) as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(query, call_filters)
+                    if seed is not None:
+                        cursor.execute("SELECT setseed(%s)", (as_setseed_arg(seed),))
+                    if binds_excluded:
+                        bound_query, params = bind_id_set(cursor, query, call_filters, const.EXCLUDED_CALL_IDS)
+                    else:
+                        bound_query, params = query, call_filters
+                    execute_logged(cursor, name, bound_query, params, sizes=param_sizes(call_filters))
                     all_ids = cursor.fetchall()
                     return tuple(id_[0] for id_ in all_ids)
         except OperationalError as e:
@@ -93,60 +423,455 @@ def gen_random_call_ids(
     return call_ids
 
 
-def get_call_ids_from_uuids(uuids: Tuple[str], ids_: Optional[Set[int]]) -> Tuple[int]:
+def gen_random_call_ids(*args, retry_limit: int = 2, **kwargs) -> Tuple[int, ...]:
+    """
+    Random call ids matching the filters of `get_call_filters`, which takes the other arguments.
+    """
+    call_filters = get_call_filters(*args, **kwargs)
+    return fetch_call_ids(get_query(const.RANDOM_CALL_ID_QUERY), call_filters, retry_limit=retry_limit)
+
+
+def get_call_ids_from_uuids(uuids: Tuple[str, ...], ids_: Optional[Set[int]]) -> Tuple[int, ...]:
     query = get_query(const.CALL_IDS_FROM_UUIDS_QUERY)
     ids_ = set(ids_) or set()
-    with connect() as conn:
+    with pooled(writable=needs_writable(uuids)) as conn:
         with conn.cursor() as cursor:
-            cursor.execute(query, {const.UUID: uuids, const.ID: ids_})
+            params = {const.UUID: uuids, const.ID: ids_}
+            execute_logged(
+                cursor,
+                const.CALL_IDS_FROM_UUIDS_QUERY,
+                *bind_id_set(cursor, query, params, const.UUID, id_type=const.CALL_UUID_TYPE),
+                sizes=param_sizes(params),
+            )
             return tuple(id_[0] for id_ in cursor.fetchall())
 
 
-def gen_random_calls(
-    call_ids: Tuple[int],
-    asr_provider: Optional[str] = None,
-    intents: Optional[Set[str]] = None,
-    states: Optional[Set[str]] = None,
-    limit: int = const.TURNS_LIMIT,
-    delay: float = const.Q_DELAY,
+def gen_call_ids_from_uuids(
+    uuid_chunks: Iterable[Iterable[str]],
+    ids_: Optional[Set[int]],
+    batch_size: int = const.UUID_BATCH_SIZE,
+) -> Iterable[Tuple[int, ...]]:
+    """
+    Resolve chunks of uuids to call ids, at most `batch_size` uuids per query.
+
+    Yields the new call ids of each query, uuids and call ids seen before are skipped.
+    """
+    seen_uuids: Set[str] = set()
+    seen_call_ids: Set[int] = set()
+    for uuid_chunk in uuid_chunks:
+        uuids = [uuid for uuid in uuid_chunk if uuid not in seen_uuids]
+        seen_uuids.update(uuids)
+        for i in range(0, len(uuids), batch_size):
+            call_ids = get_call_ids_from_uuids(tuple(uuids[i : i + batch_size]), ids_)
+            call_ids = tuple(call_id for call_id in call_ids if call_id not in seen_call_ids)
+            seen_call_ids.update(call_ids)
+            yield call_ids
+
+
+_record_types: Dict[Tuple[str, ...], Any] = {}
+
+
+def record_type(columns: Tuple[str, ...]):
+    if columns not in _record_types:
+        _record_types[columns] = namedtuple("Record", columns, rename=True)
+    return _record_types[columns]
+
+
+def decode_batch(
+    batch: RawBatch,
     domain_url: str = const.DEFAULT_AUDIO_URL_DOMAIN,
     use_fsm_url: bool = False,
     timezone: str = const.DEFAULT_TIMEZONE,
-):
-    time.sleep(1)
-    query = get_query(const.RANDOM_CALL_DATA_QUERY)
-    states = tuple(set(states or [None]))
-    intents = tuple(set(intents or [None]))
+    output_format: str = const.CSV,
+    columns: Optional[Tuple[str, ...]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Decode the rows of a batch into serialized turns, with only the `columns` fields if given.
+
+    Rows are plain tuples so that batches can be shipped to worker processes. The FRAME
+    format decodes the batch into a DataFrame with `frames.decode_frame` instead.
+    """
+    if output_format == const.FRAME:
+        return decode_frame(batch, domain_url, use_fsm_url, timezone, columns)
+    names, rows = batch
+    Record = record_type(names)
+    return list(
+        as_turns(map(Record._make, rows), domain_url, use_fsm_url, timezone, output_format, columns)
+    )
+
+
+def get_turn_filters(
+    asr_provider: Optional[str] = None,
+    intents: Optional[Iterable[str]] = None,
+    states: Optional[Iterable[str]] = None,
+) -> Dict[str, Any]:
     turn_filters = {
         const.ASR_PROVIDER: asr_provider,
         const.CONVERSATION_TYPES: (const.UCASE_INPUT,),
         const.CONVERSATION_SUB_TYPES: (const.UCASE_AUDIO,),
-        const.STATES: states,
-        const.INTENTS: intents,
+        const.STATES: tuple(set(states)) if states else (None,),
+        const.INTENTS: tuple(set(intents)) if intents else (None,),
     }
     logger.debug(f"call_filters={pformat(turn_filters)}")
+    return turn_filters
 
-    call_id_size = len(call_ids)
-    batch_size = (
-        call_id_size // limit
-        if call_id_size % limit == 0
-        else call_id_size // limit + 1
-    )
-    logger.debug(f"Creating {batch_size} batches for {call_id_size} calls")
-    i = 0
+
+def batch_count(call_id_size: int, limit: int) -> int:
+    return call_id_size // limit if call_id_size % limit == 0 else call_id_size // limit + 1
+
+
+def batch_ids(call_ids: Iterable[int], limit: int) -> Tuple[Iterable[Tuple[int, ...]], Optional[int]]:
+    """
+    Split call ids into tuples of at most `limit` ids.
+
+    Sequences give the number of batches as well, other iterables are consumed lazily as ids arrive.
+    """
+    if isinstance(call_ids, Sequence):
+        call_id_size = len(call_ids)
+        logger.debug(f"Creating {batch_count(call_id_size, limit)} batches for {call_id_size} calls")
+        id_batches = (tuple(call_ids[i : i + limit]) for i in range(0, call_id_size, limit))
+        return id_batches, batch_count(call_id_size, limit)
+    call_ids = iter(call_ids)
+    return iter(lambda: tuple(islice(call_ids, limit)), ()), None
+
+
+def project_query(query: str, names: Sequence[str]) -> str:
+    """
+    Select only `names` from the rows of `query`.
+    """
+    return f"SELECT {', '.join(names)} FROM ({query.strip().rstrip(';')}) AS projected"
+
+
+POISON_ERRORS = (QueryCanceledError, DataError, ProgramLimitExceeded)
+
+
+def set_statement_timeout(cursor, timeout: int) -> None:
+    """
+    Cancel the statements of the current transaction after `timeout` ms, 0 disables the timeout.
+    """
+    if timeout:
+        cursor.execute("SET LOCAL statement_timeout = %s", (int(timeout),))
+
+
+def retry_transient(
+    fetch: Callable[[Tuple[int, ...]], T],
+    batch: Tuple[int, ...],
+    delay: float,
+    retries: int = const.TRANSIENT_RETRIES,
+) -> T:
+    """
+    Retry `fetch` when it fails with errors that don't depend on the batch, like conflicts or lost connections.
+
+    Waits `delay` seconds before the first retry and twice as long before each next one, the
+    error is raised after `retries` retries, e.g. when the db is down or credentials are wrong.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fetch(batch)
+        except POISON_ERRORS:
+            raise
+        except (SerializationFailure, OperationalError) as e:
+            if attempt >= retries:
+                logger.error(f"Giving up on a batch of {len(batch)} calls after {retries} retries.")
+                raise
+            logger.error(e)
+            logger.error(f"This error is common if you are requesting a large dataset. We will retry the batch in a while.")
+            time.sleep(delay * 2**attempt)
+            attempt += 1
+
+
+def gen_isolated(
+    batch: Tuple[int, ...], fetch: Callable[[Tuple[int, ...]], T], skipped: List[int]
+) -> Iterable[T]:
+    """
+    Fetch a batch, bisecting it when it fails with `POISON_ERRORS` until the failing call ids are isolated.
+
+    Isolated ids are added to `skipped`, every other id is delivered once, in order.
+    A result is yielded only once it was fetched completely, so failures never repeat rows.
+    """
+    pending = [tuple(batch)]
+    while pending:
+        ids = pending.pop()
+        try:
+            result = fetch(ids)
+        except POISON_ERRORS as e:
+            if len(ids) == 1:
+                logger.warning(f"Skipping call {ids[0]}, its turns couldn't be fetched: {e}")
+                skipped.append(ids[0])
+            else:
+                logger.warning(f"Splitting a batch of {len(ids)} calls to isolate a failure: {e}")
+                middle = len(ids) // 2
+                pending += [ids[middle:], ids[:middle]]
+            continue
+        yield result
+
+
+def gen_raw_batches(
+    call_ids: Iterable[int],
+    turn_filters: Dict[str, Any],
+    limit: int = const.TURNS_LIMIT,
+    delay: float = const.Q_DELAY,
+    prepare: bool = const.PREPARE_STATEMENTS,
+    timeout: int = const.STATEMENT_TIMEOUT,
+    skipped: Optional[List[int]] = None,
+    columns: Optional[Tuple[str, ...]] = None,
+) -> Iterable[RawBatch]:
+    """
+    Yield the rows of RANDOM_CALL_DATA_QUERY for batches of at most `limit` call ids.
+
+    Each batch query is cancelled after `timeout` ms. Batches that time out or hit bad data are
+    bisected, calls that fail on their own are skipped, logged and added to `skipped`.
+
+    With `columns`, only the record columns needed for those `Turn` fields are selected.
+    """
+    query = get_query(const.RANDOM_CALL_DATA_QUERY)
+    if columns is not None:
+        query = project_query(query, record_columns(columns))
+    execute = execute_prepared if prepare else None
+    id_batches, batch_size = batch_ids(call_ids, limit)
+    skipped = [] if skipped is None else skipped
+    n_skipped = len(skipped)
+
+    def fetch(batch: Tuple[int, ...]) -> RawBatch:
+        with pooled(writable=needs_writable(batch)) as conn:
+            with conn.cursor() as cursor:
+                set_statement_timeout(cursor, timeout)
+                params = {**turn_filters, const.CALL_IDS: batch}
+                execute_logged(
+                    cursor,
+                    const.RANDOM_CALL_DATA_QUERY,
+                    *bind_id_set(cursor, query, params, const.CALL_IDS),
+                    execute=execute,
+                    sizes=param_sizes(params),
+                )
+                columns = tuple(column.name for column in cursor.description)
+                return columns, cursor.fetchall()
 
     with tqdm(total=batch_size, desc="Downloading turns for calls dataset.") as pbar:
-        while i < call_id_size:
-            batch = call_ids[i : i + limit]
-            try:
-                with connect() as conn:
-                    with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
-                        cursor.execute(query, {**turn_filters, const.CALL_IDS: batch})
-                        result_set = cursor.fetchall()
-                        yield from as_turns(result_set, domain_url, use_fsm_url, timezone)
-                        pbar.update(1)
-                i += limit
-            except (SerializationFailure, OperationalError) as e:
-                logger.error(e)
-                logger.error(f"This error is common if you are requesting a large dataset. We will retry the batch in a while.")
-                time.sleep(delay)
+        for batch in id_batches:
+            yield from gen_isolated(batch, partial(retry_transient, fetch, delay=delay), skipped)
+            pbar.update(1)
+    if len(skipped) > n_skipped:
+        logger.warning(f"Skipped {len(skipped) - n_skipped} calls: {skipped[n_skipped:]}")
+
+
+def gen_topped_up_raw_batches(
+    call_ids: Sequence[int],
+    turn_filters: Dict[str, Any],
+    target: int,
+    draw_call_ids: Callable[[int, int, Set[int]], Iterable[int]],
+    rounds: int = const.TOP_UP_ROUNDS,
+    columns: Optional[Tuple[str, ...]] = None,
+    **kwargs,
+) -> Iterable[RawBatch]:
+    """
+    Yield raw batches until `target` calls had turns matching `turn_filters`.
+
+    Turn filters drop every turn of many sampled calls. The share of calls with matching turns
+    seen so far estimates how many more ids are needed, `draw_call_ids(n, round, seen)` picks
+    about n more ids and ids already seen are dropped. Fetching stops once `target` calls matched,
+    turns of calls past the target are dropped. Other `kwargs` are passed to `gen_raw_batches`.
+    """
+    matched: Set[int] = set()
+    seen = set(call_ids)
+    probed = 0
+    if columns is not None:
+        columns = ("call_id", *columns)
+
+    for round_ in range(rounds + 1):
+        if round_:
+            hit_rate = max(len(matched) / probed, const.TOP_UP_MIN_HIT_RATE) if probed else 1.0
+            needed = math.ceil((target - len(matched)) / hit_rate * (1 + const.MARGIN))
+            call_ids = [call_id for call_id in draw_call_ids(needed, round_, seen) if call_id not in seen]
+            logger.info(
+                f"{len(matched)}/{target} calls matched the turn filters, {len(matched) / probed if probed else 0:.1%} "
+                f"of {probed} sampled. Topping up with {len(call_ids)} more call ids."
+            )
+            seen.update(call_ids)
+        if not call_ids:
+            break
+        probed += len(call_ids)
+        for names, rows in gen_raw_batches(call_ids, turn_filters, columns=columns, **kwargs):
+            index = names.index("call_id")
+            kept = []
+            for row in rows:
+                if row[index] not in matched and len(matched) >= target:
+                    continue
+                matched.add(row[index])
+                kept.append(row)
+            if kept:
+                yield names, kept
+            if len(matched) >= target:
+                return
+    logger.warning(f"Only {len(matched)}/{target} calls matched the turn filters after {probed} sampled calls.")
+
+
+def gen_copied_batches(
+    call_ids: Iterable[int],
+    asr_provider: Optional[str] = None,
+    intents: Optional[Iterable[str]] = None,
+    states: Optional[Iterable[str]] = None,
+    limit: int = const.TURNS_LIMIT,
+    delay: float = const.Q_DELAY,
+    timeout: int = const.STATEMENT_TIMEOUT,
+    skipped: Optional[List[int]] = None,
+) -> Iterable[str]:
+    """
+    Yield each batch of RANDOM_CALL_DATA_QUERY as CSV text (with a header) produced by COPY.
+
+    Rows skip the cursor and python objects entirely, a batch is buffered so that a failed
+    COPY can be retried without writing partial rows. Failing batches are bisected like in
+    `gen_raw_batches`.
+    """
+    query = get_query(const.RANDOM_CALL_DATA_QUERY).strip().rstrip(";")
+    turn_filters = get_turn_filters(asr_provider, intents, states)
+    id_batches, batch_size = batch_ids(call_ids, limit)
+    skipped = [] if skipped is None else skipped
+    n_skipped = len(skipped)
+
+    def fetch(batch: Tuple[int, ...]) -> str:
+        buffer = io.StringIO()
+        with pooled(writable=needs_writable(batch)) as conn:
+            with conn.cursor() as cursor:
+                set_statement_timeout(cursor, timeout)
+                params = {**turn_filters, const.CALL_IDS: batch}
+                bound_query = cursor.mogrify(*bind_id_set(cursor, query, params, const.CALL_IDS))
+                execute_logged(
+                    cursor,
+                    const.RANDOM_CALL_DATA_QUERY,
+                    bound_query.decode(),
+                    execute=lambda cursor, query, _: cursor.copy_expert(
+                        f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", buffer
+                    ),
+                    sizes=param_sizes(params),
+                )
+        return buffer.getvalue()
+
+    with tqdm(total=batch_size, desc="Copying turns for calls dataset.") as pbar:
+        for batch in id_batches:
+            yield from gen_isolated(batch, partial(retry_transient, fetch, delay=delay), skipped)
+            pbar.update(1)
+    if len(skipped) > n_skipped:
+        logger.warning(f"Skipped {len(skipped) - n_skipped} calls: {skipped[n_skipped:]}")
+
+
+def note_call_ids(raw_batches: Iterable[RawBatch], call_ids: Set[int]) -> Iterable[RawBatch]:
+    """
+    Yield `raw_batches`, adding the call ids of their rows to `call_ids`.
+    """
+    for names, rows in raw_batches:
+        index = names.index("call_id")
+        call_ids.update(row[index] for row in rows)
+        yield names, rows
+
+
+def gen_random_call_batches(
+    call_ids: Iterable[int],
+    asr_provider: Optional[str] = None,
+    intents: Optional[Iterable[str]] = None,
+    states: Optional[Iterable[str]] = None,
+    limit: int = const.TURNS_LIMIT,
+    delay: float = const.Q_DELAY,
+    domain_url: str = const.DEFAULT_AUDIO_URL_DOMAIN,
+    use_fsm_url: bool = False,
+    timezone: str = const.DEFAULT_TIMEZONE,
+    output_format: str = const.CSV,
+    workers: int = const.DECODE_WORKERS,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    stats: Optional[Dict[str, QueueStats]] = None,
+    timeout: int = const.STATEMENT_TIMEOUT,
+    skipped: Optional[List[int]] = None,
+    columns: Optional[Tuple[str, ...]] = None,
+    target_calls: Optional[int] = None,
+    draw_call_ids: Optional[Callable[[int, int, Set[int]], Iterable[int]]] = None,
+    delivered: Optional[Set[int]] = None,
+) -> Iterable[List[Dict[str, Any]]]:
+    """
+    Yield the serialized turns of each batch of call ids.
+
+    With `workers` > 1 batches are decoded in a process pool while the next ones are fetched,
+    at most `2 * workers` batches are in flight and batches are yielded in order.
+
+    With `queue_size` > 0 fetching and decoding run on their own threads with bounded queues
+    between them, so batch N+1 is fetched while batch N is decoded and the consumer writes
+    batch N-1. Queue occupancy of the "fetch" and "decode" stages is logged at the end and
+    kept in `stats` if a dict is given.
+
+    Batch queries time out after `timeout` ms, call ids that can't be fetched are skipped
+    and added to `skipped` (see `gen_raw_batches`).
+
+    With `columns`, turns only have those `Turn` fields and only what they need is fetched and decoded.
+
+    With `target_calls` and `draw_call_ids`, more call ids are drawn until `target_calls` calls have
+    matching turns, see `gen_topped_up_raw_batches`.
+
+    With `delivered`, the call ids of every fetched turn are added to that set, so callers can
+    tell which calls made it into the output (call_id is fetched even if `columns` leaves it out).
+    """
+    time.sleep(1)
+    columns = check_columns(columns)
+    turn_filters = get_turn_filters(asr_provider, intents, states)
+    fetch_columns = columns
+    if delivered is not None and columns is not None and "call_id" not in columns:
+        fetch_columns = ("call_id", *columns)
+    fetch_kwargs: Dict[str, Any] = dict(
+        limit=limit, delay=delay, timeout=timeout, skipped=skipped, columns=fetch_columns
+    )
+    if target_calls is None or draw_call_ids is None:
+        raw_batches = gen_raw_batches(call_ids, turn_filters, **fetch_kwargs)
+    else:
+        raw_batches = gen_topped_up_raw_batches(
+            tuple(call_ids), turn_filters, target_calls, draw_call_ids, **fetch_kwargs
+        )
+    if delivered is not None:
+        raw_batches = note_call_ids(raw_batches, delivered)
+    decode = partial(
+        decode_batch,
+        domain_url=domain_url,
+        use_fsm_url=use_fsm_url,
+        timezone=timezone,
+        output_format=output_format,
+        columns=columns,
+    )
+    if queue_size <= 0:
+        yield from decode_batches(raw_batches, decode, workers)
+        return
+
+    stats = {} if stats is None else stats
+    stats.update(fetch=QueueStats("fetch"), decode=QueueStats("decode"))
+    raw_batches = prefetch(raw_batches, queue_size, stats["fetch"])
+    try:
+        yield from prefetch(decode_batches(raw_batches, decode, workers), queue_size, stats["decode"])
+    finally:
+        for stage in stats.values():
+            logger.debug(stage)
+
+
+def decode_batches(raw_batches: Iterable[RawBatch], decode, workers: int) -> Iterable[List[Dict[str, Any]]]:
+    """
+    Apply `decode` to each raw batch, in a process pool if `workers` > 1.
+
+    Workers are spawned rather than forked, this often runs on a prefetch thread of a process
+    with other threads (jobs, pools, log handlers) whose locks a fork would copy mid-use.
+    """
+    if workers <= 1:
+        yield from map(decode, raw_batches)
+        return
+
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        pending: Deque[AsyncResult] = deque()
+        for raw_batch in raw_batches:
+            pending.append(pool.apply_async(decode, (raw_batch,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def gen_random_calls(call_ids: Iterable[int], **kwargs) -> Iterable[Dict[str, Any]]:
+    """
+    Yield serialized turns for the given call ids, see `gen_random_call_batches` for options.
+    """
+    for turns in gen_random_call_batches(call_ids, **kwargs):
+        yield from turns
@@ -0,0 +1,215 @@
+"""
+Strategies to pick random call ids.
+
+- random: RANDOM_CALL_ID_QUERY orders up to `random_id_limit` candidate calls randomly.
+  Every matching call is equally likely, but the db reads and sorts the whole candidate set,
+  so the cost grows with the size of the org/date range rather than with `call_quantity`.
+  A seed is passed to `setseed`, which repeats the order as long as the candidates are
+  scanned in the same order (same data and plan, no parallel scan).
+
+- block: BLOCK_SAMPLED_CALL_ID_QUERY reads a percentage of the calls table's pages
+  (`TABLESAMPLE SYSTEM`). The percentage starts small and grows until enough calls match,
+  so the pages read scale with the quantity requested. Calls on a page were usually
+  created together, so samples are clustered in time/campaign: fine for volume estimates,
+  a poorer choice when calls should be independent.
+
+- hash: HASH_SAMPLED_CALL_ID_QUERY keeps calls whose `hashint8(id) & (HASH_BUCKETS - 1)`
+  falls in the requested buckets, which an expression index on the calls table can serve.
+  Buckets are added until enough calls match. Hashes don't depend on call attributes so
+  this is close to a simple random sample, but a seed always picks the same calls.
+
+The block and hash queries take the same filters as RANDOM_CALL_ID_QUERY, `%(seed)s`, and
+`%(sample_percent)s` or `%(hash_buckets)s` respectively. Any of them can skip
+the call ids of an exclusion index with `AND c.id NOT IN %(excluded_call_ids)s`.
+
+Without BLOCK_SAMPLED_CALL_ID_QUERY or HASH_SAMPLED_CALL_ID_QUERY set, the query is derived
+from RANDOM_CALL_ID_QUERY, see `sampled_query`. The hash strategy is only cheaper than random
+with an index on the hash, e.g. `CREATE INDEX CONCURRENTLY ON <calls table> ((hashint8(id) & 1023))`.
+"""
+import math
+import os
+import random
+import re
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from skit_calls import constants as const
+from skit_calls.data.exclusions import ExclusionIndex
+from skit_calls.data.query import fetch_call_ids, get_query
+
+
+# The first table a query reads, with its alias unless the next word is a keyword.
+FIRST_TABLE = re.compile(
+    r"\bFROM\s+(?P<table>[\w.\"]+)(?:\s+(?:AS\s+)?"
+    r"(?P<alias>(?!(?:WHERE|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|ON|GROUP|ORDER|LIMIT|UNION)\b)\w+))?",
+    re.IGNORECASE,
+)
+WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+RANDOM_ORDER = re.compile(r"\bORDER\s+BY\s+random\(\)", re.IGNORECASE)
+
+
+def sampled_query(name: str) -> str:
+    """
+    The text of BLOCK_SAMPLED_CALL_ID_QUERY or HASH_SAMPLED_CALL_ID_QUERY.
+
+    The query file at $name is used if set. Otherwise RANDOM_CALL_ID_QUERY is rewritten, assuming
+    the first table it reads is the calls table and its WHERE clause is a conjunction: block gets
+    `TABLESAMPLE SYSTEM` on that table, hash gets the bucket predicate as its first condition.
+    `ORDER BY random()` becomes an order by a hash of the call id and `%(seed)s`, so the calls
+    kept by a LIMIT don't depend on the order the db scans them in.
+    """
+    if os.getenv(name):
+        return get_query(name)
+    random_query = get_query(const.RANDOM_CALL_ID_QUERY)
+    underivable = f"{name} can't be derived from RANDOM_CALL_ID_QUERY, set {name} to a query file."
+    table = FIRST_TABLE.search(random_query)
+    if table is None:
+        raise ValueError(underivable)
+    call_id = f"{table.group('alias') or table.group('table')}.id"
+    random_query = RANDOM_ORDER.sub(f"ORDER BY md5({call_id}::text || %({const.SEED})s)", random_query)
+    if name == const.BLOCK_SAMPLED_CALL_ID_QUERY:
+        sample = f" TABLESAMPLE SYSTEM (%({const.SAMPLE_PERCENT})s) REPEATABLE (%({const.SEED})s)"
+        return random_query[: table.end()] + sample + random_query[table.end() :]
+    where = WHERE.search(random_query, table.end())
+    if where is None:
+        raise ValueError(underivable)
+    predicate = f" (hashint8({call_id}) & {const.HASH_BUCKETS - 1}) IN %({const.HASH_BUCKETS_PARAM})s AND"
+    return random_query[: where.end()] + predicate + random_query[where.end() :]
+
+
+def block_sample_call_ids(call_filters: Dict[str, Any], seed: Optional[int] = None) -> Tuple[int, ...]:
+    """
+    Sample call ids from a growing percentage of the calls table's pages.
+
+    A larger percentage with the same seed reads a superset of the pages, so only the last
+    round's ids are kept. They are sorted before sampling, the order rows come back in isn't stable.
+    """
+    rng = random.Random(seed)
+    seed = rng.randrange(2**31) if seed is None else seed
+    limit = math.ceil(call_filters[const.LIMIT])
+    query = sampled_query(const.BLOCK_SAMPLED_CALL_ID_QUERY)
+    sample_percent = const.BLOCK_SAMPLE_START_PERCENT
+
+    while True:
+        call_ids = fetch_call_ids(
+            query,
+            {**call_filters, const.SAMPLE_PERCENT: sample_percent, const.SEED: seed},
+            seed=seed,
+            name=const.BLOCK_SAMPLED_CALL_ID_QUERY,
+        )
+        logger.debug(f"{len(call_ids)} call ids in {sample_percent}% of the calls table.")
+        if len(call_ids) >= limit or sample_percent >= 100:
+            break
+        growth = limit / len(call_ids) * (1 + const.MARGIN) if call_ids else const.BLOCK_SAMPLE_GROWTH
+        sample_percent = min(100, sample_percent * max(growth, const.BLOCK_SAMPLE_GROWTH))
+    return tuple(rng.sample(sorted(call_ids), min(limit, len(call_ids))))
+
+
+def hash_sample_call_ids(call_filters: Dict[str, Any], seed: Optional[int] = None) -> Tuple[int, ...]:
+    """
+    Sample call ids from hash buckets, adding disjoint buckets until enough calls match.
+
+    The number of buckets for the next round is estimated from the calls per bucket seen so far.
+    Ids are sorted before sampling, as with `block_sample_call_ids`.
+    """
+    rng = random.Random(seed)
+    seed = rng.randrange(2**31) if seed is None else seed
+    limit = math.ceil(call_filters[const.LIMIT])
+    query = sampled_query(const.HASH_SAMPLED_CALL_ID_QUERY)
+    buckets = list(range(const.HASH_BUCKETS))
+    rng.shuffle(buckets)
+
+    call_ids: List[int] = []
+    used = 0
+    n_buckets = const.HASH_START_BUCKETS
+    while len(call_ids) < limit and used < const.HASH_BUCKETS:
+        round_buckets = tuple(buckets[used : used + n_buckets])
+        used += len(round_buckets)
+        call_ids.extend(
+            fetch_call_ids(
+                query,
+                {**call_filters, const.HASH_BUCKETS_PARAM: round_buckets, const.SEED: seed},
+                seed=seed,
+                name=const.HASH_SAMPLED_CALL_ID_QUERY,
+            )
+        )
+        logger.debug(f"{len(call_ids)} call ids in {used}/{const.HASH_BUCKETS} hash buckets.")
+        if call_ids:
+            calls_per_bucket = len(call_ids) / used
+            n_buckets = math.ceil((limit - len(call_ids)) / calls_per_bucket * (1 + const.MARGIN))
+        else:
+            n_buckets = used * 2
+        n_buckets = max(1, min(n_buckets, const.HASH_BUCKETS - used))
+    return tuple(rng.sample(sorted(call_ids), min(limit, len(call_ids))))
+
+
+SAMPLERS = {
+    const.BLOCK_SAMPLING: block_sample_call_ids,
+    const.HASH_SAMPLING: hash_sample_call_ids,
+}
+
+
+def draw_call_ids(strategy: str, call_filters: Dict[str, Any], seed: Optional[int] = None) -> Tuple[int, ...]:
+    if strategy == const.RANDOM_SAMPLING:
+        return fetch_call_ids(get_query(const.RANDOM_CALL_ID_QUERY), call_filters, seed=seed)
+    if strategy not in SAMPLERS:
+        raise ValueError(f"Unknown sampling strategy {strategy}, expected one of {const.SAMPLING_STRATEGIES}.")
+    return SAMPLERS[strategy](call_filters, seed=seed)
+
+
+def sample_call_ids(
+    strategy: str,
+    call_filters: Dict[str, Any],
+    seed: Optional[int] = None,
+    exclusions: Optional[ExclusionIndex] = None,
+) -> Tuple[int, ...]:
+    """
+    Sample call ids matching `call_filters` with one of the strategies in `SAMPLING_STRATEGIES`.
+
+    Call ids in `exclusions` are passed to the queries as `%(excluded_call_ids)s` and dropped
+    from what they return. Queries that don't filter them out get a larger limit, for up to
+    `EXCLUSION_ROUNDS` more draws, when excluded ids leave too few calls.
+    """
+    if exclusions is None or not len(exclusions):
+        return draw_call_ids(strategy, call_filters, seed=seed)
+
+    call_filters = {**call_filters, const.EXCLUDED_CALL_IDS: exclusions.as_tuple()}
+    wanted = math.ceil(call_filters[const.LIMIT])
+    for round_ in range(const.EXCLUSION_ROUNDS + 1):
+        drawn = draw_call_ids(strategy, call_filters, seed=seed)
+        call_ids = exclusions.filter(drawn)
+        if len(drawn) > len(call_ids):
+            logger.debug(f"Dropped {len(drawn) - len(call_ids)} excluded call ids of {len(drawn)}.")
+        limit = call_filters[const.LIMIT]
+        if len(call_ids) >= wanted or len(drawn) < math.ceil(limit) or round_ == const.EXCLUSION_ROUNDS:
+            break
+        growth = wanted / len(call_ids) * (1 + const.MARGIN) if call_ids else const.BLOCK_SAMPLE_GROWTH
+        call_filters = {**call_filters, const.LIMIT: limit * growth}
+        if const.RANDOM_ID_LIMT in call_filters:
+            call_filters[const.RANDOM_ID_LIMT] = math.ceil(call_filters[const.RANDOM_ID_LIMT] * growth)
+    return tuple(call_ids[:wanted])
+
+
+def in_partition(call_id: int, partition: Tuple[int, int]) -> bool:
+    index, count = partition
+    return zlib.crc32(str(call_id).encode("ascii")) % count == index
+
+
+def partition_call_ids(call_ids: Iterable[int], partition: Optional[Tuple[int, int]]) -> Iterable[int]:
+    """
+    Keep the call ids of partition `(i, N)`, i in [0, N), assigned by a stable hash of the id.
+
+    Every process sees the same assignment, so N processes that pick the same call ids and keep
+    one partition each produce the same dataset as a single process, without coordinating.
+    Sequences are returned as tuples, other iterables are filtered lazily.
+    """
+    if partition is None:
+        return call_ids
+    index, count = partition
+    if not 0 <= index < count:
+        raise ValueError(f"Partition {index}/{count} should be in 0/{count} to {count - 1}/{count}.")
+    if isinstance(call_ids, Sequence):
+        return tuple(id_ for id_ in call_ids if in_partition(id_, partition))
+    return (id_ for id_ in call_ids if in_partition(id_, partition))
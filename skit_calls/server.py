@@ -0,0 +1,242 @@
+"""
+Serve sample and select jobs over HTTP from one long-running process.
+
+`skit-calls serve` keeps what every CLI run would set up again warm between jobs: db
+connection pools, query texts and the S3 presigner. Jobs are POSTed as JSON with the keyword
+arguments of `calls.sample` or `calls.select`:
+
+- POST /sample, POST /select: turns are streamed back as JSON lines while they are fetched.
+  With `"output": "<path or s3://bucket/prefix>"` the job writes its file (or shard directory)
+  there instead and responds with `{"path": ...}` when done.
+- GET /health: jobs running and the limit.
+
+Only the parameters in `JOB_PARAMS` (and `OUTPUT_PARAMS` for jobs with an `output`) are accepted.
+Local paths in `output`, `csv_file` and `exclusion_index` must be inside the server's `root`, which is
+unset by default: jobs can then only use s3:// urls. The server has no authentication, keep it on
+localhost or behind a proxy that has.
+
+Jobs run on a thread pool of `max_jobs` threads. A job arriving while `max_jobs` are running
+is answered with 429 and a Retry-After header right away, rather than queued behind them.
+A job can hold `DB_CONNECTIONS_PER_JOB` db connections at once, so `max_jobs` times that has to
+fit in `DB_POOL_SIZE`, the server refuses to start otherwise.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, FrozenSet, Generator, Iterator, List, Optional
+
+import psycopg2 as pg
+from aiohttp import web
+from botocore.exceptions import BotoCoreError
+from loguru import logger
+
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import db, model, query
+from skit_calls.data.model import dump_json_line
+from skit_calls.upload import is_s3_url
+
+QUERY_NAMES = (
+    const.RANDOM_CALL_ID_QUERY,
+    const.RANDOM_CALL_DATA_QUERY,
+    const.CALL_IDS_FROM_UUIDS_QUERY,
+    const.BLOCK_SAMPLED_CALL_ID_QUERY,
+    const.HASH_SAMPLED_CALL_ID_QUERY,
+)
+
+# Parameters of `calls.iter_sample`/`calls.iter_select` a job may set, others are rejected.
+JOB_PARAMS: Dict[str, FrozenSet[str]] = {
+    "sample": frozenset({
+        "start_date", "end_date", "lang", "domain_url", "org_ids", "call_quantity", "call_type", "use_fsm_url",
+        "ignore_callers", "reported", "template_id", "use_case", "flow_name", "min_duration", "asr_provider",
+        "states", "intents", "batch_turns", "timezone", "flow_ids", "sampling_strategy", "seed", "partition",
+        "columns", "top_up", "exclusion_index",
+    }),
+    "select": frozenset({"call_ids", "org_ids", "csv_file", "uuid_col", "stream", "partition", "columns"}),
+}
+# Parameters of `calls.sample`/`calls.select` that only jobs writing to an `output` may set.
+OUTPUT_PARAMS: Dict[str, FrozenSet[str]] = {
+    "sample": frozenset({"output", "output_format", "bulk", "shard_size", "num_shards"}),
+    "select": frozenset({"output", "output_format", "bulk", "shard_size", "num_shards", "call_history"}),
+}
+# Parameters naming files, and those of them that may be s3:// urls instead.
+PATH_PARAMS = ("output", "csv_file", "exclusion_index")
+S3_PATH_PARAMS = ("output", "csv_file")
+
+
+def check_path(name: str, path: Any, root: Optional[str]) -> str:
+    """
+    `path` resolved inside `root`, or an s3:// url where `name` takes one.
+    """
+    if not isinstance(path, str):
+        raise ValueError(f"Invalid {name} {path!r}, expected a path.")
+    if name in S3_PATH_PARAMS and is_s3_url(path):
+        return path
+    if root is None:
+        raise ValueError(f"Invalid {name} {path}, the server has no root for local files.")
+    base = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(base, path))
+    if os.path.commonpath([base, resolved]) != base:
+        raise ValueError(f"Invalid {name} {path}, local paths must be inside {root}.")
+    return resolved
+
+
+def check_params(kind: str, params: Dict[str, Any], root: Optional[str] = None) -> Dict[str, Any]:
+    """
+    The parameters of a `kind` job if it may set all of them, with local paths resolved inside `root`.
+    """
+    allowed = (JOB_PARAMS[kind] | OUTPUT_PARAMS[kind]) if "output" in params else JOB_PARAMS[kind]
+    unknown = sorted(set(params) - allowed)
+    if unknown:
+        raise ValueError(f"Unknown {kind} parameters {unknown}, expected some of {sorted(allowed)}.")
+    return {
+        name: check_path(name, value, root) if name in PATH_PARAMS and value is not None else value
+        for name, value in params.items()
+    }
+
+
+def warm_up() -> None:
+    """
+    Read the configured queries, open a connection per db host and load the presigner's credentials.
+    """
+    for name in QUERY_NAMES:
+        if os.getenv(name):
+            query.get_query(name)
+    for endpoint in db.get_endpoints().endpoints:
+        try:
+            endpoint.get_pool()
+        except pg.OperationalError as e:
+            logger.warning(f"Couldn't connect to {endpoint}: {e}")
+    try:
+        model.S3_CLIENT.generate_presigned_url("get_object", Params={"Bucket": "warm-up", "Key": "warm-up"}, ExpiresIn=1)
+    except BotoCoreError as e:
+        logger.warning(f"Couldn't load S3 credentials for presigned urls: {e}")
+
+
+class JobRunner:
+    """
+    Runs blocking jobs on a thread pool, admitting at most `max_jobs` at a time.
+    """
+
+    def __init__(self, max_jobs: int = const.SERVE_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self.active = 0
+        self.executor = ThreadPoolExecutor(max_jobs, thread_name_prefix="skit-calls-job")
+
+    def admit(self) -> bool:
+        if self.active >= self.max_jobs:
+            return False
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+
+    async def run(self, function: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def take(turns: Iterator[Dict[str, Any]], n: int = const.SERVE_CHUNK_TURNS) -> List[Dict[str, Any]]:
+    return list(islice(turns, n))
+
+
+def close_quietly(turns: Generator[Dict[str, Any], None, None]) -> None:
+    try:
+        turns.close()
+    except Exception as e:
+        logger.warning(f"Couldn't stop a job cleanly: {e!r}")
+
+
+def error(status: int, message: str, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    return web.json_response({"error": message}, status=status, headers=headers)
+
+
+async def run_job(request: web.Request) -> web.StreamResponse:
+    kind = request.match_info["kind"]
+    runner: JobRunner = request.app["runner"]
+    try:
+        params = await request.json()
+    except ValueError:
+        params = None
+    if not isinstance(params, dict):
+        return error(400, "Expected a JSON object of job parameters.")
+    try:
+        params = check_params(kind, params, request.app["root"])
+    except ValueError as e:
+        logger.warning(f"Rejected {kind} job: {e}")
+        return error(400, str(e))
+    if not runner.admit():
+        return error(429, f"{runner.max_jobs} jobs are running, retry later.", {"Retry-After": "5"})
+
+    turns = response = None
+    try:
+        output = params.pop("output", None)
+        if output is not None:
+            path = await runner.run(calls.write_result, kind, params, output)
+            return web.json_response({"path": path})
+
+        turns = getattr(calls, f"iter_{kind}")(**params)
+        # The first chunk is fetched before responding, so bad parameters still get an error status.
+        chunk = await runner.run(take, turns)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        while chunk:
+            await response.write("".join(f"{dump_json_line(turn)}\n" for turn in chunk).encode("utf-8"))
+            chunk = await runner.run(take, turns)
+        await response.write_eof()
+        return response
+    except Exception as e:
+        if response is not None:
+            # Turns were sent already, failing the request cuts the stream short for the client.
+            logger.exception(f"{kind} job failed while streaming")
+            raise
+        if isinstance(e, (TypeError, ValueError)):
+            logger.warning(f"Rejected {kind} job: {e}")
+            return error(400, str(e))
+        logger.exception(f"{kind} job failed")
+        return error(500, repr(e))
+    finally:
+        if turns is not None:
+            await runner.run(close_quietly, turns)
+        runner.release()
+
+
+async def health(request: web.Request) -> web.Response:
+    runner: JobRunner = request.app["runner"]
+    return web.json_response({"active": runner.active, "max_jobs": runner.max_jobs})
+
+
+def build_app(
+    max_jobs: int = const.SERVE_MAX_JOBS, warm: bool = True, root: Optional[str] = const.SERVE_ROOT
+) -> web.Application:
+    db.check_pool_size(max_jobs, "max_jobs")
+    app = web.Application()
+    app["runner"] = JobRunner(max_jobs)
+    app["root"] = root
+    app.router.add_get("/health", health)
+    app.router.add_post("/{kind:sample|select}", run_job)
+
+    async def start(app: web.Application) -> None:
+        if warm:
+            await app["runner"].run(warm_up)
+
+    async def stop(app: web.Application) -> None:
+        app["runner"].close()
+        db.close_pools()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+def serve(
+    host: str = const.SERVE_HOST,
+    port: int = const.SERVE_PORT,
+    max_jobs: int = const.SERVE_MAX_JOBS,
+    root: Optional[str] = const.SERVE_ROOT,
+) -> None:
+    web.run_app(build_app(max_jobs, root=root), host=host, port=port)
@@ -0,0 +1,168 @@
+"""
+Write turns to a directory of shard files that never split a call.
+
+Shards are written as `part-00000.csv.part` and renamed to `part-00000.csv` once full, then
+listed in `manifest.json`. The manifest is rewritten atomically after every shard and marked
+`"complete": true` after the last one, so consumers can poll it and start on early shards
+while later ones are still downloading.
+"""
+import csv
+import io
+import json
+import math
+import os
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+
+from loguru import logger
+
+from skit_calls import constants as const
+from skit_calls.data.model import Turn, dump_json_line
+from skit_calls.utils import parse_size
+
+Turns = List[Dict[str, Any]]
+
+
+def parse_shard_size(shard_size: Union[int, str, None]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Rows and bytes per shard: plain numbers are rows, sizes with a unit like "64MB" are bytes.
+    """
+    if shard_size is None:
+        return None, None
+    if isinstance(shard_size, int) or re.fullmatch(r"\s*\d+\s*", shard_size):
+        return int(shard_size), None
+    return None, parse_size(shard_size)
+
+
+def group_calls(batches: Iterable[Turns]) -> Iterator[Turns]:
+    """
+    Yield the turns of each call in a stream of turn batches.
+
+    A call's turns are always fetched in the same batch, but not necessarily next to each other.
+    """
+    for turns in batches:
+        calls: Dict[str, Turns] = {}
+        for turn in turns:
+            calls.setdefault(turn["call_id"], []).append(turn)
+        yield from calls.values()
+
+
+def render(
+    turns: Turns, output_format: str, header: bool = False, columns: Optional[Tuple[str, ...]] = None
+) -> str:
+    buffer = io.StringIO()
+    if output_format == const.JSONL:
+        for turn in turns:
+            buffer.write(dump_json_line(turn))
+            buffer.write("\n")
+    else:
+        writer = csv.DictWriter(buffer, fieldnames=columns or Turn.__slots__)
+        if header:
+            writer.writeheader()
+        writer.writerows(turns)
+    return buffer.getvalue()
+
+
+class ShardWriter:
+    """
+    Write calls to numbered shards, starting a new shard before a call that would exceed a limit.
+
+    A call larger than the limits gets a shard of its own.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        output_format: str = const.CSV,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_calls: Optional[int] = None,
+        columns: Optional[Tuple[str, ...]] = None,
+    ):
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_calls = max_calls
+        self.columns = columns
+        self.suffix = const.JSONL_FILE if output_format == const.JSONL else const.CSV_FILE
+        self.manifest: Dict[str, Any] = {"format": output_format, "complete": False, "shards": []}
+        self.handle: Optional[TextIO] = None
+        os.makedirs(output_dir, exist_ok=True)
+        self.write_manifest()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.output_dir, f"part-{len(self.manifest['shards']):05d}{self.suffix}")
+
+    def is_full(self, rows: int, size: int) -> bool:
+        return (
+            (self.max_rows is not None and self.rows + rows > self.max_rows)
+            or (self.max_bytes is not None and self.bytes + size > self.max_bytes)
+            or (self.max_calls is not None and self.calls + 1 > self.max_calls)
+        )
+
+    def write_call(self, turns: Turns) -> None:
+        text = render(turns, self.output_format, header=self.handle is None, columns=self.columns)
+        size = len(text.encode("utf-8"))
+        if self.handle is not None and self.is_full(len(turns), size):
+            self.finalize()
+            text = render(turns, self.output_format, header=True, columns=self.columns)
+            size = len(text.encode("utf-8"))
+        if self.handle is None:
+            self.handle = open(f"{self.path}.part", "w", encoding="utf-8")
+            self.rows = self.bytes = self.calls = 0
+        self.handle.write(text)
+        self.rows += len(turns)
+        self.bytes += size
+        self.calls += 1
+
+    def finalize(self) -> None:
+        if self.handle is None:
+            return
+        self.handle.close()
+        self.handle = None
+        os.replace(f"{self.path}.part", self.path)
+        shard = {"path": os.path.basename(self.path), "calls": self.calls, "rows": self.rows, "bytes": self.bytes}
+        self.manifest["shards"].append(shard)
+        self.write_manifest()
+        logger.debug(f"Finalised shard {shard}")
+
+    def close(self) -> None:
+        self.finalize()
+        self.manifest["complete"] = True
+        self.write_manifest()
+
+    def write_manifest(self) -> None:
+        path = os.path.join(self.output_dir, const.SHARD_MANIFEST)
+        with open(f"{path}.part", "w", encoding="utf-8") as handle:
+            json.dump(self.manifest, handle, indent=2)
+        os.replace(f"{path}.part", path)
+
+
+def save_turns_in_shards(
+    batches: Iterable[Turns],
+    output_dir: str,
+    output_format: str = const.CSV,
+    shard_size: Union[int, str, None] = None,
+    num_shards: Optional[int] = None,
+    n_calls: Optional[int] = None,
+    columns: Optional[Tuple[str, ...]] = None,
+) -> str:
+    """
+    Write turn batches from `query.gen_random_call_batches` to shards in `output_dir`.
+
+    `num_shards` needs the number of calls, `n_calls`, to size shards evenly. csv shards
+    have the `columns` of projected turns, every `Turn` field otherwise.
+    """
+    max_rows, max_bytes = parse_shard_size(shard_size)
+    max_calls = None
+    if num_shards:
+        if n_calls is None:
+            raise ValueError("num_shards needs a known number of calls, use shard_size instead.")
+        max_calls = max(1, math.ceil(n_calls / num_shards))
+    writer = ShardWriter(output_dir, output_format, max_rows, max_bytes, max_calls, columns)
+    for turns in group_calls(batches):
+        writer.write_call(turns)
+    writer.close()
+    return output_dir
@@ -0,0 +1,215 @@
+"""
+Stream output files to S3 while they are written.
+
+`open_s3_output` gives a text handle for the csv and jsonl writers. Every `part_size` bytes
+written are uploaded as a part of a multipart upload on a background event loop, so parts go
+out while later batches are still being fetched and the file never touches the local disk.
+The upload is completed when the handle is closed and aborted if writing fails. Outputs
+smaller than a part are uploaded with a single `put_object`.
+
+The aiobotocore client is created for `endpoint_url`, $S3_ENDPOINT_URL or AWS, point it at a
+stand-in such as minio or localstack for testing.
+"""
+import asyncio
+import io
+import os
+import re
+import threading
+import uuid
+from collections import deque
+from concurrent import futures
+from contextlib import AsyncExitStack, contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional, TextIO, Tuple
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from loguru import logger
+
+from skit_calls import constants as const
+
+S3_OUTPUT_URL = re.compile(r"s3://([^/]+)/?(.*)")
+
+
+def is_s3_url(url: Optional[str]) -> bool:
+    return isinstance(url, str) and url.startswith("s3://")
+
+
+def parse_output_url(url: str) -> Tuple[str, str]:
+    """
+    Bucket and key prefix of an s3://bucket/prefix output.
+    """
+    if not (match := S3_OUTPUT_URL.fullmatch(url)):
+        raise ValueError(f"Invalid output {url}, expected s3://bucket/prefix.")
+    return match.group(1), match.group(2)
+
+
+def output_key(url: str, suffix: str) -> Tuple[str, str]:
+    """
+    Bucket and object key of an output: the url itself if it ends with `suffix`, a new
+    object under the url's prefix otherwise.
+    """
+    bucket, key = parse_output_url(url)
+    if not key.endswith(suffix):
+        key = f"{key.rstrip('/')}/{uuid.uuid4().hex}{suffix}".lstrip("/")
+    return bucket, key
+
+
+class MultipartUpload(io.RawIOBase):
+    """
+    A writable binary stream that uploads to `bucket/key` in parts of `part_size` bytes.
+
+    Up to `concurrency` parts are uploaded at a time, writes block when all of them are busy.
+    `s3_client` replaces the aiobotocore client, it must provide the async multipart methods
+    and `put_object`.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        part_size: int = const.S3_PART_SIZE,
+        concurrency: int = const.S3_UPLOAD_CONCURRENCY,
+        endpoint_url: Optional[str] = None,
+        s3_client=None,
+    ):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.buffer = bytearray()
+        self.upload_id: Optional[str] = None
+        self.parts: Dict[int, str] = {}
+        self.part_count = 0
+        self.pending: Deque[Any] = deque()
+        self.aborted = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="s3-upload", daemon=True)
+        self.thread.start()
+        self.clients = AsyncExitStack()
+        try:
+            self.client = s3_client or self.run(self.create_client(endpoint_url))
+        except BaseException:
+            self.shutdown()
+            raise
+
+    async def create_client(self, endpoint_url: Optional[str]):
+        config = AioConfig(max_pool_connections=self.concurrency)
+        endpoint_url = endpoint_url or os.getenv(const.S3_ENDPOINT_URL)
+        return await self.clients.enter_async_context(
+            get_session().create_client("s3", endpoint_url=endpoint_url, config=config)
+        )
+
+    def run(self, coroutine) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.aborted:
+            # The text handle flushes what it buffered when it is closed after a failure.
+            return len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    async def upload_part(self, number: int, data: bytes) -> None:
+        response = await self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
+        )
+        self.parts[number] = response["ETag"]
+
+    def submit(self, data: bytes) -> None:
+        if self.upload_id is None:
+            response = self.run(self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key))
+            self.upload_id = response["UploadId"]
+        while len(self.pending) >= self.concurrency:
+            self.pending.popleft().result()
+        self.part_count += 1
+        self.pending.append(asyncio.run_coroutine_threadsafe(self.upload_part(self.part_count, data), self.loop))
+        logger.debug(f"Uploading part {self.part_count} of s3://{self.bucket}/{self.key}")
+
+    def complete(self) -> None:
+        if self.upload_id is None:
+            self.run(self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)))
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.pending.popleft().result()
+        parts = [{"ETag": etag, "PartNumber": number} for number, etag in sorted(self.parts.items())]
+        self.run(
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts}
+            )
+        )
+        logger.info(f"Uploaded {len(parts)} parts to s3://{self.bucket}/{self.key}")
+
+    def abort(self) -> None:
+        """
+        Drop the parts uploaded so far, closing the stream afterwards doesn't complete the upload.
+        """
+        if self.aborted or self.closed:
+            return
+        self.aborted = True
+        # Parts still in flight would be stored after the abort, S3 asks to abort once they're done.
+        futures.wait(self.pending)
+        if self.upload_id is not None:
+            try:
+                self.run(
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+                )
+            except Exception as e:
+                logger.warning(f"Couldn't abort the upload to s3://{self.bucket}/{self.key}: {e!r}")
+
+    def shutdown(self) -> None:
+        try:
+            self.run(self.clients.aclose())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if not self.aborted:
+                try:
+                    self.complete()
+                except BaseException:
+                    self.abort()
+                    raise
+        finally:
+            self.shutdown()
+            super().close()
+
+
+@contextmanager
+def open_s3_output(
+    url: str,
+    suffix: str,
+    part_size: int = const.S3_PART_SIZE,
+    concurrency: int = const.S3_UPLOAD_CONCURRENCY,
+    endpoint_url: Optional[str] = None,
+    s3_client=None,
+) -> Iterator[Tuple[TextIO, str]]:
+    """
+    A text handle that streams to S3 and the s3:// url of the object, see `output_key`.
+
+    The upload is completed when the block exits and aborted if it raises.
+    """
+    bucket, key = output_key(url, suffix)
+    upload = MultipartUpload(bucket, key, part_size, concurrency, endpoint_url, s3_client)
+    handle = io.TextIOWrapper(io.BufferedWriter(upload), encoding="utf-8")
+    try:
+        yield handle, f"s3://{bucket}/{key}"
+    except BaseException:
+        upload.abort()
+        handle.close()
+        raise
+    handle.close()
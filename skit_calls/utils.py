@@ -2,12 +2,18 @@
 Module provides access to logger config, session token and package version.
 """
 import os
+import queue
+import re
 import sys
-from typing import Optional, Tuple
+import threading
+import time
+from typing import Iterable, Iterator, Optional, Tuple, TypeVar, Union
 
 import toml
 from loguru import logger
 
+T = TypeVar("T")
+
 LOG_LEVELS = ["CRITICAL", "ERROR", "WARNING", "SUCCESS", "INFO", "DEBUG", "TRACE"]
 
 
@@ -97,4 +103,102 @@ def process_ids_to_int(str_values):
     if str_values and isinstance(str_values[0], str):
         str_list = str_values[0].strip("[]").split(',')
         int_list = [int(value) for value in str_list]
-    return int_list
\ No newline at end of file
+    return int_list
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """
+    Bytes in a size like "512", "64MB" or "1.5GB" (binary units).
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?B?)\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {size}, expected a number of bytes like 512, 64MB or 1.5GB.")
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper().rstrip("B")])
+
+
+class QueueStats:
+    """
+    Occupancy of a `prefetch` queue, for tuning pipeline stages.
+
+    A queue that is mostly full with a long `put_wait` means the consumer is the bottleneck,
+    a mostly empty one with a long `get_wait` means the producer is.
+    """
+
+    def __init__(self, name: str, maxsize: int = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.items = 0
+        self.occupancy = 0
+        self.max_occupancy = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    @property
+    def mean_occupancy(self) -> float:
+        return self.occupancy / self.items if self.items else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.items} items, occupancy mean {self.mean_occupancy:.2f}"
+            f" max {self.max_occupancy}/{self.maxsize}, producer blocked {self.put_wait:.2f}s,"
+            f" consumer waited {self.get_wait:.2f}s"
+        )
+
+
+def prefetch(iterable: Iterable[T], maxsize: int = 1, stats: Optional[QueueStats] = None) -> Iterator[T]:
+    """
+    Iterate over `iterable` on a background thread, keeping up to `maxsize` items ready.
+
+    Errors raised by the iterable are raised to the consumer. The thread stops once the
+    consumer stops iterating. Queue occupancy is recorded in `stats` if given.
+    """
+    items: queue.Queue = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+    stats = stats or QueueStats("prefetch")
+    stats.maxsize = maxsize
+
+    def put(item) -> bool:
+        start = time.monotonic()
+        try:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.put_wait += time.monotonic() - start
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            occupancy = items.qsize()
+            start = time.monotonic()
+            item, error = items.get()
+            stats.get_wait += time.monotonic() - start
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            stats.items += 1
+            stats.occupancy += occupancy
+            stats.max_occupancy = max(stats.max_occupancy, occupancy)
+            yield item
+    finally:
+        stop.set()
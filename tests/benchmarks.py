@@ -1,10 +1,14 @@
 import imp
+import os
 import time
+from unittest.mock import patch
 
 import pydash as py_
 from loguru import logger
 
+from skit_calls import constants as const
 from skit_calls.data import query
+from tests.conftest import fake_raw_batches
 
 
 def fetch_ids(n, start="2021-01-01", end="2021-12-31", org_id=2):
@@ -31,3 +35,162 @@ def fetch_data(n, start="2021-01-01", end="2021-12-31", org_id=2):
     df = py_.flattern(df)
     logger.debug(f"Ran in est {time.time() - s:.2f}s. | Fetched {len(df)} turns.")
     return df
+
+
+def bench_decode_workers(n_batches=48, batch_rows=1000, workers=(0, 2, 4, 8, 16)):
+    """
+    Turns decoded per second by `gen_random_calls` for a range of decode workers.
+
+    The db is replaced by in-memory batches so only decoding is measured.
+    """
+    os.environ.setdefault(const.CDN_RECORDINGS_BASE_PATH, "https://cdn.example.com/calls")
+    batches = fake_raw_batches(n_batches, batch_rows=batch_rows)
+    results = {}
+    with patch.object(query, "gen_raw_batches", lambda *args, **kwargs: iter(batches)), patch.object(
+        query.time, "sleep"
+    ):
+        for n_workers in workers:
+            s = time.time()
+            n_turns = sum(1 for _ in query.gen_random_calls((), workers=n_workers))
+            elapsed = time.time() - s
+            results[n_workers] = n_turns / elapsed
+            logger.debug(f"{n_workers=} | {n_turns} turns in {elapsed:.2f}s | {results[n_workers]:.0f} turns/s.")
+    return results
+
+
+def bench_prepared_batches(call_ids, limit=100, prepare=(False, True)):
+    """
+    Seconds per RANDOM_CALL_DATA_QUERY batch with and without server-side prepared statements.
+
+    Needs the db env vars, each setting runs over the same call ids on a fresh pool.
+    """
+    from skit_calls.data import db
+
+    turn_filters = query.get_turn_filters()
+    results = {}
+    for use_prepared in prepare:
+        db.close_pools()
+        s = time.time()
+        n_batches = sum(
+            1 for _ in query.gen_raw_batches(tuple(call_ids), turn_filters, limit=limit, prepare=use_prepared)
+        )
+        results[use_prepared] = (time.time() - s) / max(n_batches, 1)
+        logger.debug(f"prepare={use_prepared} | {n_batches} batches | {results[use_prepared] * 1000:.1f}ms per batch.")
+    return results
+
+
+BINDING_QUERY = "SELECT count(*) FROM generate_series(1, %(n)s) AS t(id) WHERE t.id IN %(call_ids)s"
+
+
+def bench_id_binding(sizes=(1000, 10000, 100000), with_db=False):
+    """
+    Cost of binding an id set with each strategy of `query.bind_id_set`.
+
+    Without a db only the size of the query text and the time to format it are measured,
+    `with_db` also runs BINDING_QUERY (needs the db env vars).
+    """
+    from psycopg2.extensions import adapt
+
+    from skit_calls.data.db import pooled
+
+    results = {}
+    for size in sizes:
+        call_ids = tuple(range(size))
+        for strategy in (const.BIND_TUPLE, const.BIND_ARRAY, const.BIND_TEMP_TABLE):
+            if strategy == const.BIND_TEMP_TABLE and not with_db:
+                continue
+            s = time.time()
+            if with_db:
+                with pooled() as conn:
+                    with conn.cursor() as cursor:
+                        bound = query.bind_id_set(
+                            cursor, BINDING_QUERY, {"n": size, const.CALL_IDS: call_ids}, const.CALL_IDS, strategy
+                        )
+                        sql = cursor.mogrify(*bound)
+                        cursor.execute(sql)
+                        cursor.fetchall()
+            else:
+                bound_query, params = query.bind_id_set(
+                    None, BINDING_QUERY, {"n": size, const.CALL_IDS: call_ids}, const.CALL_IDS, strategy
+                )
+                sql = bound_query % {key: adapt(value).getquoted().decode() for key, value in params.items()}
+            elapsed = time.time() - s
+            results[(size, strategy)] = (elapsed, len(sql))
+            logger.debug(f"{size=} | {strategy=} | {len(sql) / 1024:.0f}KiB of sql | {elapsed * 1000:.1f}ms.")
+    return results
+
+
+def bench_sampling(call_filters, quantities=(200, 2000, 20000), strategies=const.SAMPLING_STRATEGIES, seed=0):
+    """
+    Seconds to pick call ids with each sampling strategy, for increasing quantities.
+
+    `call_filters` come from `query.get_call_filters`, the db env vars and every strategy's
+    query file are needed.
+    """
+    from skit_calls.data import sampling
+
+    results = {}
+    for quantity in quantities:
+        filters = {
+            **call_filters,
+            const.LIMIT: quantity + const.MARGIN * quantity,
+            const.RANDOM_ID_LIMT: min(30 * quantity, 75000),
+        }
+        for strategy in strategies:
+            s = time.time()
+            call_ids = sampling.sample_call_ids(strategy, filters, seed=seed)
+            results[(quantity, strategy)] = time.time() - s
+            logger.debug(
+                f"{quantity=} | {strategy=} | {len(call_ids)} ids in {results[(quantity, strategy)]:.2f}s."
+            )
+    return results
+
+
+def bench_row_serializer(n_turns=20000):
+    """
+    Turns written per second as dicts through `csv.DictWriter` and as rows through `csv.writer`.
+
+    Both outputs are checked to be identical.
+    """
+    import io
+
+    from skit_calls import calls
+    from skit_calls.data.model import Turn
+    from tests.conftest import make_record
+
+    os.environ.setdefault(const.CDN_RECORDINGS_BASE_PATH, "https://cdn.example.com/calls")
+    turns = [Turn.from_record(make_record(i), const.DEFAULT_AUDIO_URL_DOMAIN) for i in range(n_turns)]
+    paths = {
+        "dict": (lambda turn: turn.to_dict(), calls.write_csv),
+        "row": (lambda turn: turn.to_row(), calls.write_csv_rows),
+    }
+    results, outputs = {}, {}
+    for name, (serialize, write) in paths.items():
+        handle = io.StringIO()
+        s = time.time()
+        write(map(serialize, turns), handle)
+        elapsed = time.time() - s
+        results[name] = n_turns / elapsed
+        outputs[name] = handle.getvalue()
+        logger.debug(f"{name=} | {n_turns} turns in {elapsed:.2f}s | {results[name]:.0f} turns/s.")
+    assert outputs["dict"] == outputs["row"]
+    return results
+
+
+def bench_frame_decoder(n_batches=20, batch_rows=1000):
+    """
+    Seconds to build the in-memory DataFrame from turn dicts vs `frames.decode_frame`.
+    """
+    from skit_calls import calls
+    from skit_calls.data import frames
+
+    os.environ.setdefault(const.CDN_RECORDINGS_BASE_PATH, "https://cdn.example.com/calls")
+    batches = fake_raw_batches(n_batches, batch_rows=batch_rows)
+    s = time.time()
+    calls.save_turns_in_memory(turn for batch in batches for turn in query.decode_batch(batch))
+    results = {"dicts": time.time() - s}
+    s = time.time()
+    frames.concat_frames(frames.decode_frame(batch) for batch in batches)
+    results["frames"] = time.time() - s
+    logger.debug(f"{n_batches * batch_rows} turns | dicts {results['dicts']:.2f}s | frames {results['frames']:.2f}s.")
+    return results
@@ -0,0 +1,115 @@
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+RECORD_COLUMNS = (
+    "call_id",
+    "call_uuid",
+    "conversation_id",
+    "conversation_uuid",
+    "call_url",
+    "call_url_id",
+    "turn_audio_base_path",
+    "turn_audio_path",
+    "call_type",
+    "disposition",
+    "previous_disposition",
+    "blocking_disposition",
+    "reftime",
+    "state",
+    "prediction",
+    "utterances",
+    "context",
+    "call_end_status",
+    "intents_info",
+    "language",
+    "asr_latency",
+    "slu_latency",
+    "asr_provider",
+    "virtual_number",
+    "flow_version",
+    "flow_id",
+    "flow_name",
+    "flow_uuid",
+    "template_id",
+    "call_duration",
+    "client_uuid",
+)
+Record = namedtuple("Record", RECORD_COLUMNS)
+
+
+def make_record(i: int = 0, **overrides) -> Record:
+    """
+    A row shaped like the result of RANDOM_CALL_DATA_QUERY.
+    """
+    call_id = 1000 + i // 4
+    values = {
+        "call_id": call_id,
+        "call_uuid": f"call-{call_id}",
+        "conversation_id": 50000 + i,
+        "conversation_uuid": f"conv-{i}",
+        "call_url": None,
+        "call_url_id": f"recordings/{call_id}",
+        "turn_audio_base_path": "https://s3.ap-south-1.amazonaws.com/bucket-name/",
+        "turn_audio_path": f"turns/{call_id}/{i}%20a.wav",
+        "call_type": "INBOUND",
+        "disposition": None,
+        "previous_disposition": None,
+        "blocking_disposition": None,
+        "reftime": datetime(2022, 12, 1, 10, 37, 43, 39748, tzinfo=pytz.UTC)
+        + timedelta(seconds=i),
+        "state": "COF",
+        "prediction": {
+            "intents": [
+                {
+                    "name": "_confirm_",
+                    "score": 0.91 + i % 5 / 100,
+                    "slots": [{"name": "date", "values": [{"value": i, "type": "date"}]}],
+                }
+            ]
+        },
+        "utterances": json.dumps(
+            [[{"transcript": f"हाँ जी {i}", "confidence": 0.9}, {"transcript": "haan", "confidence": 0.1}]],
+            ensure_ascii=False,
+        ),
+        "context": json.dumps({"bot_response": f"नमस्ते {i}", "ack": True}, ensure_ascii=False),
+        "call_end_status": "COMPLETED",
+        "intents_info": json.dumps([{"name": "_confirm_", "score": 0.9}]),
+        "language": "hi",
+        "asr_latency": "0.25",
+        "slu_latency": None,
+        "asr_provider": "google",
+        "virtual_number": "0801234567",
+        "flow_version": "3",
+        "flow_id": "12",
+        "flow_name": "collections",
+        "flow_uuid": "flow-uuid",
+        "template_id": 7,
+        "call_duration": "43.5",
+        "client_uuid": "client-uuid",
+    }
+    values.update(overrides)
+    return Record(**values)
+
+
+def fake_raw_batches(n_batches, batch_rows=10):
+    """
+    Batches as yielded by `query.gen_raw_batches`.
+    """
+    return [
+        (RECORD_COLUMNS, [tuple(make_record(b * batch_rows + i)) for i in range(batch_rows)])
+        for b in range(n_batches)
+    ]
+
+
+@pytest.fixture
+def records():
+    return [make_record(i) for i in range(12)]
+
+
+@pytest.fixture(autouse=True)
+def recordings_base_path(monkeypatch):
+    monkeypatch.setenv("CDN_RECORDINGS_BASE_PATH", "https://cdn.example.com/calls")
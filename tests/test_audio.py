@@ -0,0 +1,135 @@
+import asyncio
+import io
+import json
+import time
+from collections import Counter
+
+import pytest
+from aiohttp import web
+
+from skit_calls import audio
+from skit_calls import constants as const
+
+RECORDING = b"RIFF" + bytes(range(256)) * 600
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self, size):
+        return self.stream.read(size)
+
+
+class FakeS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+
+    async def get_object(self, Bucket, Key):
+        return {"Body": FakeBody(self.objects[(Bucket, Key)])}
+
+
+async def serve_and_download(urls_for, tmp_path, **kwargs):
+    hits = Counter()
+
+    async def recording(request):
+        name = request.match_info["name"]
+        hits[name] += 1
+        if name == "missing":
+            raise web.HTTPNotFound()
+        if name == "flaky" and hits[name] < 3:
+            raise web.HTTPServiceUnavailable()
+        return web.Response(body=RECORDING)
+
+    app = web.Application()
+    app.router.add_get("/recordings/{name}", recording)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        urls = urls_for(f"http://127.0.0.1:{port}/recordings")
+        report = await audio.adownload_audio(urls, str(tmp_path), **kwargs)
+    finally:
+        await runner.cleanup()
+    return report, hits
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(const, "AUDIO_RETRY_BACKOFF", 0)
+
+
+def test_download_audio_retries_and_reports_failures(tmp_path):
+    def urls_for(base):
+        return [f"{base}/{name}" for name in ("a.wav", "b.wav", "flaky", "missing")]
+
+    report, hits = asyncio.run(
+        serve_and_download(urls_for, tmp_path, concurrency=2, s3_client=FakeS3Client({}))
+    )
+    assert report.downloaded == 3
+    assert len(report.failed) == 1
+    assert next(iter(report.failed)).endswith("/missing")
+    assert hits["flaky"] == 3 and hits["missing"] == 1
+    saved = [p for p in tmp_path.rglob("*") if p.is_file()]
+    assert sorted(p.name for p in saved) == ["a.wav", "b.wav", "flaky"]
+    assert all(p.read_bytes() == RECORDING for p in saved)
+
+
+def test_download_audio_skips_existing_files(tmp_path):
+    urls_for = lambda base: [f"{base}/a.wav"]
+    asyncio.run(serve_and_download(urls_for, tmp_path, s3_client=FakeS3Client({})))
+    report, hits = asyncio.run(serve_and_download(urls_for, tmp_path, s3_client=FakeS3Client({})))
+    assert report.skipped == 1 and report.downloaded == 0
+    assert hits["a.wav"] == 0
+
+
+def test_download_audio_from_s3(tmp_path):
+    client = FakeS3Client({("bucket", "calls/1.wav"): RECORDING})
+    report = asyncio.run(audio.adownload_audio(["s3://bucket/calls/1.wav"], str(tmp_path), s3_client=client))
+    assert report.downloaded == 1
+    assert (tmp_path / "bucket" / "calls" / "1.wav").read_bytes() == RECORDING
+
+
+def test_audio_path():
+    assert audio.audio_path("s3://bucket/a/b.wav", "/out") == "/out/bucket/a/b.wav"
+    url = "https://bucket.s3.ap-south-1.amazonaws.com/a/b%20c.wav?X-Amz-Signature=x"
+    assert audio.audio_path(url, "/out") == "/out/bucket/a/b c.wav"
+    assert audio.audio_path("https://cdn.example.com/x/y.wav", "/out") == "/out/cdn.example.com/x/y.wav"
+    with pytest.raises(ValueError):
+        audio.audio_path("https://cdn.example.com/../../etc/passwd", "/out")
+
+
+def test_read_audio_urls_dedupes_csv_and_jsonl(tmp_path):
+    rows = [
+        {"call_uuid": "u1", "audio_url": "https://h/1.wav", "call_url": "https://h/c1.wav"},
+        {"call_uuid": "u1", "audio_url": "https://h/2.wav", "call_url": "https://h/c1.wav"},
+        {"call_uuid": "u2", "audio_url": None, "call_url": "https://h/c2.wav"},
+    ]
+    expected = ["https://h/1.wav", "https://h/c1.wav", "https://h/2.wav", "https://h/c2.wav"]
+    jsonl = tmp_path / "sample.jsonl"
+    jsonl.write_text("\n".join(json.dumps(row) for row in rows))
+    assert list(audio.read_audio_urls(str(jsonl))) == expected
+
+    csv = tmp_path / "sample.csv"
+    csv.write_text("call_uuid,audio_url,call_url\nu1,https://h/1.wav,https://h/c1.wav\n"
+                   "u1,https://h/2.wav,https://h/c1.wav\nu2,,https://h/c2.wav\n")
+    assert list(audio.read_audio_urls(str(csv))) == expected
+
+
+def test_rate_limiter_spaces_requests():
+    async def acquire_all(n):
+        limiter = audio.RateLimiter(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(n):
+            await limiter.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(acquire_all(6)) >= 5 / 50 * 0.9
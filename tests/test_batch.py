@@ -0,0 +1,119 @@
+import json
+import random
+import threading
+
+import pytest
+
+from skit_calls import batch, calls
+from skit_calls import constants as const
+from skit_calls.data import db
+from tests.test_db import fake_primary
+
+DATES = {"start_date": "2022-01-01T00:00:00+05:30", "end_date": "2022-01-02T00:00:00+05:30"}
+
+
+def write_jobs(path, jobs):
+    path.write_text("\n".join(json.dumps(job) for job in jobs) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def fake_calls(monkeypatch):
+    draws, runs = [], {}
+
+    def sample_call_ids(start_date, end_date, lang, call_quantity=200, **kwargs):
+        draws.append((lang, call_quantity))
+        return tuple(range(len(draws) * 1000, len(draws) * 1000 + int(call_quantity * 1.1)))
+
+    def sample(start_date, end_date, lang, domain_url="", call_quantity=200, call_ids=None, on_disk=True, **kwargs):
+        if lang == "ta":
+            raise ValueError("No calls in ta.")
+        call_ids = sample_call_ids(start_date, end_date, lang, call_quantity) if call_ids is None else call_ids
+        runs[kwargs.get("intents", [lang])[0]] = call_ids
+        path = f"{kwargs['tmp']}/{len(runs)}.csv"
+        with open(path, "w") as handle:
+            handle.write("call_id\n" + "\n".join(map(str, call_ids)))
+        return path
+
+    monkeypatch.setattr(calls, "sample_call_ids", sample_call_ids)
+    monkeypatch.setattr(calls, "sample", sample)
+    return draws, runs
+
+
+def test_jobs_with_the_same_filters_share_a_draw(fake_calls, tmp_path):
+    draws, runs = fake_calls
+    tmp = str(tmp_path)
+    jobs_file = write_jobs(tmp_path / "jobs.jsonl", [
+        {"command": "sample", "name": "confirm", "lang": "en", "call_quantity": 10, "intents": ["confirm"], "tmp": tmp, **DATES},
+        {"command": "sample", "name": "deny", "lang": "en", "call_quantity": 20, "intents": ["deny"], "tmp": tmp, **DATES},
+        {"command": "sample", "name": "hindi", "lang": "hi", "call_quantity": 10, "tmp": tmp, **DATES},
+        {"command": "sample", "name": "tamil", "lang": "ta", "tmp": tmp, **DATES},
+    ])
+    summary = batch.run_batch(jobs_file, str(tmp_path / "out"), concurrency=3)
+
+    assert sorted(draws) == [("en", 20), ("hi", 10)]
+    assert runs["confirm"] == runs["deny"][:11] and len(runs["deny"]) == 22
+    reports = {job["name"]: job for job in summary["jobs"]}
+    assert (summary["done"], summary["failed"], summary["shared_call_id_draws"]) == (3, 1, 1)
+    assert reports["confirm"]["shared_draw"] and not reports["hindi"]["shared_draw"]
+    assert reports["deny"]["path"] == str(tmp_path / "out" / "deny.csv")
+    assert "No calls in ta." in reports["tamil"]["error"]
+    with open(tmp_path / "out" / const.BATCH_SUMMARY) as handle:
+        assert json.load(handle) == summary
+
+
+def test_jobs_sample_their_ids_from_a_shared_draw(monkeypatch):
+    jobs = [
+        batch.Job("small", "sample", {"lang": "en", "call_quantity": 10, "seed": 3, **DATES}),
+        batch.Job("large", "sample", {"lang": "en", "call_quantity": 100, "seed": 3, **DATES}),
+    ]
+    for job in jobs:
+        job.draw = batch.draw_key(job)
+    picked = []
+    for order in (1, 2):
+        # The same draw, returned in a different order.
+        drawn = list(range(1000, 1200))
+        random.Random(order).shuffle(drawn)
+        monkeypatch.setattr(calls, "sample_call_ids", lambda **kwargs: tuple(drawn))
+        draws = batch.SharedDraws(jobs)
+        picked.append([draws.get(job) for job in jobs])
+    small, large = picked[0]
+    assert picked[0] == picked[1]
+    assert (len(small), len(large)) == (11, 111) and len(set(large)) == 111
+    assert set(small) <= set(large)
+    assert small != tuple(range(1000, 1011))
+
+
+def test_draw_keys():
+    job = batch.Job("a", "sample", {"lang": "en", "call_quantity": 10, "intents": ["a"], **DATES})
+    same = batch.Job("b", "sample", {"lang": "en", "states": ["B"], **DATES})
+    assert batch.draw_key(job) == batch.draw_key(same) != batch.draw_key(batch.Job("c", "sample", {"lang": "hi", **DATES}))
+    assert batch.draw_key(batch.Job("d", "sample", {"lang": "en", "exclusion_index": "x.npy", **DATES})) is None
+    assert batch.draw_key(batch.Job("e", "select", {"call_ids": [1]})) is None
+    assert batch.output_path(batch.Job("f", "sample", {"output_format": const.JSONL}), "out") == "out/f.jsonl"
+
+
+def test_read_jobs_rejects_unknown_commands(tmp_path):
+    with pytest.raises(ValueError):
+        batch.read_jobs(write_jobs(tmp_path / "jobs.jsonl", [{"command": "delete"}]))
+    with pytest.raises(ValueError):
+        batch.read_jobs(write_jobs(tmp_path / "jobs.jsonl", [{"command": "select", "name": "a"}] * 2))
+
+
+def test_more_jobs_than_db_connections_share_the_pool(monkeypatch, tmp_path):
+    primary = fake_primary(monkeypatch, pool_size=4)
+    both_connected = threading.Barrier(2, timeout=5)
+
+    def write_result(command, params, output):
+        with db.pooled(), db.pooled():
+            both_connected.wait()
+        return output
+
+    monkeypatch.setattr(calls, "write_result", write_result)
+    jobs_file = write_jobs(tmp_path / "jobs.jsonl", [{"command": "select", "call_ids": [i]} for i in range(6)])
+    summary = batch.run_batch(jobs_file, str(tmp_path / "out"), concurrency=2)
+    assert summary["done"] == 6
+    assert primary.pool.most_used == 4 and primary.pool.used == 0
+
+    with pytest.raises(ValueError, match="concurrency=3"):
+        batch.run_batch(jobs_file, str(tmp_path / "out"), concurrency=3)
@@ -0,0 +1,95 @@
+import asyncio
+import os
+
+from skit_calls import audio
+from skit_calls.cache import AudioCache, cache_key, materialize
+from tests.test_audio import RECORDING, FakeS3Client
+
+
+def write_entry(cache, source, data):
+    path = cache.path(cache_key(source))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as handle:
+        handle.write(data)
+    return cache.add(source)
+
+
+def test_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr("skit_calls.cache.time.time", lambda: next(clock))
+    cache = AudioCache(str(tmp_path), max_bytes=25)
+    for source in ("a", "b", "c"):
+        write_entry(cache, source, b"x" * 10)
+    assert cache.get("a") is None
+    assert cache.get("b") and cache.get("c")
+
+    cache.get("b")
+    write_entry(cache, "d", b"x" * 10)
+    assert cache.get("c") is None
+    assert cache.size == 20
+    assert not os.path.exists(cache.path(cache_key("c")))
+
+
+def test_cache_index_survives_runs(tmp_path):
+    cache = AudioCache(str(tmp_path))
+    write_entry(cache, "s3://bucket/a.wav", RECORDING)
+    cache.save()
+
+    reopened = AudioCache(str(tmp_path))
+    assert reopened.size == len(RECORDING)
+    assert reopened.get("s3://bucket/a.wav") == cache.path(cache_key("s3://bucket/a.wav"))
+
+
+def test_runs_sharing_a_cache_merge_their_index(tmp_path, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr("skit_calls.cache.time.time", lambda: next(clock))
+    first, second = AudioCache(str(tmp_path), max_bytes=25), AudioCache(str(tmp_path), max_bytes=25)
+    write_entry(first, "a", b"x" * 10)
+    write_entry(second, "b", b"x" * 10)
+    write_entry(second, "c", b"x" * 10)
+    first.save()
+    second.save()
+
+    reopened = AudioCache(str(tmp_path), max_bytes=25)
+    assert reopened.get("a") is None and reopened.get("b") and reopened.get("c")
+    assert reopened.size == 20 and not os.path.exists(reopened.path(cache_key("a")))
+
+
+def test_materialize_hardlinks(tmp_path):
+    source = tmp_path / "source.wav"
+    source.write_bytes(RECORDING)
+    destination = tmp_path / "out" / "a.wav"
+    materialize(str(source), str(destination))
+    assert destination.read_bytes() == RECORDING
+    assert os.stat(source).st_ino == os.stat(destination).st_ino
+
+
+def test_materialize_falls_back_to_symlinks(tmp_path, monkeypatch):
+    def cross_device(*args):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr("skit_calls.cache.os.link", cross_device)
+    source = tmp_path / "source.wav"
+    source.write_bytes(RECORDING)
+    destination = tmp_path / "out" / "a.wav"
+    materialize(str(source), str(destination))
+    assert destination.is_symlink() and destination.read_bytes() == RECORDING
+
+
+def test_download_audio_reuses_cache_across_runs(tmp_path):
+    client = FakeS3Client({("bucket", "calls/1.wav"): RECORDING})
+    urls = ["s3://bucket/calls/1.wav", "https://bucket.s3.ap-south-1.amazonaws.com/calls/1.wav?X-Amz-Signature=x"]
+    cache_dir = str(tmp_path / "cache")
+
+    first = asyncio.run(
+        audio.adownload_audio(urls[:1], str(tmp_path / "run1"), cache=AudioCache(cache_dir), s3_client=client)
+    )
+    client.objects.clear()
+    second = asyncio.run(
+        audio.adownload_audio(
+            urls[1:], str(tmp_path / "run2"), via_s3=True, cache=AudioCache(cache_dir), s3_client=client
+        )
+    )
+    assert (first.downloaded, first.cached) == (1, 0)
+    assert (second.downloaded, second.cached, second.failed) == (0, 1, {})
+    assert (tmp_path / "run2" / "bucket" / "calls" / "1.wav").read_bytes() == RECORDING
@@ -1,9 +1,16 @@
+import inspect
+import json
 import os
 import shutil
 
 import pandas as pd
 import pytest
 
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import query
+from skit_calls.data.exclusions import ExclusionIndex
+
 # from skit_calls import calls
 # from skit_calls import constants as const
 
@@ -34,3 +41,115 @@ import pytest
 # def test_sample_in_memory(args):
 #     sample_calls_df = calls.sample(**args, on_disk=False)
 #     assert isinstance(sample_calls_df, pd.DataFrame)
+
+
+@pytest.fixture
+def sampled_turns(monkeypatch, records):
+    turns = list(query.as_turns(records, "https://example.com", False, "Asia/Kolkata"))
+    monkeypatch.setattr(calls, "sample_call_ids", lambda *args, **kwargs: (1, 2, 3))
+    monkeypatch.setattr(calls.query, "gen_random_calls", lambda *args, **kwargs: iter(turns))
+    return turns
+
+
+def test_iter_sample_yields_turns(sampled_turns):
+    assert list(calls.iter_sample("2022-01-01", "2022-01-02", "en")) == sampled_turns
+
+
+def test_iter_sample_yields_dataframe_chunks(sampled_turns):
+    chunks = list(calls.iter_sample("2022-01-01", "2022-01-02", "en", chunk_size=5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 2]
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks, ignore_index=True), calls.save_turns_in_memory(sampled_turns)
+    )
+
+
+def test_turns_within_budget_stay_in_memory(records):
+    turns = list(query.as_turns(records, const.DEFAULT_AUDIO_URL_DOMAIN, False, const.DEFAULT_TIMEZONE))
+    results = calls.save_turns_within_budget(iter(turns), memory_budget=10**9)
+    assert not results.spilled
+    assert list(results) == turns
+    assert results.to_frame().shape == (12, len(turns[0]))
+
+
+def test_turns_over_budget_spill_to_disk(records):
+    turns = list(query.as_turns(records, const.DEFAULT_AUDIO_URL_DOMAIN, False, const.DEFAULT_TIMEZONE))
+    budget = sum(calls.approx_size(turn) for turn in turns[:3])
+    results = calls.save_turns_within_budget(iter(turns), memory_budget=budget)
+    assert results.spilled
+    in_memory = calls.save_turns_within_budget(iter(turns), memory_budget=10**9)
+    expected = pd.read_csv(calls.save_turns_on_disk(iter(turns)))
+    pd.testing.assert_frame_equal(results.to_frame(), expected)
+    pd.testing.assert_frame_equal(pd.concat(results.iter_chunks(5), ignore_index=True), expected)
+    assert [len(chunk) for chunk in in_memory.iter_chunks(5)] == [5, 5, 2]
+    assert [turn["conversation_uuid"] for turn in results] == [turn["conversation_uuid"] for turn in turns]
+
+
+def test_sample_tops_up_to_call_quantity(monkeypatch):
+    from tests.conftest import RECORD_COLUMNS, make_record
+
+    seeds = []
+
+    def sample_call_ids(*args, call_quantity, seed, **kwargs):
+        seeds.append(seed)
+        start = 100 * len(seeds)
+        return tuple(range(start, start + call_quantity))
+
+    def gen_raw_batches(call_ids, turn_filters, **kwargs):
+        # Only calls with even ids have matching turns.
+        rows = [tuple(make_record(0, call_id=call_id)) for call_id in call_ids if call_id % 2 == 0]
+        yield RECORD_COLUMNS, rows
+
+    monkeypatch.setattr(calls, "sample_call_ids", sample_call_ids)
+    monkeypatch.setattr(query, "gen_raw_batches", gen_raw_batches)
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    df = calls.sample(
+        "2022-01-01", "2022-01-02", "en", const.DEFAULT_AUDIO_URL_DOMAIN,
+        call_quantity=20, on_disk=False, seed=5, top_up=True,
+    )
+    assert df.call_id.nunique() == 20
+    assert seeds == [5, 6]
+    with pytest.raises(ValueError):
+        calls.sample("2022-01-01", "2022-01-02", "en", "", top_up=True, partition=(0, 2))
+
+
+def test_budget_without_a_size_is_the_memory_limit():
+    assert calls.budget_bytes(True) == int(const.MEMORY_LIMIT)
+    assert calls.budget_bytes("2KB") == 2048
+
+
+def test_streaming_apis_keep_their_positional_parameters():
+    for function, positional in [(calls.iter_sample, 25), (calls.iter_select, 8)]:
+        parameters = list(inspect.signature(function).parameters.values())
+        assert parameters[positional - 1].name == "chunk_size"
+        assert all(parameter.kind is parameter.KEYWORD_ONLY for parameter in parameters[positional:])
+
+
+def test_exclusion_index_gets_only_delivered_calls(monkeypatch, tmp_path):
+    from tests.conftest import RECORD_COLUMNS, make_record
+
+    fetched_columns = []
+
+    def gen_raw_batches(call_ids, turn_filters, columns=None, **kwargs):
+        fetched_columns.append(columns)
+        # Only calls with even ids have matching turns.
+        yield RECORD_COLUMNS, [tuple(make_record(0, call_id=call_id)) for call_id in call_ids if call_id % 2 == 0]
+
+    def gen_copied_batches(call_ids, **kwargs):
+        records = [make_record(0, call_id=call_id) for call_id in call_ids if call_id % 3 == 0]
+        copied = pd.DataFrame(records, columns=RECORD_COLUMNS)
+        yield copied.assign(prediction=copied.prediction.map(json.dumps)).to_csv(index=False)
+
+    monkeypatch.setattr(calls, "sample_call_ids", lambda *args, call_quantity, **kwargs: tuple(range(call_quantity)))
+    monkeypatch.setattr(query, "gen_raw_batches", gen_raw_batches)
+    monkeypatch.setattr(query, "gen_copied_batches", gen_copied_batches)
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    args = ("2022-01-01", "2022-01-02", "en", const.DEFAULT_AUDIO_URL_DOMAIN)
+
+    index = str(tmp_path / "sampled.npy")
+    calls.sample(*args, call_quantity=10, on_disk=False, columns=["intent"], exclusion_index=index)
+    assert fetched_columns == [("call_id", "intent")]
+    assert ExclusionIndex(index).as_tuple() == (0, 2, 4, 6, 8)
+
+    index = str(tmp_path / "bulk.npy")
+    calls.sample(*args, call_quantity=10, bulk=True, exclusion_index=index)
+    assert ExclusionIndex(index).as_tuple() == (0, 3, 6, 9)
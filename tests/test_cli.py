@@ -1,4 +1,8 @@
-from skit_calls.cli import process_date_filters, to_datetime
+import argparse
+
+import pytest
+
+from skit_calls.cli import parse_columns, parse_output, parse_partition, process_date_filters, to_datetime
 from datetime import date, datetime, timedelta
 from skit_calls import constants as const
 import pytz
@@ -80,3 +84,23 @@ def test_process_date_filters_current():
     assert end_date == (datetime.combine(date.today(), datetime.min.time()) + timedelta(
             hours=23, minutes=59, seconds=59
         )).replace(tzinfo=pytz.timezone(const.DEFAULT_TIMEZONE)).isoformat()
+
+
+def test_parse_partition():
+    assert parse_partition("0/4") == (0, 4)
+    assert parse_partition("3/4") == (3, 4)
+    for invalid in ("4/4", "-1/4", "1", "a/b"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_partition(invalid)
+
+
+def test_parse_columns():
+    assert parse_columns("call_uuid, intent,audio_url") == ("call_uuid", "intent", "audio_url")
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_columns("call_uuid,not_a_field")
+
+
+def test_parse_output():
+    assert parse_output("s3://datasets/calls/") == "s3://datasets/calls/"
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_output("datasets/calls")
@@ -0,0 +1,190 @@
+import random
+import threading
+import time
+from collections import Counter
+
+import psycopg2 as pg
+import pytest
+from psycopg2.errors import SerializationFailure
+from psycopg2.pool import PoolError
+
+from skit_calls.data import db
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_endpoints(clock=None, **kwargs):
+    endpoints = db.parse_endpoints("primary:5432*1,replica-1*3,replica-2:5433*3", "5432")
+    return db.Endpoints(endpoints, rng=random.Random(0), clock=clock or Clock(), **kwargs)
+
+
+def shares(endpoints, n=20000, writable=False):
+    counts = Counter(endpoints.choose(writable).host for _ in range(n))
+    return {host: count / n for host, count in counts.items()}
+
+
+def test_parse_endpoints():
+    primary, replica_1, replica_2 = db.parse_endpoints("primary:5432*1, replica-1*3, replica-2:5433", "6432")
+    assert (primary.host, primary.port, primary.weight, primary.primary) == ("primary", "5432", 1.0, True)
+    assert (replica_1.port, replica_1.weight, replica_1.primary) == ("6432", 3.0, False)
+    assert (replica_2.port, replica_2.weight) == ("5433", 1.0)
+    with pytest.raises(ValueError):
+        db.parse_endpoints(" , ")
+
+
+def test_hosts_are_picked_by_weight():
+    result = shares(make_endpoints())
+    assert result["primary"] == pytest.approx(1 / 7, abs=0.02)
+    assert result["replica-1"] == pytest.approx(3 / 7, abs=0.02)
+    assert shares(make_endpoints(), writable=True) == {"primary": 1.0}
+
+
+def test_slow_hosts_get_less_traffic():
+    endpoints = make_endpoints()
+    primary, replica_1, replica_2 = endpoints.endpoints
+    for _ in range(20):
+        endpoints.record_success(primary, 0.1)
+        endpoints.record_success(replica_1, 0.1)
+        endpoints.record_success(replica_2, 0.3)
+    assert replica_2.latency == pytest.approx(0.3)
+    result = shares(endpoints)
+    assert result["replica-1"] == pytest.approx(3 * result["replica-2"], rel=0.1)
+
+
+def test_failing_hosts_are_ejected_then_retried():
+    clock = Clock()
+    endpoints = make_endpoints(clock, eject_after=3, eject_seconds=30)
+    replica_1 = endpoints.endpoints[1]
+    for _ in range(2):
+        endpoints.record_failure(replica_1)
+    assert "replica-1" in shares(endpoints, 1000)
+
+    endpoints.record_failure(replica_1)
+    assert "replica-1" not in shares(endpoints, 1000)
+
+    clock.now = 31
+    assert "replica-1" in shares(endpoints, 1000)
+    endpoints.record_failure(replica_1)
+    assert "replica-1" not in shares(endpoints, 1000)
+
+    clock.now = 62
+    endpoints.record_success(replica_1, 0.1)
+    endpoints.record_failure(replica_1)
+    assert "replica-1" in shares(endpoints, 1000)
+
+
+def test_all_hosts_ejected_falls_back_to_first_due():
+    clock = Clock()
+    endpoints = make_endpoints(clock, eject_after=1, eject_seconds=30)
+    for endpoint in endpoints.endpoints:
+        clock.now += 1
+        endpoints.record_failure(endpoint)
+    assert endpoints.choose().host == "primary"
+
+
+class FakePool:
+    def __init__(self, error=None, maxconn=db.const.DB_POOL_SIZE):
+        self.error = error
+        self.maxconn = maxconn
+        self.used = 0
+        self.most_used = 0
+        self.returned = []
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        if self.error:
+            raise self.error
+        with self.lock:
+            # Like ThreadedConnectionPool, which raises rather than waits.
+            if self.used == self.maxconn:
+                raise PoolError("connection pool exhausted")
+            self.used += 1
+            self.most_used = max(self.most_used, self.used)
+        return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            self.used -= 1
+            self.returned.append(conn)
+
+
+class FakeConnection:
+    closed = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def test_pooled_tracks_host_health(monkeypatch):
+    endpoints = db.Endpoints([db.Endpoint("primary", primary=True)], eject_after=2)
+    primary = endpoints.endpoints[0]
+    monkeypatch.setattr(db, "get_endpoints", lambda: endpoints)
+
+    primary.pool = FakePool(pg.OperationalError("could not connect to server"))
+    monkeypatch.setattr(db.Endpoint, "get_pool", lambda self, maxconn=None: self.pool)
+    with pytest.raises(pg.OperationalError):
+        with db.pooled():
+            pass
+    assert primary.failures == 1
+
+    primary.pool = FakePool()
+    with pytest.raises(SerializationFailure):
+        with db.pooled():
+            raise SerializationFailure("could not serialize access")
+    assert primary.failures == 1
+
+    with db.pooled():
+        pass
+    assert primary.failures == 0 and primary.latency is not None
+    assert len(primary.pool.returned) == 2
+
+
+def fake_primary(monkeypatch, pool_size=db.const.DB_POOL_SIZE):
+    """
+    A single db host whose pool of `pool_size` connections raises when exhausted.
+    """
+    monkeypatch.setattr(db.const, "DB_POOL_SIZE", pool_size)
+    endpoints = db.Endpoints([db.Endpoint("primary", primary=True)])
+    primary = endpoints.endpoints[0]
+    primary.pool = FakePool(maxconn=pool_size)
+    monkeypatch.setattr(db, "get_endpoints", lambda: endpoints)
+    monkeypatch.setattr(db.Endpoint, "get_pool", lambda self, maxconn=None: self.pool)
+    return primary
+
+
+def test_pooled_waits_for_a_connection_when_all_are_borrowed(monkeypatch):
+    primary = fake_primary(monkeypatch)
+    errors = []
+
+    def borrow():
+        try:
+            with db.pooled():
+                time.sleep(0.01)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=borrow) for _ in range(db.const.DB_POOL_SIZE * 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert primary.pool.most_used == db.const.DB_POOL_SIZE
+    assert len(primary.pool.returned) == db.const.DB_POOL_SIZE * 3
+
+
+def test_jobs_that_could_exhaust_the_pool_are_rejected():
+    db.check_pool_size(4, "max_jobs", pool_size=8)
+    with pytest.raises(ValueError, match="max_jobs=5 jobs can hold up to 10 db connections"):
+        db.check_pool_size(5, "max_jobs", pool_size=8)
+    with pytest.raises(ValueError):
+        db.check_pool_size(0, "max_jobs", pool_size=8)
@@ -0,0 +1,38 @@
+import numpy as np
+
+from skit_calls.data.exclusions import ExclusionIndex
+
+
+def test_index_filters_and_persists(tmp_path):
+    path = str(tmp_path / "index" / "excluded.npy")
+    index = ExclusionIndex(path)
+    assert len(index) == 0 and index.filter((3, 1, 2)) == (3, 1, 2)
+
+    assert index.add([5, 3, 5, 10**12]) == 3
+    assert index.add([3, 7]) == 1
+    assert 7 in index and 4 not in index
+    assert index.filter((8, 7, 1, 10**12, 5, 2)) == (8, 1, 2)
+    assert index.contains([0, 3, 11**12]).tolist() == [False, True, False]
+
+    reloaded = ExclusionIndex(path)
+    assert reloaded.as_tuple() == (3, 5, 7, 10**12)
+    assert reloaded.ids.dtype == np.int64
+
+
+def test_concurrent_indexes_keep_each_others_ids(tmp_path):
+    path = str(tmp_path / "excluded.npy")
+    first, second = ExclusionIndex(path), ExclusionIndex(path)
+    first.add(range(0, 1000, 2))
+    second.add(range(1, 1000, 2))
+    assert ExclusionIndex(path).as_tuple() == tuple(range(1000))
+
+
+def test_ids_are_added_only_after_the_stream_is_consumed(tmp_path):
+    index = ExclusionIndex(str(tmp_path / "excluded.npy"))
+    drawn = [1, 2]
+    stream = index.add_after(iter(["a", "b"]), drawn)
+    assert next(stream) == "a"
+    drawn.append(3)
+    assert len(index) == 0
+    assert list(stream) == ["b"]
+    assert index.as_tuple() == (1, 2, 3)
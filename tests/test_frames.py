@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+import pytz
+
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import query
+from skit_calls.data.frames import concat_frames, decode_frame, join_urls
+from skit_calls.data.model import get_url
+from tests.conftest import RECORD_COLUMNS, fake_raw_batches, make_record
+
+
+def dict_frame(batches, **kwargs):
+    return calls.save_turns_in_memory(
+        turn for batch in batches for turn in query.decode_batch(batch, const.DEFAULT_AUDIO_URL_DOMAIN, **kwargs)
+    )
+
+
+def frame(batches, **kwargs):
+    return concat_frames(decode_frame(batch, const.DEFAULT_AUDIO_URL_DOMAIN, **kwargs) for batch in batches)
+
+
+def edge_records():
+    return [
+        make_record(0, call_url="https://cdn.example.com/x.wav", prediction=None, context=None, utterances=None),
+        make_record(1, call_url_id=None, asr_latency="", call_duration=0, intents_info=None),
+        make_record(2, turn_audio_path="/a/../b.wav", turn_audio_base_path="https://host/base"),
+        make_record(3, turn_audio_path="a//b.wav?x=1", reftime=datetime(2022, 12, 1, 4, 0, tzinfo=pytz.UTC)),
+        make_record(4, turn_audio_base_path="s3://bucket/", utterances='[{"transcript": "hi"}]'),
+        make_record(5, prediction={"intents": []}, context='{"bot_response": {"text": "hi"}}'),
+        make_record(6, reftime=datetime(2022, 12, 1, 4, 0, 0, 5, tzinfo=pytz.timezone("Asia/Tokyo"))),
+    ]
+
+
+def test_frames_match_turn_dicts():
+    batches = fake_raw_batches(3) + [(RECORD_COLUMNS, [tuple(record) for record in edge_records()]), (RECORD_COLUMNS, [])]
+    pd.testing.assert_frame_equal(frame(batches), dict_frame(batches))
+
+
+def test_frames_with_an_all_null_float_batch_match_turn_dicts():
+    nulls = {"asr_latency": None, "slu_latency": None, "call_duration": None}
+    null_batch = (RECORD_COLUMNS, [tuple(make_record(100 + i, **nulls)) for i in range(4)])
+    batches = fake_raw_batches(2)
+    for mixed in (batches[:1] + [null_batch] + batches[1:], [null_batch] + batches, batches + [null_batch]):
+        result = frame(mixed)
+        pd.testing.assert_frame_equal(result, dict_frame(mixed))
+        assert result.asr_latency.dtype == "float64"
+    pd.testing.assert_frame_equal(frame([null_batch]), dict_frame([null_batch]))
+
+
+@pytest.mark.parametrize("timezone", ["UTC", "America/New_York"])
+def test_frames_match_turn_dicts_across_timezones(timezone):
+    batches = fake_raw_batches(2)
+    pd.testing.assert_frame_equal(frame(batches, timezone=timezone), dict_frame(batches, timezone=timezone))
+
+
+def test_projected_frames():
+    columns = ("call_uuid", "intent", "audio_url", "asr_latency")
+    batches = fake_raw_batches(2)
+    pd.testing.assert_frame_equal(frame(batches, columns=columns), dict_frame(batches, columns=columns))
+
+
+def test_join_urls_matches_get_url():
+    pairs = [
+        ("https://host/base/", "a/b.wav"),
+        ("https://host/base", "/a/b.wav"),
+        ("https://host", "a%20b.wav"),
+        ("https://host/base/", "../b.wav"),
+        ("https://host/base/./", "b.wav"),
+        ("https://host//base/", "b.wav"),
+        ("https://host/base/", "a//b.wav"),
+        ("https://host/base?q=1", "b.wav"),
+        ("HTTPS://host/base/", "b.wav"),
+        ("s3://bucket/base/", "b.wav"),
+        ("https://host/base/", "https://other/b.wav"),
+        ("https://host/base/", "b.wav#frag"),
+    ]
+    bases, paths = zip(*pairs)
+    joined = join_urls(bases, paths, lambda base, path: get_url(base, path, None, None))
+    assert joined.tolist() == [get_url(base, path, None, None) for base, path in pairs]
+
+
+def test_sample_in_memory_decodes_frames(monkeypatch):
+    batches = fake_raw_batches(4)
+    monkeypatch.setattr(calls, "sample_call_ids", lambda *args, **kwargs: (1, 2, 3))
+    monkeypatch.setattr(query, "gen_raw_batches", lambda *args, **kwargs: iter(batches))
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    df = calls.sample("2022-01-01", "2022-01-02", "en", const.DEFAULT_AUDIO_URL_DOMAIN, on_disk=False)
+    pd.testing.assert_frame_equal(df, dict_frame(batches))
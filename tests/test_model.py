@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import os
+from collections import namedtuple
+
+import pytest
+
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import model, query
+from skit_calls.data.model import RawJSON, Turn, check_columns, derive_columns, dump_json_line, record_columns
+from tests.conftest import make_record
+
+
+def as_rows(records, output_format):
+    return list(query.as_turns(records, const.DEFAULT_AUDIO_URL_DOMAIN, False, const.DEFAULT_TIMEZONE, output_format))
+
+
+def test_jsonl_matches_csv_values(records):
+    csv_handle = io.StringIO()
+    calls.write_csv(as_rows(records, const.CSV), csv_handle)
+    jsonl_handle = io.StringIO()
+    calls.write_jsonl(as_rows(records, const.JSONL), jsonl_handle)
+
+    csv_rows = list(csv.DictReader(io.StringIO(csv_handle.getvalue())))
+    json_rows = [json.loads(line) for line in jsonl_handle.getvalue().splitlines()]
+    assert len(csv_rows) == len(json_rows) == len(records)
+    for csv_row, json_row in zip(csv_rows, json_rows):
+        assert list(json_row) == list(csv_row)
+        assert json_row["slots"] == json.loads(csv_row["slots"])
+        assert json_row["context"] == json.loads(csv_row["context"])
+        assert json_row["utterances"] == json.loads(csv_row["utterances"])
+        assert json_row["primary_utterance"] == csv_row["primary_utterance"]
+
+
+def test_jsonl_passes_raw_json_through():
+    raw = '{"bot_response":  "hello"}'
+    row, = as_rows([make_record(context=raw)], const.JSONL)
+    assert isinstance(row["context"], RawJSON)
+    assert f'"context": {raw}' in dump_json_line(row)
+    assert row["bot_response"] == "hello"
+
+
+def test_jsonl_decodes_multiline_raw_json():
+    row, = as_rows([make_record(context='{\n"bot_response": "hello"}')], const.JSONL)
+    assert row["context"] == {"bot_response": "hello"}
+    assert "\n" not in dump_json_line(row)
+
+
+@pytest.mark.parametrize(
+    "raw", ['{\r\n"bot_response": "hello"}', '{"bot_response": "hello\u2028there"}', '{"bot_response": "\u2029"}']
+)
+def test_jsonl_rows_stay_on_one_line(raw):
+    row, = as_rows([make_record(context=raw)], const.JSONL)
+    assert not isinstance(row["context"], RawJSON)
+    line = dump_json_line(row)
+    assert line.splitlines() == [line]
+    assert json.loads(line)["context"] == json.loads(raw)
+
+
+def as_copied_row(record):
+    return {
+        key: "" if value is None else json.dumps(value) if isinstance(value, dict) else str(value)
+        for key, value in record._asdict().items()
+    }
+
+
+def test_derived_columns_match_turns(records):
+    for record in records + [make_record(call_url="https://cdn.example.com/x.wav", prediction=None)]:
+        turn = Turn.from_record(record, const.DEFAULT_AUDIO_URL_DOMAIN)
+        derived = derive_columns(as_copied_row(record), const.DEFAULT_AUDIO_URL_DOMAIN)
+        assert list(derived) == list(const.DERIVED_COLUMNS)
+        for column, value in derived.items():
+            assert value == getattr(turn, column), column
+
+
+def test_export_writes_one_header(records):
+    def copied(batch):
+        handle = io.StringIO()
+        writer = csv.DictWriter(handle, fieldnames=batch[0]._fields)
+        writer.writeheader()
+        writer.writerows(map(as_copied_row, batch))
+        return handle.getvalue()
+
+    file_path = calls.export_turns_on_disk([copied(records[:5]), copied(records[5:])])
+    with open(file_path) as handle:
+        rows = list(csv.DictReader(handle))
+    os.remove(file_path)
+    assert len(rows) == len(records)
+    assert rows[-1]["intent"] == "_confirm_"
+    assert rows[-1]["call_id"] == str(records[-1].call_id)
+
+
+def test_row_serializer_matches_dict_writer(records):
+    records = records + [make_record(20, context=None, utterances=None, prediction={}, asr_latency=None)]
+    dict_handle = io.StringIO()
+    calls.write_csv(as_rows(records, const.CSV), dict_handle)
+    row_handle = io.StringIO()
+    calls.write_csv_rows(as_rows(records, const.CSV_ROWS), row_handle)
+    assert row_handle.getvalue() == dict_handle.getvalue()
+
+
+def projected_record(record, columns):
+    names = record_columns(columns)
+    return namedtuple("Projected", names)(*(getattr(record, name) for name in names))
+
+
+def test_projected_turns_match_full_turns(records):
+    projections = [(field,) for field in Turn.__slots__] + [
+        ("call_uuid", "conversation_uuid", "primary_utterance", "intent", "audio_url"),
+        ("entities", "context", "reftime", "call_id"),
+    ]
+    for output_format in (const.CSV, const.JSONL, const.CSV_ROWS):
+        full = as_rows(records, output_format)
+        for columns in projections:
+            projected = list(query.as_turns(
+                [projected_record(record, columns) for record in records],
+                const.DEFAULT_AUDIO_URL_DOMAIN, False, const.DEFAULT_TIMEZONE, output_format, columns,
+            ))
+            if output_format == const.CSV_ROWS:
+                indices = [Turn.__slots__.index(column) for column in columns]
+                expected = [tuple(row[i] for i in indices) for row in full]
+            else:
+                expected = [{column: row[column] for column in columns} for row in full]
+            assert projected == expected, (output_format, columns)
+
+
+def test_projection_skips_unneeded_converters(records, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("not needed for the requested columns")
+
+    monkeypatch.setattr(model, "get_url", fail)
+    monkeypatch.setattr(model, "get_readable_reftime", fail)
+    monkeypatch.setattr(model, "prediction2intent", fail)
+    columns = ("call_uuid", "conversation_uuid", "primary_utterance")
+    rows = list(query.as_turns(
+        [projected_record(record, columns) for record in records],
+        const.DEFAULT_AUDIO_URL_DOMAIN, True, const.DEFAULT_TIMEZONE, const.CSV, columns,
+    ))
+    assert list(rows[0]) == list(columns)
+    assert record_columns(columns) == ("call_uuid", "conversation_uuid", "utterances")
+
+
+def test_check_columns():
+    assert check_columns(None) is None
+    assert check_columns(["intent", "call_id", "intent"]) == ("intent", "call_id")
+    with pytest.raises(ValueError):
+        check_columns(["intent", "not_a_field"])
+    with pytest.raises(ValueError):
+        check_columns([])
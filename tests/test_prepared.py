@@ -0,0 +1,138 @@
+import pytest
+
+from skit_calls.data import query
+
+QUERY = """
+SELECT * FROM turn t
+WHERE t.call_id IN %(call_ids)s
+  AND t.state NOT IN %(states)s
+  AND (%(asr_provider)s IS NULL OR t.asr_provider = %(asr_provider)s)
+  AND t.text LIKE 'a%%'
+"""
+PARAMS = {"call_ids": (1, 2), "states": ("A",), "asr_provider": None}
+
+
+def test_prepared_statement_rewrites_tuples_as_arrays():
+    name, text, names = query.as_prepared_statement(QUERY, PARAMS)
+    assert names == ["call_ids", "states", "asr_provider"]
+    assert "t.call_id = ANY($1)" in text
+    assert "t.state <> ALL($2)" in text
+    assert "($3 IS NULL OR t.asr_provider = $3)" in text
+    assert "LIKE 'a%'" in text
+    assert name == query.as_prepared_statement(QUERY, {**PARAMS, "call_ids": (3,)})[0]
+
+
+def test_tuples_outside_in_are_not_prepared():
+    assert query.as_prepared_statement("SELECT %(ids)s = (1, 2)", {"ids": (1, 2)}) is None
+
+
+class FakeCursor:
+    def __init__(self, connection=None, fail_on=None, error=None):
+        self.connection = connection
+        self.fail_on = fail_on
+        self.error = error or query.ProgrammingError("could not determine data type of parameter $3")
+        self.executed = []
+        self.copied = []
+
+    def execute(self, sql, params=None):
+        if self.fail_on and sql.startswith(self.fail_on):
+            raise self.error
+        self.executed.append((sql, params))
+
+    def copy_expert(self, sql, handle):
+        self.copied.append((sql, handle.read()))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.prepared = set()
+
+    def rollback(self):
+        pass
+
+
+def test_statements_are_prepared_once_per_connection():
+    cursor = FakeCursor(FakeConnection())
+    query.execute_prepared(cursor, QUERY, PARAMS)
+    query.execute_prepared(cursor, QUERY, {**PARAMS, "call_ids": (3, 4)})
+    statements = [sql.split()[0] for sql, _ in cursor.executed]
+    assert statements == ["SAVEPOINT", "PREPARE", "EXECUTE", "EXECUTE"]
+    assert cursor.executed[-1][1] == [[3, 4], ["A"], None]
+
+
+def test_unpreparable_queries_fall_back():
+    unpreparable = QUERY + " -- fallback"
+    cursor = FakeCursor(FakeConnection(), fail_on="PREPARE")
+    query.execute_prepared(cursor, unpreparable, PARAMS)
+    assert [sql for sql, _ in cursor.executed] == [
+        "SAVEPOINT skit_calls_prepare",
+        "ROLLBACK TO SAVEPOINT skit_calls_prepare",
+        unpreparable,
+    ]
+    assert unpreparable in query._unpreparable
+
+
+def test_failed_executes_of_prepared_statements_propagate():
+    failing = QUERY + " -- poison"
+    cursor = FakeCursor(FakeConnection(), fail_on="EXECUTE", error=query.DataError("invalid input syntax"))
+    with pytest.raises(query.DataError):
+        query.execute_prepared(cursor, failing, PARAMS)
+    assert [sql.split()[0] for sql, _ in cursor.executed] == ["SAVEPOINT", "PREPARE", "ROLLBACK"]
+    assert failing not in query._unpreparable
+    assert query.as_prepared_statement(failing, PARAMS)[0] in cursor.connection.prepared
+
+
+def test_query_text_is_read_once(tmp_path, monkeypatch):
+    sql = tmp_path / "query.sql"
+    sql.write_text("SELECT 1")
+    monkeypatch.setenv("TEST_CACHED_QUERY", str(sql))
+    assert query.get_query("TEST_CACHED_QUERY") == "SELECT 1"
+    sql.write_text("SELECT 2")
+    assert query.get_query("TEST_CACHED_QUERY") == "SELECT 1"
+
+
+def test_small_id_sets_are_bound_inline():
+    bound_query, params = query.bind_id_set(FakeCursor(), QUERY, PARAMS, "call_ids")
+    assert (bound_query, params) == (QUERY, PARAMS)
+
+
+def test_id_sets_bound_as_array_literal():
+    params = {**PARAMS, "call_ids": tuple(range(500)), "states": ('a"b',)}
+    bound_query, bound_params = query.bind_id_set(FakeCursor(), QUERY, params, "call_ids")
+    assert "t.call_id = ANY(CAST(%(call_ids)s AS bigint[]))" in bound_query
+    assert "t.state NOT IN %(states)s" in bound_query
+    assert bound_params["call_ids"] == "{" + ",".join(map(str, range(500))) + "}"
+    bound_query, bound_params = query.bind_id_set(
+        FakeCursor(), QUERY, params, "states", strategy="array", id_type="text"
+    )
+    assert "t.state <> ALL(CAST(%(states)s AS text[]))" in bound_query
+    assert bound_params["states"] == '{"a\\"b"}'
+
+
+def test_untyped_id_sets_stay_inline():
+    params = {**PARAMS, "states": tuple(f"state-{i}" for i in range(500))}
+    assert query.bind_id_set(FakeCursor(), QUERY, params, "states") == (QUERY, params)
+    cursor = FakeCursor()
+    params = {**params, "states": params["states"] * 40}
+    bound_query, _ = query.bind_id_set(cursor, QUERY, params, "states", id_type="uuid")
+    assert "t.state NOT IN (SELECT id FROM skit_calls_states)" in bound_query
+    assert cursor.executed[0][0].startswith("CREATE TEMP TABLE IF NOT EXISTS skit_calls_states (id uuid")
+
+
+def test_large_id_sets_are_staged_in_a_temp_table():
+    cursor = FakeCursor()
+    params = {**PARAMS, "call_ids": tuple(range(20000))}
+    bound_query, bound_params = query.bind_id_set(cursor, QUERY, params, "call_ids")
+    assert "t.call_id IN (SELECT id FROM skit_calls_call_ids)" in bound_query
+    assert "call_ids" not in bound_params
+    (copy_sql, copied), = cursor.copied
+    assert copy_sql == "COPY skit_calls_call_ids (id) FROM STDIN"
+    assert sorted(map(int, copied.split("\n"))) == list(range(20000))
+    assert cursor.executed[0][0].startswith("CREATE TEMP TABLE IF NOT EXISTS skit_calls_call_ids (id bigint")
+
+
+def test_empty_id_sets_are_bound_as_empty_arrays():
+    params = {**PARAMS, "states": ()}
+    bound_query, bound_params = query.bind_id_set(FakeCursor(), QUERY, params, "states")
+    assert "t.state <> ALL(%(states)s)" in bound_query
+    assert bound_params["states"] == "{}"
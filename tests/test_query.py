@@ -0,0 +1,288 @@
+import itertools
+import json
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+from psycopg2.errors import OperationalError
+from psycopg2 import DataError
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, TRANSACTION_STATUS_INTRANS, QueryCanceledError
+
+from skit_calls import constants as const
+from skit_calls.data import query
+from tests.conftest import fake_raw_batches
+
+
+@pytest.fixture
+def raw_batches(monkeypatch):
+    batches = fake_raw_batches(7)
+    monkeypatch.setattr(query, "gen_raw_batches", lambda *args, **kwargs: iter(batches))
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    return batches
+
+
+def test_process_pool_decoding_matches_in_process(raw_batches):
+    in_process = list(query.gen_random_calls((1,), workers=0))
+    pooled = list(query.gen_random_calls((1,), workers=3))
+    assert len(in_process) == 70
+    assert pooled == in_process
+
+
+def test_pipelined_stages_match_serial(raw_batches):
+    serial = list(query.gen_random_calls((1,), queue_size=0))
+    stats = {}
+    pipelined = list(query.gen_random_calls((1,), queue_size=2, stats=stats))
+    assert pipelined == serial
+    assert set(stats) == {"fetch", "decode"}
+    assert stats["fetch"].items == stats["decode"].items == 7
+
+
+def test_fetch_runs_ahead_of_decode(monkeypatch):
+    fetched = []
+    all_fetched = threading.Event()
+
+    def raw_batches(*args, **kwargs):
+        for i, batch in enumerate(fake_raw_batches(3)):
+            fetched.append(i)
+            if i == 2:
+                all_fetched.set()
+            yield batch
+
+    monkeypatch.setattr(query, "gen_raw_batches", raw_batches)
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    batches = query.gen_random_call_batches((1,), queue_size=2)
+    next(batches)
+    assert all_fetched.wait(timeout=2)
+    assert len(list(batches)) == 2
+
+Column = namedtuple("Column", ["name"])
+
+
+class FakeCursor:
+    """
+    Returns one row per call id and times out on batches that contain a poison id.
+    """
+
+    def __init__(self, poison, transient, matches=lambda call_id: True):
+        self.poison = poison
+        self.transient = transient
+        self.matches = matches
+        self.description = [Column("call_id")]
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        if query.startswith("SET LOCAL"):
+            self.timeout = params[0]
+            return
+        ids = params[const.CALL_IDS]
+        if self.transient:
+            self.transient.pop()
+            raise OperationalError("server closed the connection unexpectedly")
+        if self.poison & set(ids):
+            raise QueryCanceledError("canceling statement due to statement timeout")
+        self.rows = [(call_id,) for call_id in ids if self.matches(call_id)]
+        self.rowcount = len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    state = {"poison": set(), "transient": [], "queries": 0, "matches": lambda call_id: True}
+
+    @contextmanager
+    def pooled(writable=False):
+        state["queries"] += 1
+        yield SimpleNamespace(cursor=lambda: FakeCursor(state["poison"], state["transient"], state["matches"]))
+
+    monkeypatch.setattr(query, "pooled", pooled)
+    monkeypatch.setattr(query, "get_query", lambda name: "SELECT call_id FROM turn")
+    monkeypatch.setattr(query.time, "sleep", lambda _: None)
+    return state
+
+
+def fetched_ids(batches):
+    return [row[0] for _, rows in batches for row in rows]
+
+
+def test_poison_calls_are_isolated_and_skipped(fake_db):
+    fake_db["poison"] = {3, 12}
+    skipped = []
+    batches = list(query.gen_raw_batches(range(16), {}, limit=8, prepare=False, skipped=skipped))
+    assert fetched_ids(batches) == [i for i in range(16) if i not in {3, 12}]
+    assert skipped == [3, 12]
+    # 2 batches, each bisected down to the poison id: 1 + 2 + 2 + 2 queries.
+    assert fake_db["queries"] == 14
+
+
+def test_transient_errors_retry_the_same_batch(fake_db):
+    fake_db["transient"] = [1, 1]
+    skipped = []
+    batches = list(query.gen_raw_batches(range(8), {}, limit=8, prepare=False, skipped=skipped))
+    assert fetched_ids(batches) == list(range(8))
+    assert skipped == [] and len(batches) == 1
+    assert fake_db["queries"] == 3
+
+
+def test_transient_errors_give_up_after_the_retry_limit(fake_db, monkeypatch):
+    waits = []
+    monkeypatch.setattr(query.time, "sleep", waits.append)
+    fake_db["transient"] = [1] * 10
+    with pytest.raises(OperationalError):
+        list(query.gen_raw_batches(range(8), {}, limit=8, delay=0.5, prepare=False))
+    assert waits == [0.5 * 2**i for i in range(const.TRANSIENT_RETRIES)]
+    assert fake_db["queries"] == const.TRANSIENT_RETRIES + 1
+
+
+def test_project_query():
+    projected = query.project_query("SELECT * FROM turn WHERE call_id IN %(call_ids)s;\n", ("call_id", "reftime"))
+    assert projected == "SELECT call_id, reftime FROM (SELECT * FROM turn WHERE call_id IN %(call_ids)s) AS projected"
+
+
+def test_top_up_draws_until_enough_calls_match(fake_db):
+    fake_db["matches"] = lambda call_id: call_id % 4 == 0
+    draws = []
+
+    def draw_call_ids(quantity, round_, seen):
+        start = max(seen) + 1
+        draws.append(quantity)
+        # Half of each draw overlaps ids that were already seen.
+        return list(range(start - quantity // 2, start + quantity))
+
+    batches = query.gen_topped_up_raw_batches(
+        tuple(range(40)), {}, target=30, draw_call_ids=draw_call_ids, limit=16, prepare=False
+    )
+    call_ids = fetched_ids(batches)
+    assert len(call_ids) == len(set(call_ids)) == 30
+    assert all(call_id % 4 == 0 for call_id in call_ids)
+    # 10 of 40 calls matched: 20 more at a 25% hit rate, with a margin.
+    assert draws == [88]
+
+
+def test_top_up_stops_when_draws_run_out(fake_db):
+    fake_db["matches"] = lambda call_id: call_id % 4 == 0
+    batches = query.gen_topped_up_raw_batches(
+        tuple(range(40)), {}, target=30, draw_call_ids=lambda *args: range(40), prepare=False
+    )
+    assert len(fetched_ids(batches)) == 10
+
+
+class ExplainedCursor:
+    """
+    Records what it runs, EXPLAIN returns a two line plan or fails with `explain_error`,
+    other queries fail with `error` if given, which aborts the transaction.
+    """
+
+    def __init__(self, executed, explain_error=None, error=None, connection=None):
+        self.executed = executed
+        self.explain_error = explain_error
+        self.error = error
+        self.connection = connection or SimpleNamespace(
+            status=TRANSACTION_STATUS_INTRANS,
+            get_transaction_status=lambda: self.connection.status,
+            rollback=lambda: executed.append("ROLLBACK"),
+        )
+        self.connection.cursor = lambda: ExplainedCursor(executed, explain_error, connection=self.connection)
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.executed.append(query)
+        if query.startswith("EXPLAIN") and self.explain_error:
+            raise self.explain_error
+        if self.error is not None and not query.startswith(("EXPLAIN", "SAVEPOINT", "RELEASE", "ROLLBACK")):
+            self.connection.status = TRANSACTION_STATUS_INERROR
+            raise self.error
+        self.rowcount = 2
+
+    def fetchall(self):
+        return [("Seq Scan on turn",), ("Execution Time: 31000 ms",)]
+
+
+def test_queries_are_reported_to_hooks(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, "SLOW_QUERY_LOG", str(tmp_path / "slow.jsonl"))
+    stats = []
+    monkeypatch.setattr(query, "query_hooks", [stats.append])
+    executed = []
+    query.execute_logged(
+        ExplainedCursor(executed), const.RANDOM_CALL_DATA_QUERY, "SELECT 1", {const.CALL_IDS: (1, 2, 3), "lang": "en"}
+    )
+    (report,) = stats
+    assert report.name == const.RANDOM_CALL_DATA_QUERY and report.rows == 2
+    assert report.param_sizes == {const.CALL_IDS: 3} and report.seconds >= 0
+    assert executed == ["SELECT 1"] and not (tmp_path / "slow.jsonl").exists()
+
+
+def test_slow_queries_are_explained(monkeypatch, tmp_path):
+    log = tmp_path / "slow.jsonl"
+    monkeypatch.setattr(const, "SLOW_QUERY_LOG", str(log))
+    monkeypatch.setattr(const, "SLOW_QUERY_MS", 30_000)
+    clock = itertools.count(step=31.0)
+    monkeypatch.setattr(query.time, "perf_counter", lambda: next(clock))
+    executed = []
+    query.execute_logged(ExplainedCursor(executed), const.RANDOM_CALL_ID_QUERY, "SELECT id FROM call", {})
+    entry = json.loads(log.read_text())
+    assert entry["name"] == const.RANDOM_CALL_ID_QUERY and entry["seconds"] == 31.0 and entry["rows"] == 2
+    assert entry["plan"] == "Seq Scan on turn\nExecution Time: 31000 ms"
+    assert executed[1:] == [
+        "SAVEPOINT skit_calls_explain",
+        "EXPLAIN SELECT id FROM call",
+        "RELEASE SAVEPOINT skit_calls_explain",
+    ]
+
+    # A failed EXPLAIN is logged and rolled back, the query's transaction carries on.
+    executed.clear()
+    error = QueryCanceledError("canceling statement due to statement timeout")
+    query.execute_logged(ExplainedCursor(executed, error), const.RANDOM_CALL_ID_QUERY, "SELECT id FROM call", {})
+    entry = json.loads(log.read_text().splitlines()[1])
+    assert entry["plan"].startswith("EXPLAIN failed: canceling statement")
+    assert executed[-1] == "ROLLBACK TO SAVEPOINT skit_calls_explain"
+
+    # ANALYZE runs the query again, only when asked for.
+    executed.clear()
+    monkeypatch.setattr(const, "SLOW_QUERY_ANALYZE", True)
+    query.execute_logged(ExplainedCursor(executed), const.RANDOM_CALL_ID_QUERY, "SELECT id FROM call", {})
+    assert executed[2] == "EXPLAIN (ANALYZE, BUFFERS) SELECT id FROM call"
+
+
+def test_failed_queries_are_reported_and_cancelled_ones_explained(monkeypatch, tmp_path):
+    log = tmp_path / "slow.jsonl"
+    monkeypatch.setattr(const, "SLOW_QUERY_LOG", str(log))
+    monkeypatch.setattr(const, "SLOW_QUERY_ANALYZE", True)
+    stats = []
+    monkeypatch.setattr(query, "query_hooks", [stats.append])
+    executed = []
+    timeout = QueryCanceledError("canceling statement due to statement timeout")
+    with pytest.raises(QueryCanceledError):
+        query.execute_logged(ExplainedCursor(executed, error=timeout), const.RANDOM_CALL_DATA_QUERY, "SELECT 1", {})
+    # The aborted transaction is rolled back, the plan of a cancelled query is never analyzed.
+    assert executed == [
+        "SELECT 1",
+        "ROLLBACK",
+        "SAVEPOINT skit_calls_explain",
+        "EXPLAIN SELECT 1",
+        "RELEASE SAVEPOINT skit_calls_explain",
+    ]
+    entry = json.loads(log.read_text())
+    assert entry["error"] == "QueryCanceledError" and entry["plan"] == "Seq Scan on turn\nExecution Time: 31000 ms"
+
+    executed.clear()
+    with pytest.raises(DataError):
+        query.execute_logged(ExplainedCursor(executed, error=DataError("bad")), const.RANDOM_CALL_ID_QUERY, "SELECT 1")
+    assert executed == ["SELECT 1"]
+    assert [(report.error, report.rows) for report in stats] == [("QueryCanceledError", -1), ("DataError", -1)]
+    assert all(report.seconds >= 0 for report in stats)
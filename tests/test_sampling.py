@@ -0,0 +1,164 @@
+import random
+from contextlib import nullcontext
+
+import pytest
+
+from skit_calls import constants as const
+from skit_calls.data import query, sampling
+from skit_calls.data.exclusions import ExclusionIndex
+
+POPULATION = range(200000)
+
+
+def fake_fetch_call_ids(queries, row_order=None):
+    """
+    A stand in for `fetch_call_ids`, returning rows in the order `row_order` shuffles them to.
+    """
+
+    def fetch_call_ids(query, call_filters, retry_limit=2, seed=None, name=None):
+        queries.append({**call_filters, "setseed": seed})
+        if const.HASH_BUCKETS_PARAM in call_filters:
+            buckets = set(call_filters[const.HASH_BUCKETS_PARAM])
+            rows = [id_ for id_ in POPULATION if id_ % const.HASH_BUCKETS in buckets and id_ % 3 == 0]
+        else:
+            n_pages = int(len(POPULATION) * call_filters[const.SAMPLE_PERCENT] / 100)
+            rows = [id_ for id_ in POPULATION[:n_pages] if id_ % 3 == 0]
+        if row_order is not None:
+            row_order.shuffle(rows)
+        return tuple(rows)
+
+    return fetch_call_ids
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    queries = []
+    monkeypatch.setattr(sampling, "fetch_call_ids", fake_fetch_call_ids(queries))
+    monkeypatch.setattr(sampling, "get_query", lambda name: name)
+    monkeypatch.setattr(sampling, "sampled_query", lambda name: name)
+    return queries
+
+
+@pytest.mark.parametrize("strategy", [const.BLOCK_SAMPLING, const.HASH_SAMPLING])
+def test_strategies_fetch_what_is_asked(fake_db, strategy):
+    call_ids = sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7)
+    assert len(call_ids) == len(set(call_ids)) == 220
+    assert all(id_ % 3 == 0 for id_ in call_ids)
+    assert call_ids == sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7)
+
+
+@pytest.mark.parametrize("strategy", [const.BLOCK_SAMPLING, const.HASH_SAMPLING])
+def test_seeded_samples_dont_depend_on_row_order(fake_db, monkeypatch, strategy):
+    call_ids = sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7)
+    assert all(call_filters["setseed"] == 7 and call_filters[const.SEED] == 7 for call_filters in fake_db)
+    for row_seed in (1, 2):
+        monkeypatch.setattr(sampling, "fetch_call_ids", fake_fetch_call_ids([], random.Random(row_seed)))
+        assert sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7) == call_ids
+
+
+def test_hash_buckets_are_disjoint_and_scale_with_quantity(fake_db):
+    sampling.sample_call_ids(const.HASH_SAMPLING, {const.LIMIT: 220.0}, seed=1)
+    buckets = [bucket for call_filters in fake_db for bucket in call_filters[const.HASH_BUCKETS_PARAM]]
+    assert len(buckets) == len(set(buckets))
+    # ~65 matching calls per bucket, 220 calls shouldn't need more than a handful of buckets.
+    assert len(buckets) <= 8
+
+
+RANDOM_QUERY = """
+SELECT c.id FROM call AS c JOIN flow f ON f.id = c.flow_id
+WHERE c.created_at BETWEEN %(start_date)s AND %(end_date)s
+ORDER BY random() LIMIT %(limit)s
+"""
+
+
+def test_sampled_queries_are_derived_from_the_random_query(monkeypatch):
+    monkeypatch.delenv(const.BLOCK_SAMPLED_CALL_ID_QUERY, raising=False)
+    monkeypatch.delenv(const.HASH_SAMPLED_CALL_ID_QUERY, raising=False)
+    monkeypatch.setattr(sampling, "get_query", lambda name: RANDOM_QUERY)
+    block = sampling.sampled_query(const.BLOCK_SAMPLED_CALL_ID_QUERY)
+    assert "FROM call AS c TABLESAMPLE SYSTEM (%(sample_percent)s) REPEATABLE (%(seed)s) JOIN flow" in block
+    hash_ = sampling.sampled_query(const.HASH_SAMPLED_CALL_ID_QUERY)
+    assert "WHERE (hashint8(c.id) & 1023) IN %(hash_buckets)s AND c.created_at BETWEEN" in hash_
+    for derived in (block, hash_):
+        assert "ORDER BY md5(c.id::text || %(seed)s) LIMIT %(limit)s" in derived
+        assert "random()" not in derived
+
+    monkeypatch.setattr(sampling, "get_query", lambda name: "SELECT 1")
+    with pytest.raises(ValueError):
+        sampling.sampled_query(const.HASH_SAMPLED_CALL_ID_QUERY)
+
+
+def test_unset_query_paths_fail_early(monkeypatch):
+    monkeypatch.delenv("TEST_UNSET_QUERY", raising=False)
+    with pytest.raises(ValueError, match="TEST_UNSET_QUERY isn't set"):
+        query.get_query("TEST_UNSET_QUERY")
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        sampling.sample_call_ids("reservoir", {const.LIMIT: 1})
+
+
+def test_partitions_split_call_ids_exactly():
+    call_ids = tuple(range(10000, 30000, 7))
+    partitions = [sampling.partition_call_ids(call_ids, (i, 4)) for i in range(4)]
+    assert sorted(id_ for partition in partitions for id_ in partition) == sorted(call_ids)
+    assert all(abs(len(partition) - len(call_ids) / 4) < len(call_ids) * 0.05 for partition in partitions)
+    assert partitions[1] == sampling.partition_call_ids(list(call_ids), (1, 4))
+    assert list(sampling.partition_call_ids(iter(call_ids), (1, 4))) == list(partitions[1])
+    with pytest.raises(ValueError):
+        sampling.partition_call_ids(call_ids, (4, 4))
+
+
+@pytest.mark.parametrize("strategy", [const.BLOCK_SAMPLING, const.HASH_SAMPLING])
+def test_partitioned_samples_add_up_to_the_unpartitioned_sample(monkeypatch, strategy):
+    monkeypatch.setattr(sampling, "sampled_query", lambda name: name)
+    monkeypatch.setattr(sampling, "fetch_call_ids", fake_fetch_call_ids([]))
+    call_ids = sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7)
+    partitions = []
+    for i in range(4):
+        # Each process's db returns the rows in its own order.
+        monkeypatch.setattr(sampling, "fetch_call_ids", fake_fetch_call_ids([], random.Random(i)))
+        sample = sampling.sample_call_ids(strategy, {const.LIMIT: 220.0}, seed=7)
+        partitions.append(sampling.partition_call_ids(sample, (i, 4)))
+    assert sorted(id_ for partition in partitions for id_ in partition) == sorted(call_ids)
+
+
+def test_random_sampling_seeds_the_transaction(monkeypatch):
+    executed = []
+
+    class Cursor:
+        rowcount = 2
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def execute(self, sql, params=None):
+            executed.append((sql, params))
+
+        def fetchall(self):
+            return [(1,), (2,)]
+
+    class Connection:
+        def cursor(self):
+            return Cursor()
+
+    monkeypatch.setattr(query, "pooled", lambda writable=False: nullcontext(Connection()))
+    monkeypatch.setattr(sampling, "get_query", lambda name: name)
+    assert sampling.sample_call_ids(const.RANDOM_SAMPLING, {const.LIMIT: 2}, seed=42) == (1, 2)
+    (setseed, (value,)), _ = executed
+    assert setseed == "SELECT setseed(%s)" and -1 <= value <= 1
+    assert value == query.as_setseed_arg(42) != query.as_setseed_arg(43)
+
+
+def test_excluded_call_ids_are_never_sampled(fake_db, tmp_path):
+    exclusions = ExclusionIndex(str(tmp_path / "excluded.npy"))
+    exclusions.add(id_ for id_ in POPULATION if id_ % 2 == 0)
+    call_ids = sampling.sample_call_ids(const.BLOCK_SAMPLING, {const.LIMIT: 220.0}, seed=7, exclusions=exclusions)
+    # The fake queries ignore %(excluded_call_ids)s, so the limit grows until enough calls are left.
+    assert len(call_ids) == len(set(call_ids)) == 220
+    assert not exclusions.contains(call_ids).any()
+    assert len(fake_db[-1][const.EXCLUDED_CALL_IDS]) == len(exclusions)
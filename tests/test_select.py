@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+from skit_calls import calls
+from skit_calls.data import query
+
+
+def test_streaming_select_resolves_uuids_in_bounded_batches(tmp_path, monkeypatch):
+    csv_file = tmp_path / "uuids.csv"
+    uuids = [f"uuid-{i % 23}" for i in range(60)]
+    pd.DataFrame({"call_uuid": uuids, "other": range(60)}).to_csv(csv_file, index=False)
+    lookups = []
+
+    def get_call_ids_from_uuids(uuids, ids_):
+        lookups.append(uuids)
+        return tuple(int(uuid.split("-")[1]) for uuid in uuids)
+
+    monkeypatch.setattr(query, "get_call_ids_from_uuids", get_call_ids_from_uuids)
+    call_ids = calls.stream_call_ids_from_csv(str(csv_file), "call_uuid", {1}, chunk_size=10, batch_size=5)
+    assert sorted(call_ids) == list(range(23))
+    assert max(len(batch) for batch in lookups) <= 5
+    assert sum(len(batch) for batch in lookups) == 23
+
+
+def test_call_id_streams_are_batched_lazily():
+    id_batches, total = query.batch_ids(iter(range(7)), 3)
+    assert total is None
+    assert list(id_batches) == [(0, 1, 2), (3, 4, 5), (6,)]
+    id_batches, total = query.batch_ids(list(range(7)), 3)
+    assert total == 3
+    assert list(id_batches) == [(0, 1, 2), (3, 4, 5), (6,)]
+
+
+def test_streaming_select_without_matches_is_an_error(tmp_path, monkeypatch):
+    csv_file = tmp_path / "uuids.csv"
+    pd.DataFrame({"call_uuid": ["uuid-1", "uuid-2"]}).to_csv(csv_file, index=False)
+    monkeypatch.setattr(query, "get_call_ids_from_uuids", lambda uuids, ids_: ())
+    with pytest.raises(ValueError):
+        calls.select_call_ids(org_ids={1}, csv_file=str(csv_file), uuid_col="call_uuid", stream=True)
+
+    monkeypatch.setattr(query, "get_call_ids_from_uuids", lambda uuids, ids_: (7,) if "uuid-2" in uuids else ())
+    call_ids = calls.select_call_ids(org_ids={1}, csv_file=str(csv_file), uuid_col="call_uuid", stream=True)
+    assert list(call_ids) == [7]
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from skit_calls import calls, server
+from skit_calls.data import db
+from tests.test_db import fake_primary
+
+
+@pytest.fixture(autouse=True)
+def no_pools(monkeypatch):
+    monkeypatch.setattr(db, "close_pools", lambda: None)
+
+
+async def request_all(requests, max_jobs=2, root=None):
+    async with TestClient(TestServer(server.build_app(max_jobs, warm=False, root=root))) as client:
+        return await requests(client)
+
+
+def test_turns_are_streamed_as_json_lines(monkeypatch):
+    closed = []
+
+    def iter_sample(start_date, end_date, lang, call_quantity=200):
+        try:
+            for i in range(call_quantity * 3):
+                yield {"call_id": str(i // 3), "intent": "_confirm_", "lang": lang}
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(calls, "iter_sample", iter_sample)
+
+    async def requests(client):
+        response = await client.post(
+            "/sample", json={"start_date": "2022-01-01", "end_date": "2022-01-02", "lang": "en", "call_quantity": 5}
+        )
+        return response.status, response.headers["Content-Type"], await response.text()
+
+    status, content_type, body = asyncio.run(request_all(requests))
+    turns = [json.loads(line) for line in body.splitlines()]
+    assert status == 200 and content_type == "application/x-ndjson"
+    assert len(turns) == 15 and turns[-1] == {"call_id": "4", "intent": "_confirm_", "lang": "en"}
+    assert closed == [True]
+
+
+def test_bad_jobs_get_an_error_status(monkeypatch):
+    def iter_select(call_ids=None):
+        raise ValueError("No call ids to select.")
+        yield
+
+    monkeypatch.setattr(calls, "iter_select", iter_select)
+
+    async def requests(client):
+        unknown = await client.post("/select", json={"call_ids": [1], "colour": "red"})
+        invalid = await client.post("/select", json={})
+        not_json = await client.post("/select", data="call_ids=1")
+        health = await (await client.get("/health")).json()
+        return unknown.status, invalid.status, (await invalid.json())["error"], not_json.status, health
+
+    unknown, invalid, message, not_json, health = asyncio.run(request_all(requests))
+    assert (unknown, invalid, not_json) == (400, 400, 400)
+    assert message == "No call ids to select."
+    assert health == {"active": 0, "max_jobs": 2}
+
+
+def test_jobs_over_the_limit_are_turned_away(monkeypatch, tmp_path):
+    started, release = threading.Semaphore(0), threading.Event()
+
+    def sample(**params):
+        started.release()
+        release.wait(5)
+        path = tmp_path / f"{params['lang']}.csv"
+        path.write_text("call_id\n1\n")
+        return str(path)
+
+    monkeypatch.setattr(calls, "sample", sample)
+
+    async def requests(client):
+        loop = asyncio.get_running_loop()
+
+        def job(lang):
+            output = str(tmp_path / "out" / f"{lang}.csv")
+            return asyncio.create_task(client.post("/sample", json={"lang": lang, "output": output}))
+
+        running = [job("en"), job("hi")]
+        for _ in running:
+            await loop.run_in_executor(None, started.acquire)
+        rejected = await client.post("/sample", json={"lang": "ta"})
+        release.set()
+        done = [await (await task).json() for task in running]
+        return rejected.status, rejected.headers["Retry-After"], done
+
+    status, retry_after, done = asyncio.run(request_all(requests, root=str(tmp_path)))
+    assert status == 429 and retry_after == "5"
+    assert sorted(result["path"] for result in done) == [str(tmp_path / "out" / "en.csv"), str(tmp_path / "out" / "hi.csv")]
+    assert (tmp_path / "out" / "hi.csv").read_text() == "call_id\n1\n"
+
+
+def test_more_jobs_than_db_connections_share_the_pool(monkeypatch):
+    primary = fake_primary(monkeypatch, pool_size=4)
+    both_connected = threading.Barrier(2, timeout=5)
+
+    def iter_select(call_ids):
+        # Like a streamed select: uuids are resolved on one connection while turns are fetched on another.
+        with db.pooled(), db.pooled():
+            both_connected.wait()
+        yield {"call_id": str(call_ids[0])}
+
+    monkeypatch.setattr(calls, "iter_select", iter_select)
+
+    async def requests(client):
+        statuses = []
+        for wave in range(3):
+            responses = await asyncio.gather(
+                *(client.post("/select", json={"call_ids": [wave * 2 + i]}) for i in range(2))
+            )
+            statuses += [response.status for response in responses]
+            # A job's slot is released after its response ends.
+            while (await (await client.get("/health")).json())["active"]:
+                await asyncio.sleep(0.01)
+        return statuses
+
+    assert asyncio.run(request_all(requests, max_jobs=2)) == [200] * 6
+    assert primary.pool.most_used == 4 and primary.pool.used == 0
+
+    with pytest.raises(ValueError, match="DB_POOL_SIZE=4"):
+        server.build_app(max_jobs=3, warm=False)
+
+
+def test_jobs_only_set_allowed_parameters_and_paths(monkeypatch, tmp_path):
+    jobs = []
+    monkeypatch.setattr(calls, "write_result", lambda kind, params, output: jobs.append((params, output)) or output)
+
+    async def requests(client):
+        responses = [
+            await client.post("/sample", json={"lang": "en", "workers": 64}),
+            await client.post("/sample", json={"lang": "en", "bulk": True}),
+            await client.post("/sample", json={"lang": "en", "output": "../escaped.csv"}),
+            await client.post(
+                "/sample", json={"lang": "en", "output": "s3://bucket/prefix", "exclusion_index": "/tmp/x"}
+            ),
+            await client.post("/select", json={"csv_file": str(tmp_path / "uuids.csv"), "output": "out/calls.csv"}),
+        ]
+        return [(response.status, await response.json()) for response in responses]
+
+    results = asyncio.run(request_all(requests, root=str(tmp_path)))
+    assert [status for status, _ in results] == [400, 400, 400, 400, 200]
+    assert "workers" in results[0][1]["error"] and "inside" in results[2][1]["error"]
+    assert jobs == [({"csv_file": str(tmp_path / "uuids.csv")}, str(tmp_path / "out" / "calls.csv"))]
+
+    with pytest.raises(ValueError, match="no root"):
+        server.check_params("select", {"csv_file": "uuids.csv"})
+    assert server.check_params("select", {"csv_file": "s3://bucket/uuids.csv"}) == {"csv_file": "s3://bucket/uuids.csv"}
+
+
+def test_warm_up_reads_queries_and_connects(monkeypatch, tmp_path):
+    query_file = tmp_path / "random_call_id.sql"
+    query_file.write_text("SELECT 1")
+    monkeypatch.setenv(server.const.RANDOM_CALL_ID_QUERY, str(query_file))
+    read = []
+    monkeypatch.setattr(server.query, "get_query", read.append)
+    endpoints = db.Endpoints([db.Endpoint("primary", primary=True), db.Endpoint("replica")])
+    monkeypatch.setattr(db, "get_endpoints", lambda: endpoints)
+    monkeypatch.setattr(db.Endpoint, "get_pool", lambda self: setattr(self, "pool", "warm"))
+
+    server.warm_up()
+    assert server.const.RANDOM_CALL_ID_QUERY in read
+    assert [endpoint.pool for endpoint in endpoints.endpoints] == ["warm", "warm"]
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from skit_calls import calls
+from skit_calls import constants as const
+from skit_calls.data import query
+from skit_calls.shards import parse_shard_size, save_turns_in_shards
+from tests.conftest import fake_raw_batches
+
+
+def turn_batches(n_batches=5, output_format=const.CSV):
+    # 8 rows a batch keeps the 4 turn calls of make_record within one batch, like batching by call id does.
+    return [query.decode_batch(batch, const.DEFAULT_AUDIO_URL_DOMAIN, output_format=output_format)
+            for batch in fake_raw_batches(n_batches, batch_rows=8)]
+
+
+def read_manifest(output_dir):
+    with open(os.path.join(output_dir, const.SHARD_MANIFEST)) as handle:
+        return json.load(handle)
+
+
+def read_shards(output_dir):
+    manifest = read_manifest(output_dir)
+    return [pd.read_csv(os.path.join(output_dir, shard["path"]), dtype=str) for shard in manifest["shards"]]
+
+
+def test_shards_never_split_calls(tmp_path):
+    batches = turn_batches()
+    save_turns_in_shards(batches, str(tmp_path), shard_size=6)
+    manifest = read_manifest(tmp_path)
+    shards = read_shards(tmp_path)
+
+    assert manifest["complete"]
+    assert [shard["rows"] for shard in manifest["shards"]] == [4] * 10
+    call_ids = [set(shard.call_id) for shard in shards]
+    assert all(len(ids) == 1 for ids in call_ids)
+
+    single_file = calls.save_turns_on_disk((turn for batch in batches for turn in batch))
+    expected = pd.read_csv(single_file, dtype=str)
+    pd.testing.assert_frame_equal(pd.concat(shards, ignore_index=True), expected)
+    expected_files = {shard["path"] for shard in manifest["shards"]} | {const.SHARD_MANIFEST}
+    assert set(os.listdir(tmp_path)) == expected_files
+
+
+def test_shards_by_bytes_and_count(tmp_path):
+    save_turns_in_shards(turn_batches(), str(tmp_path / "bytes"), shard_size="8KB")
+    manifest = read_manifest(tmp_path / "bytes")
+    assert all(shard["bytes"] <= 8 * 1024 for shard in manifest["shards"])
+    assert sum(shard["rows"] for shard in manifest["shards"]) == 40
+
+    save_turns_in_shards(turn_batches(), str(tmp_path / "count"), num_shards=3, n_calls=10)
+    manifest = read_manifest(tmp_path / "count")
+    assert [shard["calls"] for shard in manifest["shards"]] == [4, 4, 2]
+
+    with pytest.raises(ValueError):
+        save_turns_in_shards(turn_batches(), str(tmp_path / "unknown"), num_shards=3)
+
+
+def test_shards_are_listed_before_the_download_ends(tmp_path):
+    seen = []
+
+    def batches():
+        for batch in turn_batches(output_format=const.JSONL):
+            yield batch
+            seen.append(read_manifest(tmp_path))
+
+    save_turns_in_shards(batches(), str(tmp_path), output_format=const.JSONL, shard_size=8)
+    assert [len(manifest["shards"]) for manifest in seen] == [0, 1, 2, 3, 4]
+    assert not any(manifest["complete"] for manifest in seen)
+    first = seen[1]["shards"][0]["path"]
+    assert first.endswith(const.JSONL_FILE)
+    with open(tmp_path / first) as handle:
+        assert len(handle.readlines()) == 8
+
+
+def test_parse_shard_size():
+    assert parse_shard_size(None) == (None, None)
+    assert parse_shard_size(100) == (100, None)
+    assert parse_shard_size("100") == (100, None)
+    assert parse_shard_size("64MB") == (None, 64 * 2**20)
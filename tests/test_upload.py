@@ -0,0 +1,109 @@
+from contextlib import asynccontextmanager
+from functools import partial
+
+import pytest
+
+from skit_calls import calls, upload
+from skit_calls import constants as const
+from skit_calls.data import query
+from tests.conftest import fake_raw_batches
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+
+    async def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    async def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f'"{PartNumber}"'}
+
+    async def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == sorted(parts)
+        self.objects[(Bucket, Key)] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(self.uploads.pop(UploadId))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3Client()
+    endpoints = []
+
+    class Session:
+        @asynccontextmanager
+        async def create_client(self, service, endpoint_url=None, config=None):
+            endpoints.append(endpoint_url)
+            yield client
+
+    monkeypatch.setattr(upload, "get_session", Session)
+    monkeypatch.setattr(calls, "open_s3_output", partial(upload.open_s3_output, part_size=1024))
+    monkeypatch.setenv(const.S3_ENDPOINT_URL, "http://localhost:9000")
+    client.endpoints = endpoints
+    return client
+
+
+def turns(n_batches=5):
+    for batch in fake_raw_batches(n_batches):
+        yield from query.decode_batch(batch, const.DEFAULT_AUDIO_URL_DOMAIN, output_format=const.CSV_ROWS)
+
+
+def test_output_key():
+    assert upload.output_key("s3://bucket/datasets/calls.csv", ".csv") == ("bucket", "datasets/calls.csv")
+    bucket, key = upload.output_key("s3://bucket/datasets/", ".jsonl")
+    assert bucket == "bucket" and key.startswith("datasets/") and key.endswith(".jsonl")
+    assert "/" not in upload.output_key("s3://bucket", ".csv")[1]
+    with pytest.raises(ValueError):
+        upload.parse_output_url("https://bucket/key")
+
+
+def test_turns_are_uploaded_in_parts_while_they_are_written(s3):
+    expected = open(calls.save_turns_on_disk(turns(), const.CSV_ROWS), "rb").read()
+    parts_seen = []
+
+    def watched():
+        for i, turn in enumerate(turns()):
+            if i % 10 == 0:
+                parts_seen.append(sum(len(parts) for parts in s3.uploads.values()))
+            yield turn
+
+    url = calls.save_turns_on_disk(watched(), const.CSV_ROWS, output="s3://bucket/datasets/run-1.csv")
+    assert url == "s3://bucket/datasets/run-1.csv"
+    assert s3.objects[("bucket", "datasets/run-1.csv")] == expected
+    assert s3.endpoints == ["http://localhost:9000"]
+    assert len(expected) > 4 * 1024 and 0 < parts_seen[-1] < len(expected) // 1024
+
+
+def test_small_outputs_are_put_in_one_request(s3):
+    url = calls.save_turns_on_disk(iter([]), const.JSONL, output="s3://bucket/datasets")
+    assert url.startswith("s3://bucket/datasets/") and url.endswith(const.JSONL_FILE)
+    assert list(s3.objects.values()) == [b""] and not s3.uploads
+
+
+def test_failed_writes_abort_the_upload(s3):
+    def failing():
+        yield from turns()
+        raise RuntimeError("connection lost")
+
+    with pytest.raises(RuntimeError):
+        calls.save_turns_on_disk(failing(), const.CSV_ROWS, output="s3://bucket/datasets/")
+    assert not s3.objects and not s3.uploads and len(s3.aborted) == 1
+
+
+def test_output_needs_a_single_file():
+    calls.check_output("s3://bucket/prefix")
+    with pytest.raises(ValueError):
+        calls.check_output("/tmp/calls.csv")
+    with pytest.raises(ValueError):
+        calls.check_output("s3://bucket/prefix", sharded=True)
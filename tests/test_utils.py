@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from skit_calls.utils import QueueStats, parse_size, prefetch
+
+
+def test_prefetch_keeps_order():
+    assert list(prefetch(range(100), maxsize=3)) == list(range(100))
+
+
+def test_prefetch_raises_producer_errors():
+    def failing():
+        yield 1
+        raise ValueError("db went away")
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="db went away"):
+        next(items)
+
+
+def test_prefetch_runs_ahead_of_consumer():
+    produced = []
+    ready = threading.Event()
+
+    def producer():
+        for i in range(3):
+            produced.append(i)
+            if i == 2:
+                ready.set()
+            yield i
+
+    items = prefetch(producer(), maxsize=2)
+    assert next(items) == 0
+    assert ready.wait(timeout=2)
+    assert list(items) == [1, 2]
+
+
+def test_prefetch_records_queue_stats():
+    stats = QueueStats("stage")
+    assert list(prefetch(range(10), maxsize=4, stats=stats)) == list(range(10))
+    assert stats.items == 10
+    assert stats.maxsize == 4
+    assert 0 <= stats.mean_occupancy <= stats.max_occupancy <= 4
+    assert str(stats).startswith("stage: 10 items")
+
+
+def test_parse_size():
+    assert parse_size("512") == 512
+    assert parse_size("64MB") == 64 * 2**20
+    assert parse_size("1.5gb") == 3 * 2**29
+    with pytest.raises(ValueError):
+        parse_size("64 parsecs")